@@ -1,2 +1,2 @@
-from . import (augmenters, chroma, classify, data, experiment, features,
-               targets, test)
+from . import (audio, augmenters, chroma, classify, data, experiment,
+               features, targets, test)
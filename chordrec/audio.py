@@ -0,0 +1,111 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import madmom as mm
+
+CACHE_DIR = 'audio_cache'
+PCM_EXT = '.f32'
+
+# madmom scales integer signals by the maximum value of their data type when
+# computing a STFT. we store decoded audio already scaled this way, so features
+# computed from the cached signals equal those computed from the audio files.
+INT16_MAX = float(np.iinfo(np.int16).max)
+
+# content hashes of files already seen by this process
+_hashes = {}
+
+
+def content_hash(filename):
+    """
+    Computes the hash of a file's content. Hashes are remembered as long as
+    the file is not modified.
+    :param filename: file to hash
+    :return:         hash value of the file content
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+    if key not in _hashes:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            # this needs an empty *byte* string b'' as a sentinel value
+            for chunk in iter(lambda: f.read(128 * sha1.block_size), b''):
+                sha1.update(chunk)
+        _hashes[key] = sha1.hexdigest()
+
+    return _hashes[key]
+
+
+def cache_file(audio_file, sample_rate, num_channels, cache_dir=None):
+    """
+    Determines where the decoded audio of a file is stored
+    :param audio_file:   audio file
+    :param sample_rate:  sample rate of the decoded audio
+    :param num_channels: number of channels of the decoded audio
+    :param cache_dir:    audio cache directory
+    :return:             file containing the decoded audio
+    """
+    return os.path.join(
+        cache_dir or CACHE_DIR,
+        '{}_sr={}_ch={}{}'.format(content_hash(audio_file), sample_rate,
+                                  num_channels, PCM_EXT)
+    )
+
+
+def decode(audio_file, pcm_file, sample_rate, num_channels):
+    """
+    Decodes an audio file and stores it as raw float32 PCM samples
+    :param audio_file:   audio file to decode
+    :param pcm_file:     file to store the samples to
+    :param sample_rate:  sample rate to decode to
+    :param num_channels: number of channels to decode to
+    """
+    sig = mm.audio.signal.Signal(audio_file, sample_rate=sample_rate,
+                                 num_channels=num_channels)
+
+    if np.issubdtype(sig.dtype, np.integer):
+        pcm = (sig / float(np.iinfo(sig.dtype).max)).astype(np.float32)
+    else:
+        pcm = np.asarray(sig, dtype=np.float32)
+
+    cache_dir = os.path.dirname(pcm_file)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another process might have created it in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+
+    # write to a temporary file first, so that other processes never see
+    # partially decoded audio
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp',
+                                     delete=False) as f:
+        pcm.tofile(f)
+    os.rename(f.name, pcm_file)
+
+
+def load_signal(audio_file, sample_rate=44100, num_channels=1,
+                cache_dir=None):
+    """
+    Loads the decoded audio of a file. The audio is decoded only the first
+    time it is requested; afterwards, the stored samples are memory-mapped
+    and wrapped as a signal without copying.
+    :param audio_file:   audio file
+    :param sample_rate:  sample rate of the signal
+    :param num_channels: number of channels of the signal
+    :param cache_dir:    audio cache directory
+    :return:             float32 signal scaled to [-1, 1]
+    """
+    pcm_file = cache_file(audio_file, sample_rate, num_channels, cache_dir)
+
+    if not os.path.exists(pcm_file):
+        decode(audio_file, pcm_file, sample_rate, num_channels)
+
+    pcm = np.memmap(pcm_file, dtype=np.float32, mode='r')
+    if num_channels > 1:
+        pcm = pcm.reshape((-1, num_channels))
+
+    return mm.audio.signal.Signal(pcm, sample_rate=sample_rate,
+                                  num_channels=num_channels)
@@ -1,13 +1,20 @@
 import numpy as np
 from scipy.ndimage import shift
 import random
+import ctypes
+import threading
+import traceback
+import multiprocessing
+import Queue
+from itertools import chain
+import dmgr
 from targets import one_hot
 
 
 class SemitoneShift(object):
 
     def __init__(self, p, max_shift, bins_per_semitone,
-                 target_type='chords_maj_min'):
+                 target_type='chords_maj_min', num_classes=None):
         """
         Augmenter that shifts by semitones a spectrum with logarithmically
         spaced frequency bins.
@@ -16,10 +23,14 @@ class SemitoneShift(object):
         :param max_shift: maximum number of semitones to shift
         :param bins_per_semitone: number of spectrogram bins per semitone
         :param target_type: specifies target type
+        :param num_classes: number of chord classes. only needed if the
+                            targets are class ids instead of one-hot vectors
         """
         self.p = p
         self.max_shift = max_shift
         self.bins_per_semitone = bins_per_semitone
+        self.num_classes = num_classes
+        self._roll_tables = {}
 
         if target_type == 'chords_maj_min':
             self.adapt_targets = self._adapt_targets_chords_maj_min
@@ -27,32 +38,80 @@ class SemitoneShift(object):
             self.adapt_targets = self._adapt_targets_chroma
 
     def _adapt_targets_chords_maj_min(self, targets, shifts):
-        chord_classes = targets.argmax(-1)
-        no_chord_class = targets.shape[-1] - 1
+        class_ids = targets.dtype.kind in 'iu'
+
+        if class_ids:
+            if self.num_classes is None:
+                raise ValueError('Need the number of classes to shift '
+                                 'class id targets')
+            chord_classes = targets
+            no_chord_class = self.num_classes - 1
+        else:
+            chord_classes = targets.argmax(-1)
+            no_chord_class = targets.shape[-1] - 1
+
         no_chords = (chord_classes == no_chord_class)
         chord_roots = chord_classes % 12
         chord_majmin = chord_classes / 12
 
+        # sequence targets have one class per step; shift them all
+        shifts = shifts.reshape(shifts.shape + (1,) * (chord_classes.ndim - 1))
+
         new_chord_roots = (chord_roots + shifts) % 12
         new_chord_classes = new_chord_roots + chord_majmin * 12
         new_chord_classes[no_chords] = no_chord_class
-        new_targets = one_hot(new_chord_classes, no_chord_class + 1)
+
+        if class_ids:
+            return new_chord_classes.astype(targets.dtype)
+
+        num_classes = no_chord_class + 1
+        new_targets = one_hot(new_chord_classes.ravel(), num_classes).reshape(
+            new_chord_classes.shape + (num_classes,))
         return new_targets
 
     def _adapt_targets_chroma(self, targets, shifts):
-        new_targets = np.empty_like(targets)
-        for i in range(len(targets)):
-            new_targets[i] = np.roll(targets[i], shifts[i], axis=-1)
-        return new_targets
+        return self._roll(targets, shifts, 1)
+
+    def _roll(self, data, shifts, bins_per_shift):
+        """
+        Rolls each sample of a batch along the last axis, equivalent to
+        calling np.roll for each sample. Samples with the same shift are
+        rolled together using a precomputed index table.
+        :param data: batch of samples
+        :param shifts: number of semitones to shift each sample
+        :param bins_per_shift: number of bins per semitone
+        :return: rolled samples
+        """
+        num_bins = data.shape[-1]
+        key = (num_bins, bins_per_shift)
+
+        if key not in self._roll_tables:
+            # rolling by s takes element (i - s) mod n to position i.
+            # precompute these indices for every possible shift
+            bin_shifts = np.arange(-self.max_shift, self.max_shift + 1)
+            bin_shifts *= bins_per_shift
+            self._roll_tables[key] = \
+                (np.arange(num_bins) - bin_shifts[:, np.newaxis]) % num_bins
+
+        rolled = np.empty_like(data)
+        for amount, idxs in enumerate(self._roll_tables[key],
+                                      -self.max_shift):
+            samples = np.flatnonzero(shifts == amount)
+            if len(samples) > 0:
+                rolled[samples] = data[samples][..., idxs]
+
+        return rolled
 
     def __call__(self, batch_iterator):
         """
         :param batch_iterator: data iterator that yields the data to be
-                               augmented
+                               augmented. additional batch elements after
+                               data and targets (e.g. masks) are passed on
         :return: augmented data/target pairs
         """
 
-        for data, targets in batch_iterator:
+        for batch in batch_iterator:
+            data, targets = batch[:2]
             batch_size = len(data)
 
             shifts = np.random.randint(-self.max_shift,
@@ -65,40 +124,85 @@ class SemitoneShift(object):
 
             new_targets = self.adapt_targets(targets, shifts)
 
+            # TODO: remove data from upper and lower parts that got
+            #       rolled (?)
+            new_data = self._roll(data, shifts, self.bins_per_semitone)
 
-            new_data = np.empty_like(data)
-            for i in range(batch_size):
-                # TODO: remove data from upper and lower parts that got
-                #       rolled (?)
-                new_data[i] = np.roll(
-                    data[i], shifts[i] * self.bins_per_semitone, axis=-1)
-
-            yield new_data, new_targets
+            yield (new_data, new_targets) + tuple(batch[2:])
 
 
 class Detuning(object):
 
-    def __init__(self, p, max_shift, bins_per_semitone):
+    def __init__(self, p, max_shift, bins_per_semitone, order=None):
         """
         Augmenter that shifts a spectrogram with logarithmically spaced
         frequency bins by maximum 0.5 semitones
         :param p: percentage of data to be shifted
         :param max_shift: maximum fraction of semitone to shirt (<= 0.5)
         :param bins_per_semitone: number of spectrogram bins per semitone
+        :param order: interpolation order. if None, each sample is shifted
+                      separately using spline interpolation (along the
+                      first sample axis). if 0 (nearest) or 1 (linear),
+                      all samples of a batch are shifted at once along the
+                      frequency (last) axis.
         """
         if max_shift >= 0.5:
             raise ValueError('Detuning only works up to half a semitone!')
+        if order not in (None, 0, 1):
+            raise ValueError('Batched detuning only supports interpolation '
+                             'orders 0 and 1')
         self.p = p
         self.max_shift = max_shift
         self.bins_per_semitone = bins_per_semitone
+        self.order = order
+
+    def _shift(self, data, bin_shifts):
+        """
+        Shifts each sample of a batch by a fractional number of bins along
+        the last axis. Bins shifted in from outside are zero.
+        :param data: batch of samples
+        :param bin_shifts: number of bins to shift each sample
+        :return: shifted samples
+        """
+        num_bins = data.shape[-1]
+
+        # sample i of the result takes its value from position i - shift.
+        # split this position into an integer offset and the interpolation
+        # weight of the next bin
+        if self.order == 0:
+            offsets = np.round(-bin_shifts).astype(int)
+            weights = np.zeros(len(data), dtype=data.dtype)
+        else:
+            offsets = np.floor(-bin_shifts).astype(int)
+            weights = (-bin_shifts - offsets).astype(data.dtype)
+
+        # pad with zeros so all offsets stay within the array
+        pad = np.abs(offsets).max() + 1
+        padded = np.zeros(data.shape[:-1] + (num_bins + 2 * pad,),
+                          dtype=data.dtype)
+        padded[..., pad:pad + num_bins] = data
+
+        weights = weights.reshape((-1,) + (1,) * (data.ndim - 1))
+
+        new_data = np.empty_like(data)
+        for offset in np.unique(offsets):
+            samples = np.flatnonzero(offsets == offset)
+            start = pad + offset
+            lower = padded[samples, ..., start:start + num_bins]
+            upper = padded[samples, ..., start + 1:start + 1 + num_bins]
+            new_data[samples] = lower + weights[samples] * (upper - lower)
+
+        return new_data
 
     def __call__(self, batch_iterator):
         """
         :param batch_iterator: data iterator that yields the data to be
-                               augmented
+                               augmented. additional batch elements after
+                               data and targets (e.g. masks) are passed on
         :return: augmented data/target pairs
         """
-        for data, targets in batch_iterator:
+        for batch in batch_iterator:
+            data = batch[0]
             batch_size = len(data)
 
             shifts = np.random.rand(batch_size) * 2 * self.max_shift - \
@@ -109,17 +213,381 @@ class Detuning(object):
                                      int(batch_size * (1 - self.p)))
             shifts[no_shift] = 0
 
-            new_data = np.empty_like(data)
-            for i in range(batch_size):
-                new_data[i] = shift(
-                    data[i], (shifts[i] * self.bins_per_semitone, 0))
+            if self.order is not None:
+                new_data = self._shift(data, shifts * self.bins_per_semitone)
+            else:
+                new_data = np.empty_like(data)
+                for i in range(batch_size):
+                    new_data[i] = shift(
+                        data[i], (shifts[i] * self.bins_per_semitone, 0))
 
-            yield new_data, targets
+            yield (new_data,) + tuple(batch[1:])
 
 
-def create_augmenters(augmentation):
-    return [globals()[name](**params)
-            for name, params in augmentation.iteritems()]
+def detuning_error(data, max_shift, bins_per_semitone, order=1):
+    """
+    Compares the batched detuning with shifting each sample along the
+    frequency axis using cubic spline interpolation.
+    :param data: batch of (real) feature samples
+    :param max_shift: maximum fraction of semitone to shift
+    :param bins_per_semitone: number of spectrogram bins per semitone
+    :param order: interpolation order of the batched detuning
+    :return: dictionary with mean and maximum absolute error, relative
+             error and the processing time of both versions
+    """
+    import time
+    bin_shifts = (np.random.rand(len(data)) * 2 * max_shift - max_shift) * \
+        bins_per_semitone
+
+    detuning = Detuning(1., max_shift, bins_per_semitone, order=order)
+    start = time.time()
+    batched = detuning._shift(data, bin_shifts)
+    batched_time = time.time() - start
+
+    axis_shift = (0,) * (data.ndim - 2)
+    start = time.time()
+    spline = np.empty_like(data)
+    for i in range(len(data)):
+        spline[i] = shift(data[i], axis_shift + (bin_shifts[i],), order=3)
+    spline_time = time.time() - start
+
+    err = np.abs(batched - spline)
+    return dict(mean_abs_err=float(err.mean()),
+                max_abs_err=float(err.max()),
+                rel_err=float(err.sum() / np.abs(spline).sum()),
+                batched_time=batched_time,
+                spline_time=spline_time)
+
+
+class Upcast(object):
+
+    def __init__(self, dtype='float32'):
+        """
+        Converts data stored in lower precision (e.g. float16 features) to
+        the precision the network computes in. Other data passes unchanged.
+        :param dtype: data type to convert to
+        """
+        self.dtype = np.dtype(dtype)
+
+    def __call__(self, batch_iterator):
+        for batch in batch_iterator:
+            data = batch[0]
+            if data.dtype.kind == 'f' and \
+                    data.dtype.itemsize < self.dtype.itemsize:
+                batch = (data.astype(self.dtype),) + tuple(batch[1:])
+            yield batch
+
+
+class OneHotTargets(object):
+
+    def __init__(self, num_classes):
+        """
+        Expands integer class id targets to one-hot vectors. Put this
+        at the end of the augmentation chain, so targets are kept compact
+        until they are fed to the network.
+        :param num_classes: number of classes
+        """
+        self.num_classes = num_classes
+
+    def __call__(self, batch_iterator):
+        """
+        :param batch_iterator: data iterator that yields class id targets
+        :return: data/one-hot target pairs
+        """
+        for batch in batch_iterator:
+            data, targets = batch[:2]
+            new_targets = one_hot(targets.ravel(), self.num_classes).reshape(
+                targets.shape + (self.num_classes,))
+            yield (data, new_targets) + tuple(batch[2:])
+
+
+# alignment of arrays in the shared memory buffers of the PrefetchIterator
+_ALIGN = 64
+
+
+def _pack(buf, arrays):
+    """
+    Copies arrays into a byte buffer
+    :param buf: byte buffer (numpy uint8 array)
+    :param arrays: arrays to copy
+    :return: layout of the arrays in the buffer, or None if they do not fit
+    """
+    layout = []
+    offset = 0
+    for a in arrays:
+        a = np.asarray(a)
+        end = offset + a.nbytes
+        if end > len(buf):
+            return None
+        buf[offset:end].view(a.dtype).reshape(a.shape)[...] = a
+        layout.append((offset, a.dtype.str, a.shape))
+        offset += -(-a.nbytes // _ALIGN) * _ALIGN
+    return layout
+
+
+def _unpack(buf, layout):
+    """
+    Creates views of arrays stored in a byte buffer
+    :param buf: byte buffer (numpy uint8 array)
+    :param layout: layout of the arrays, as returned by _pack
+    :return: tuple of arrays
+    """
+    arrays = []
+    for offset, dtype, shape in layout:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays.append(buf[offset:offset + nbytes].view(dtype).reshape(shape))
+    return tuple(arrays)
+
+
+def _prefetch_worker(batch_iterator, augmenters, buffers, tasks, results,
+                     seed):
+    # each worker has its own random number stream. batches are assigned
+    # to workers in a fixed order, so runs are reproducible
+    np.random.seed(seed)
+    random.seed(seed)
+    buffers = [np.frombuffer(b, dtype=np.uint8) for b in buffers]
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task == 'end':
+            results.put('end')
+            continue
+
+        slot, kind, payload = task
+        try:
+            if kind == 'plan':
+                # the worker is a fork of the main process, so it has its
+                # own copy of (or memory map into) the data source
+                batch = batch_iterator.assemble(payload)
+            elif kind == 'buffer':
+                # copy, so we can overwrite the slot with the results
+                batch = tuple(np.array(a) for a in
+                              _unpack(buffers[slot], payload))
+            else:
+                batch = payload
+
+            batches = iter([batch])
+            for aug in augmenters:
+                batches = aug(batches)
+            batch = tuple(next(batches))
+
+            layout = _pack(buffers[slot], batch)
+            results.put((slot, layout, batch if layout is None else None))
+        except Exception:
+            results.put(('error', traceback.format_exc(), None))
+
+
+class PrefetchIterator(object):
+
+    def __init__(self, batch_iterator, augmenters, num_workers=4,
+                 num_batches=8, seed=None):
+        """
+        Builds and augments batches in background processes while the
+        network trains on the current batch, and returns them in their
+        original order through shared memory buffers.
+
+        If the wrapped iterator can plan its batches (see e.g.
+        iterators.FrameBatchIterator), i.e. it has methods plan(), which
+        returns a list of compact descriptions of the batches of an epoch,
+        and assemble(description), which builds a batch, the workers
+        assemble the batches themselves. Otherwise, the batches are built by
+        the wrapped iterator in the main process and copied into the
+        buffers.
+
+        The worker processes run until close() is called or the iterator
+        is garbage collected.
+
+        :param batch_iterator: data iterator that yields the batches
+        :param augmenters: augmenters to apply, in this order
+        :param num_workers: number of worker processes
+        :param num_batches: maximum number of batches prepared in advance
+        :param seed: seed of the random number streams of the workers. if
+                     None, it is drawn from numpy's random number generator
+        """
+        self.batch_iterator = batch_iterator
+        self.augmenters = augmenters
+        self.num_workers = num_workers
+        self.num_batches = max(num_batches, num_workers)
+        self.seed = seed if seed is not None else np.random.randint(2 ** 30)
+        self._workers = None
+
+    def __getattr__(self, name):
+        # behave like the wrapped iterator (e.g. batch size)
+        if name == 'batch_iterator':
+            raise AttributeError(name)
+        return getattr(self.batch_iterator, name)
+
+    def __len__(self):
+        return len(self.batch_iterator)
+
+    def _start(self, batch):
+        # size the buffers based on the first batch, with some headroom for
+        # augmenters that change the size of data. larger batches are
+        # passed through the task queues instead
+        nbytes = sum(np.asarray(a).nbytes + _ALIGN for a in batch) * 2
+        self._buffers = [multiprocessing.RawArray(ctypes.c_char, nbytes)
+                         for _ in range(self.num_batches)]
+        self._tasks = [multiprocessing.Queue()
+                       for _ in range(self.num_workers)]
+        self._results = [multiprocessing.Queue()
+                         for _ in range(self.num_workers)]
+        self._workers = [
+            multiprocessing.Process(
+                target=_prefetch_worker,
+                args=(self.batch_iterator, self.augmenters, self._buffers,
+                      self._tasks[w], self._results[w], self.seed + w))
+            for w in range(self.num_workers)
+        ]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+        self._views = [np.frombuffer(b, dtype=np.uint8)
+                       for b in self._buffers]
+
+    def _feed(self, tasks, free_slots, stop, state):
+        seq = 0
+        try:
+            for kind, payload in tasks:
+                slot = None
+                while slot is None:
+                    if stop.is_set():
+                        return
+                    try:
+                        slot = free_slots.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+
+                if kind == 'batch':
+                    layout = _pack(self._views[slot], payload)
+                    if layout is not None:
+                        kind, payload = 'buffer', layout
+                    else:
+                        payload = tuple(payload)
+                self._tasks[seq % self.num_workers].put((slot, kind, payload))
+                seq += 1
+                state['submitted'] = seq
+        except Exception:
+            state['error'] = traceback.format_exc()
+        finally:
+            # the end marker travels through the workers like a batch
+            self._tasks[seq % self.num_workers].put('end')
+            state['submitted'] = seq + 1
+
+    def __iter__(self):
+        if hasattr(self.batch_iterator, 'plan'):
+            plan = self.batch_iterator.plan()
+            if len(plan) == 0:
+                return
+            if self._workers is None:
+                self._start(self.batch_iterator.assemble(plan[0]))
+            tasks = (('plan', p) for p in plan)
+        else:
+            batches = iter(self.batch_iterator)
+            try:
+                first = next(batches)
+            except StopIteration:
+                return
+            if self._workers is None:
+                self._start(first)
+            tasks = (('batch', b) for b in chain([first], batches))
+
+        free_slots = Queue.Queue()
+        for slot in range(self.num_batches):
+            free_slots.put(slot)
+
+        stop = threading.Event()
+        state = {'submitted': 0}
+        feeder = threading.Thread(
+            target=self._feed,
+            args=(tasks, free_slots, stop, state))
+        feeder.daemon = True
+        feeder.start()
+
+        seq = 0
+        try:
+            while True:
+                result = self._results[seq % self.num_workers].get()
+                seq += 1
+                if result == 'end':
+                    break
+
+                slot, layout, batch = result
+                if slot == 'error':
+                    raise RuntimeError('Augmentation failed:\n' + layout)
+                if layout is not None:
+                    batch = tuple(np.array(a) for a in
+                                  _unpack(self._views[slot], layout))
+                free_slots.put(slot)
+                yield batch
+
+            if 'error' in state:
+                raise RuntimeError('Creating batches failed:\n' +
+                                   state['error'])
+        finally:
+            # collect the batches still in flight, so the workers are idle
+            # when the next epoch starts
+            stop.set()
+            feeder.join()
+            for s in range(seq, state['submitted']):
+                self._results[s % self.num_workers].get()
+
+    def close(self):
+        """
+        Stops the worker processes
+        """
+        if self._workers is not None:
+            for tasks in self._tasks:
+                tasks.put(None)
+            for w in self._workers:
+                w.join()
+            self._workers = None
+
+    def __del__(self):
+        self.close()
+
+
+def create_augmenters(augmentation, num_classes=None):
+    """
+    Creates the augmenters defined in the augmentation config
+    :param augmentation: augmentation config
+    :param num_classes: number of classes, if the targets are class ids
+    :return: list of augmenters
+    """
+    augmenters = []
+    for name, params in augmentation.iteritems():
+        if name == 'SemitoneShift' and num_classes is not None:
+            params = dict(params, num_classes=num_classes)
+        augmenters.append(globals()[name](**params))
+    return augmenters
+
+
+def augment(batches, augmentation, prefetch=None, num_classes=None):
+    """
+    Applies the augmenters defined in the augmentation config to a batch
+    iterator. Data stored in lower precision is converted to float32 first.
+    :param batches: batch iterator
+    :param augmentation: augmentation config (can be None)
+    :param prefetch: if not None, prepare batches in background processes.
+                     dictionary of parameters for the PrefetchIterator
+                     (e.g. num_workers, num_batches, seed)
+    :param num_classes: if not None, the targets are class ids of this many
+                        classes. they are augmented as class ids and
+                        expanded to one-hot vectors at the end
+    :return: batch iterator yielding augmented batches
+    """
+    augmenters = [Upcast()]
+    if augmentation is not None:
+        augmenters += create_augmenters(augmentation, num_classes)
+    if num_classes is not None:
+        augmenters.append(OneHotTargets(num_classes))
+
+    if prefetch:
+        return PrefetchIterator(batches, augmenters, **prefetch)
+    else:
+        return dmgr.iterators.AugmentedIterator(batches, *augmenters)
 
 
 def add_sacred_config(ex):
@@ -134,7 +602,9 @@ def add_sacred_config(ex):
             Detuning=dict(
                 p=1.0,
                 max_shift=0.4,
-                bins_per_semitone=2
+                bins_per_semitone=2,
+                # None: spline interpolation per sample, 0 or 1: batched
+                order=None
             )
         )
     )
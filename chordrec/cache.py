@@ -0,0 +1,191 @@
+"""
+Content-addressed cache of computed features and targets.
+
+Computed arrays are stored once under a key derived from the content of their
+source file (audio or annotation) and the full parameter set of the extractor
+that computed them:
+
+    <feature_cache>/objects/<key[:2]>/<key>.npy
+
+Each dataset keeps a manifest (sqlite) that maps every song and extractor name
+to the key of its current entry. The file layout dmgr expects
+(<feature_cache>/<dataset>/<name>/<song>.features.npy) consists of symbolic
+links to the stored entries, so changing an audio file or an extractor
+parameter only recomputes the affected entries.
+"""
+import os
+import hashlib
+import sqlite3
+import numpy as np
+
+import audio
+
+STORE_DIR = 'objects'
+MANIFEST_FILE = 'manifest.sqlite'
+
+
+def _update_hash(sha1, value):
+    if isinstance(value, dict):
+        for k in sorted(value):
+            sha1.update(repr(k))
+            _update_hash(sha1, value[k])
+    elif isinstance(value, (list, tuple)):
+        sha1.update('[')
+        for v in value:
+            _update_hash(sha1, v)
+        sha1.update(']')
+    elif isinstance(value, np.ndarray):
+        sha1.update('{}{}'.format(value.dtype.str, value.shape))
+        sha1.update(np.ascontiguousarray(value).tostring())
+    elif value is None or isinstance(value, (bool, int, long, float, str,
+                                             unicode, np.generic)):
+        sha1.update(repr(value))
+    # other attributes (processors, engines, ...) are not parameters
+
+
+def param_hash(extractor):
+    """
+    Hashes the class and parameters of a feature extractor or target
+    computer. Parameters are all attributes of simple types (numbers,
+    strings, and lists, tuples and dictionaries of those) and numpy arrays
+    (e.g. filterbanks). Other attributes are ignored, except for the
+    extractor wrapped by another one.
+    :param extractor: feature extractor or target computer
+    :return:          hash value of the parameters
+    """
+    sha1 = hashlib.sha1(type(extractor).__name__)
+    _update_hash(sha1, vars(extractor))
+
+    # wrappers (e.g. features.StorageDtype) also depend on what they wrap
+    if hasattr(extractor, 'extractor'):
+        sha1.update(param_hash(extractor.extractor))
+
+    return sha1.hexdigest()
+
+
+def entry_key(*parts):
+    """
+    Computes the key of a cache entry
+    :param parts: everything the entry depends on (content hashes,
+                  parameter hashes, number of frames)
+    :return:      key of the entry
+    """
+    return hashlib.sha1('|'.join(map(str, parts))).hexdigest()
+
+
+def entry_file(store_dir, key):
+    """
+    Determines where a cache entry is stored
+    :param store_dir: directory of the stored entries
+    :param key:       key of the entry
+    :return:          file name of the entry
+    """
+    return os.path.join(store_dir, key[:2], key + '.npy')
+
+
+def link(entry, filename):
+    """
+    Points a file of the dmgr cache layout to a stored entry
+    :param entry:    file name of the entry
+    :param filename: file name in the dmgr cache layout
+    """
+    target = os.path.relpath(entry, os.path.dirname(filename))
+    if os.path.islink(filename) and os.readlink(filename) == target:
+        return
+
+    link_dir = os.path.dirname(filename)
+    if not os.path.exists(link_dir):
+        try:
+            os.makedirs(link_dir)
+        except OSError:
+            if not os.path.isdir(link_dir):
+                raise
+
+    # replace the file atomically, readers see either the old or new entry
+    tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+    os.symlink(target, tmp_file)
+    os.rename(tmp_file, filename)
+
+
+class Manifest(object):
+    """
+    Index of the cache entries of a dataset. It is read completely when
+    opened, so looking up entries does not touch the file system.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: manifest file
+        """
+        manifest_dir = os.path.dirname(filename)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            try:
+                os.makedirs(manifest_dir)
+            except OSError:
+                if not os.path.isdir(manifest_dir):
+                    raise
+
+        self.db = sqlite3.connect(filename, timeout=600)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources ('
+                        'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                        'hash TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'song TEXT, name TEXT, key TEXT, num_frames INTEGER, '
+                        'PRIMARY KEY (song, name))')
+        self.db.commit()
+
+        self._sources = {
+            path: (mtime, size, h) for path, mtime, size, h in
+            self.db.execute('SELECT path, mtime, size, hash FROM sources')
+        }
+        self._entries = {
+            (song, name): (key, num_frames) for song, name, key, num_frames in
+            self.db.execute('SELECT song, name, key, num_frames FROM entries')
+        }
+
+    def content_hash(self, filename):
+        """
+        Hash of a source file's content. The file is only hashed again if
+        its modification time or size changed.
+        :param filename: source file
+        :return:         hash value of the file content
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        known = self._sources.get(path)
+        if known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+            return known[2]
+
+        h = audio.content_hash(path)
+        self._sources[path] = (stat.st_mtime, stat.st_size, h)
+        self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                        (path, stat.st_mtime, stat.st_size, h))
+        return h
+
+    def get(self, song, name):
+        """
+        Looks up the current entry of a song
+        :param song: song name
+        :param name: name of the feature extractor or target computer
+        :return:     key and number of frames of the entry, or None
+        """
+        return self._entries.get((song, name))
+
+    def set(self, song, name, key, num_frames):
+        """
+        Sets the current entry of a song
+        :param song:       song name
+        :param name:       name of the feature extractor or target computer
+        :param key:        key of the entry
+        :param num_frames: number of frames of the entry
+        """
+        self._entries[(song, name)] = (key, num_frames)
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                        (song, name, key, num_frames))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
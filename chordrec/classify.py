@@ -2,18 +2,22 @@ from __future__ import print_function
 
 import os
 
+import lasagne as lnn
+import theano
 import yaml
 
 import data
 import dmgr
 import features
 import nn
+import shards
 import targets
 import test
 
 from nn.utils import Colors
 from models import dnn, avg_gap_feature, crf, rnn
-from experiment import TempDir, create_optimiser, setup, compute_features
+from experiment import (TempDir, create_optimiser, setup, compute_features,
+                        run_folds, close_iterators)
 
 # Initialise Sacred experiment
 ex = setup('Classify Chords')
@@ -53,7 +57,7 @@ def learn_rate_schedule():
 
 @ex.automain
 def main(_log, datasource, feature_extractor, target, model, optimiser,
-         training, regularisation, augmentation, testing):
+         training, regularisation, augmentation, testing, parallel_folds):
 
     err = False
     if model is None or not model or 'type' not in model:
@@ -88,105 +92,155 @@ def main(_log, datasource, feature_extractor, target, model, optimiser,
         _log.error(Colors.red('Need same number of validation and test folds'))
         return 1
 
-    all_pred_files = []
-    all_gt_files = []
+    # songs are loaded once and shared by all folds
+    session = data.DatasetSession(
+        dataset_names=datasource['datasets'],
+        preprocessors=datasource['preprocessors'],
+        compute_targets=target_computer,
+        context_size=datasource['context_size'],
+        cached=datasource['cached'],
+        memory_mapped=datasource['memory_mapped'],
+        num_workers=datasource['num_workers'],
+    )
 
-    print(Colors.magenta('\nStarting experiment ' + ex.observers[0].hash()))
+    def run_fold(exp_dir, test_fold, val_fold):
+        print('')
+        print(Colors.yellow(
+            '=' * 20 + ' FOLD {} '.format(test_fold) + '=' * 20))
+        artifacts = []
 
-    with TempDir() as exp_dir:
-        for test_fold, val_fold in zip(datasource['test_fold'],
-                                       datasource['val_fold']):
-            print('')
-            print(Colors.yellow(
-                '=' * 20 + ' FOLD {} '.format(test_fold) + '=' * 20))
-            # Load data sets
-            print(Colors.red('\nLoading data...\n'))
-
-            train_set, val_set, test_set, gt_files = data.create_datasources(
-                dataset_names=datasource['datasets'],
-                preprocessors=datasource['preprocessors'],
-                compute_features=features.create_extractor(feature_extractor,
-                                                           test_fold),
-                compute_targets=target_computer,
-                context_size=datasource['context_size'],
-                test_fold=test_fold,
-                val_fold=val_fold,
-                cached=datasource['cached'],
-            )
+        # Load data sets
+        print(Colors.red('\nLoading data...\n'))
 
-            if testing['test_on_val']:
-                test_set = val_set
-
-            print(Colors.blue('Train Set:'))
-            print('\t', train_set)
-            print(Colors.blue('Validation Set:'))
-            print('\t', val_set)
-            print(Colors.blue('Test Set:'))
-            print('\t', test_set)
-            print('')
-
-            # build network
-            print(Colors.red('Building network...\n'))
-
-            model_type = globals()[model['type']]
-            mdl = model_type.build_model(in_shape=train_set.dshape,
-                                         out_size=train_set.tshape[0],
-                                         model=model)
-
-            # mandatory parts of the model
-            neural_net = mdl['network']
-            input_var = mdl['input_var']
-            target_var = mdl['target_var']
-            loss_fn = mdl['loss_fn']
-
-            # optional parts
-            mask_var = mdl.get('mask_var')
-            feature_out = mdl.get('feature_out')
-
-            train_batches, validation_batches = model_type.create_iterators(
-                train_set, val_set, training, augmentation
-            )
-
-            opt, lrs = create_optimiser(optimiser)
+        train_set, val_set, test_set, gt_files = session.datasources(
+            features.create_extractor(feature_extractor, test_fold),
+            test_fold=test_fold, val_fold=val_fold
+        )
 
-            train_fn = nn.compile_train_fn(
-                neural_net, input_var, target_var,
-                loss_fn=loss_fn, opt_fn=opt, mask_var=mask_var,
-                **regularisation
-            )
+        if testing['test_on_val']:
+            test_set = val_set
+
+        print(Colors.blue('Train Set:'))
+        print('\t', train_set)
+        print(Colors.blue('Validation Set:'))
+        print('\t', val_set)
+        print(Colors.blue('Test Set:'))
+        print('\t', test_set)
+        print('')
+
+        # build network
+        print(Colors.red('Building network...\n'))
+
+        model_type = globals()[model['type']]
+        mdl = model_type.build_model(in_shape=train_set.dshape,
+                                     out_size=target_computer.num_classes,
+                                     model=model)
+
+        # mandatory parts of the model
+        neural_net = mdl['network']
+        input_var = mdl['input_var']
+        target_var = mdl['target_var']
+        loss_fn = mdl['loss_fn']
+
+        # optional parts
+        mask_var = mdl.get('mask_var')
+        feature_out = mdl.get('feature_out')
+        process_out = mdl.get('process_out')
+
+        # class id targets are kept compact and only expanded to one-hot
+        # vectors right before they are fed to the network
+        if getattr(target_computer, 'class_ids', False):
+            num_classes = target_computer.num_classes
+        else:
+            num_classes = None
+
+        train_batches, validation_batches = model_type.create_iterators(
+            train_set, val_set, training, augmentation, num_classes
+        )
 
-            test_fn = nn.compile_test_func(
-                neural_net, input_var, target_var,
-                loss_fn=loss_fn, mask_var=mask_var,
-                **regularisation
-            )
+        opt, lrs = create_optimiser(optimiser)
 
-            process_fn = nn.compile_process_func(
-                neural_net, input_var, mask_var=mask_var)
+        train_fn = nn.compile_train_fn(
+            neural_net, input_var, target_var,
+            loss_fn=loss_fn, opt_fn=opt, mask_var=mask_var,
+            **regularisation
+        )
 
-            if feature_out is not None:
-                feature_fn = nn.compile_process_func(
-                    feature_out, input_var, mask_var=mask_var
-                )
-            else:
-                feature_fn = None
+        test_fn = nn.compile_test_func(
+            neural_net, input_var, target_var,
+            loss_fn=loss_fn, mask_var=mask_var,
+            **regularisation
+        )
 
-            print(Colors.blue('Neural Network:'))
-            print(nn.to_string(neural_net))
-            print('')
+        process_fn = nn.compile_process_func(
+            neural_net, input_var, mask_var=mask_var)
 
-            if 'param_file' in training:
+        if feature_out is not None:
+            feature_fn = nn.compile_process_func(
+                feature_out, input_var, mask_var=mask_var
+            )
+        else:
+            feature_fn = None
+
+        if feature_out is not None and process_out is not None:
+            # features and predictions in one pass through the network
+            feature_process_fn = theano.function(
+                [input_var] + ([mask_var] if mask_var is not None else []),
+                [feature_out, process_out]
+            )
+        else:
+            feature_process_fn = None
+
+        # whole-song networks, for songs served as context windows
+        song_fn = None
+        song_feature_fn = None
+        song_feature_process_fn = None
+        if testing.get('fully_convolutional') and \
+                hasattr(model_type, 'fully_convolutional'):
+            try:
+                if feature_fn is not None and \
+                        hasattr(model_type, 'fully_convolutional_features'):
+                    song_feat, song_net, song_var = \
+                        model_type.fully_convolutional_features(neural_net)
+                    # a single function for features and predictions. the
+                    # layers after the feature layer cost little, so it
+                    # also computes the features of the other sets
+                    song_feature_process_fn = theano.function(
+                        [song_var], lnn.layers.get_output(
+                            [song_feat, song_net], deterministic=True))
+                    song_feature_fn = \
+                        lambda song: song_feature_process_fn(song)[0]
+                    if feature_process_fn is None:
+                        song_fn = \
+                            lambda song: song_feature_process_fn(song)[1]
+                elif feature_process_fn is None:
+                    # (otherwise, the test set is labelled with the
+                    # predictions computed along with its features)
+                    song_net, song_var = model_type.fully_convolutional(
+                        neural_net)
+                    song_fn = nn.compile_process_func(song_net, song_var)
+            except ValueError as e:
+                print(Colors.yellow('Cannot process whole songs at once, '
+                                    'falling back to context windows: '
+                                    '{}\n'.format(e)))
+
+        print(Colors.blue('Neural Network:'))
+        print(nn.to_string(neural_net))
+        print('')
+
+        if 'param_file' in training:
+            nn.load_params(neural_net,
+                           training['param_file'].format(test_fold))
+            train_losses = []
+            val_losses = []
+            val_accs = []
+        else:
+            if 'init_file' in training:
+                print('initialising')
                 nn.load_params(neural_net,
-                               training['param_file'].format(test_fold))
-                train_losses = []
-                val_losses = []
-                val_accs = []
-            else:
-                if 'init_file' in training:
-                    print('initialising')
-                    nn.load_params(neural_net,
-                                   training['init_file'].format(test_fold))
-                print(Colors.red('Starting training...\n'))
+                               training['init_file'].format(test_fold))
+            print(Colors.red('Starting training...\n'))
+            try:
                 train_losses, val_losses, _, val_accs = nn.train(
                     network=neural_net,
                     train_fn=train_fn, train_batches=train_batches,
@@ -196,58 +250,90 @@ def main(_log, datasource, feature_extractor, target, model, optimiser,
                     early_stop=training['early_stop'],
                     early_stop_acc=training['early_stop_acc']
                 )
-                param_file = os.path.join(
-                    exp_dir, 'params_fold_{}.pkl'.format(test_fold))
-                nn.save_params(neural_net, param_file)
-                ex.add_artifact(param_file)
-
-            print(Colors.red('\nStarting testing...\n'))
-
-            if feature_fn is not None:
-                dest_dir = os.path.join(exp_dir,
-                                        'features_fold_{}'.format(test_fold))
+            finally:
+                close_iterators(train_batches, validation_batches)
+            param_file = os.path.join(
+                exp_dir, 'params_fold_{}.pkl'.format(test_fold))
+            nn.save_params(neural_net, param_file)
+            artifacts.append(param_file)
+
+        print(Colors.red('\nStarting testing...\n'))
+
+        test_outputs = None
+
+        if feature_fn is not None:
+            dest_dir = os.path.join(exp_dir,
+                                    'features_fold_{}'.format(test_fold))
+            # optionally store the features of all songs in one shard
+            shard = (shards.ShardWriter(dest_dir)
+                     if testing.get('feature_shards') else None)
+            for ds in [train_set, val_set, test_set]:
+                if ds is test_set and feature_process_fn is not None:
+                    # keep the predictions to label the test set. when
+                    # testing on the validation set, we stop there
+                    test_outputs = {}
+                    compute_features(
+                        feature_process_fn, ds,
+                        batch_size=testing['batch_size'],
+                        dest_dir=dest_dir, extension='.features.npy',
+                        use_mask=mask_var is not None, shard=shard,
+                        max_frames=testing.get('max_frames'),
+                        outputs=test_outputs,
+                        song_fn=song_feature_process_fn)
+                    break
                 compute_features(
-                    feature_fn, train_set, batch_size=testing['batch_size'],
+                    feature_fn, ds, batch_size=testing['batch_size'],
                     dest_dir=dest_dir, extension='.features.npy',
-                    use_mask=mask_var is not None)
-                compute_features(
-                    feature_fn, val_set, batch_size=testing['batch_size'],
-                    dest_dir=dest_dir, extension='.features.npy',
-                    use_mask=mask_var is not None)
-                compute_features(
-                    feature_fn, test_set, batch_size=testing['batch_size'],
-                    dest_dir=dest_dir, extension='.features.npy',
-                    use_mask=mask_var is not None)
-                ex.add_artifact(dest_dir)
+                    use_mask=mask_var is not None, shard=shard,
+                    max_frames=testing.get('max_frames'),
+                    song_fn=song_feature_fn)
+            if shard is not None:
+                shard.close()
+                artifacts += shard.files
+            else:
+                artifacts.append(dest_dir)
 
-            pred_files = test.compute_labeling(
-                process_fn, target_computer, test_set, dest_dir=exp_dir,
-                use_mask=mask_var is not None, batch_size=testing['batch_size']
-            )
+        pred_files = test.compute_labeling(
+            process_fn, target_computer, test_set, dest_dir=exp_dir,
+            use_mask=mask_var is not None, batch_size=testing['batch_size'],
+            max_frames=testing.get('max_frames'), song_fn=song_fn,
+            outputs=test_outputs
+        )
 
-            test_gt_files = dmgr.files.match_files(
-                pred_files, test.PREDICTION_EXT, gt_files, data.GT_EXT
-            )
+        test_gt_files = dmgr.files.match_files(
+            pred_files, test.PREDICTION_EXT, gt_files, data.GT_EXT
+        )
 
-            all_pred_files += pred_files
-            all_gt_files += test_gt_files
+        print(Colors.blue('Results:'))
+        scores = test.compute_average_scores(test_gt_files, pred_files)
+        test.print_scores(scores)
+        result_file = os.path.join(
+            exp_dir, 'results_fold_{}.yaml'.format(test_fold))
+        yaml.dump(dict(scores=scores,
+                       train_losses=map(float, train_losses),
+                       val_losses=map(float, val_losses),
+                       val_accs=map(float, val_accs)),
+                  open(result_file, 'w'))
+        artifacts.append(result_file)
 
-            print(Colors.blue('Results:'))
-            scores = test.compute_average_scores(test_gt_files, pred_files)
-            test.print_scores(scores)
-            result_file = os.path.join(
-                exp_dir, 'results_fold_{}.yaml'.format(test_fold))
-            yaml.dump(dict(scores=scores,
-                           train_losses=map(float, train_losses),
-                           val_losses=map(float, val_losses),
-                           val_accs=map(float, val_accs)),
-                      open(result_file, 'w'))
-            ex.add_artifact(result_file)
+        return pred_files, test_gt_files, artifacts
+
+    all_pred_files = []
+    all_gt_files = []
+
+    print(Colors.magenta('\nStarting experiment ' + ex.observers[0].hash()))
+
+    with TempDir() as exp_dir:
+        folds = [(exp_dir, test_fold, val_fold)
+                 for test_fold, val_fold in zip(datasource['test_fold'],
+                                                datasource['val_fold'])]
 
-            # delete datasets so disk space is free
-            del train_set
-            del val_set
-            del test_set
+        for pred_files, test_gt_files, artifacts in run_folds(
+                run_fold, folds, **parallel_folds):
+            all_pred_files += pred_files
+            all_gt_files += test_gt_files
+            for a in artifacts:
+                ex.add_artifact(a)
 
         # if there is something to aggregate
         if len(datasource['test_fold']) > 1:
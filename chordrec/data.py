@@ -1,11 +1,23 @@
+from __future__ import print_function
 from operator import eq
 import os
+import copy
+import time
+import tempfile
+import multiprocessing
+import numpy as np
 import dmgr
 
+import cache
+import datasources
+import shards
+
 DATA_DIR = 'data'
 CACHE_DIR = 'feature_cache'
 SRC_EXT = '.flac'
 GT_EXT = '.chords'
+FEAT_EXT = '.features.npy'
+TARG_EXT = '.targets.npy'
 
 
 def combine_files(*args):
@@ -59,11 +71,252 @@ DATASET_DEFS = {
 }
 
 
+def save_atomic(filename, array):
+    """
+    Saves an array such that readers never see a partially written file
+    :param filename: file to save the array to
+    :param array:    array to save
+    """
+    dest_dir = os.path.dirname(filename)
+    if dest_dir and not os.path.exists(dest_dir):
+        try:
+            os.makedirs(dest_dir)
+        except OSError:
+            # another worker might have created it in the meantime
+            if not os.path.isdir(dest_dir):
+                raise
+
+    with tempfile.NamedTemporaryFile(dir=dest_dir, suffix='.tmp',
+                                     delete=False) as f:
+        np.save(f, array)
+    os.rename(f.name, filename)
+
+
+def cache_file(cache_dir, name, src_file, ext):
+    """
+    Determines where the cached result of an extractor is stored
+    :param cache_dir: feature cache directory of the dataset
+    :param name:      name of the feature extractor or target computer
+    :param src_file:  source (audio or annotation) file
+    :param ext:       extension of the cache file
+    :return:          cache file name
+    """
+    song = os.path.splitext(os.path.basename(src_file))[0]
+    return os.path.join(cache_dir, name, song + ext)
+
+
+def feature_names(compute_features):
+    """
+    Names of the features computed by a feature extractor. Extractors that
+    compute several features at once (e.g. features.MultiFeature) define
+    a list of names.
+    :param compute_features: feature extractor
+    :return:                 list of feature names
+    """
+    if hasattr(compute_features, 'names'):
+        return compute_features.names
+    return [compute_features.name]
+
+
+def extractors(compute_features):
+    """
+    Single feature extractors of a feature extractor. Extractors that compute
+    several features at once (e.g. features.MultiFeature) define a list of
+    extractors.
+    :param compute_features: feature extractor
+    :return:                 list of feature extractors
+    """
+    return getattr(compute_features, 'extractors', [compute_features])
+
+
+# extractors of the worker processes. they are set by the pool initialiser,
+# so they do not need to be pickled for each job
+_worker_extractors = None
+
+
+def _init_worker(compute_features, compute_targets):
+    global _worker_extractors
+    _worker_extractors = (compute_features, compute_targets)
+
+
+def _extract(job):
+    (song, src_file, gt_file, feat_entries, num_frames, targ_deps,
+     store_dir) = job
+    compute_features, compute_targets = _worker_extractors
+
+    if feat_entries is not None:
+        feats = compute_features(src_file)
+        if not hasattr(compute_features, 'names'):
+            feats = [feats]
+        for f, entry in zip(feats, feat_entries):
+            save_atomic(entry, f)
+        num_frames = len(feats[0])
+
+    # targets depend on the number of frames of the features
+    targ_key = cache.entry_key(*(targ_deps + (num_frames,)))
+    targ_entry = cache.entry_file(store_dir, targ_key)
+    if not os.path.exists(targ_entry):
+        save_atomic(targ_entry, compute_targets(gt_file, num_frames))
+
+    return song, num_frames, targ_key
+
+
+def _precomputed(feat_file):
+    # features computed elsewhere might only be available in a shard. dmgr
+    # needs the per-song file, so we extract it. it gets the shard's
+    # modification time, so the data sources still read from the shard
+    if not os.path.exists(feat_file):
+        song, data_file = shards.shard_file(feat_file, FEAT_EXT)
+        shard = shards.open_shard(data_file)
+        if shard is not None and song in shard:
+            save_atomic(feat_file, shard[song])
+            os.utime(feat_file, (shard.mtime, shard.mtime))
+    return np.load(feat_file, mmap_mode='r')
+
+
+def precompute(name, data_dir, feature_cache_dir,
+               compute_features, compute_targets, num_workers=1):
+    """
+    Computes features and targets of all files of a dataset whose cache
+    entries are missing or outdated, i.e. the source file or the extractor
+    parameters changed. See the cache module for how entries are stored.
+    :param name:              dataset name
+    :param data_dir:          base data directory
+    :param feature_cache_dir: base feature cache directory
+    :param compute_features:  feature extractor. if it computes several
+                              features, each is cached under its own name
+    :param compute_targets:   target computer
+    :param num_workers:       number of worker processes
+    :return:                  number of computed files
+    """
+    data_dir = os.path.join(data_dir, DATASET_DEFS[name]['data_dir'])
+    cache_dir = os.path.join(feature_cache_dir, name)
+    store_dir = os.path.join(feature_cache_dir, cache.STORE_DIR)
+
+    src_files = sorted(dmgr.files.find(data_dir, '*' + SRC_EXT))
+    gt_files = dmgr.files.match_files(
+        src_files, SRC_EXT, list(dmgr.files.find(data_dir, '*' + GT_EXT)),
+        GT_EXT
+    )
+
+    manifest = cache.Manifest(os.path.join(cache_dir, cache.MANIFEST_FILE))
+
+    feat_names = feature_names(compute_features)
+    feat_params = [cache.param_hash(e) for e in extractors(compute_features)]
+    targ_params = cache.param_hash(compute_targets)
+    # precomputed features are not managed by the cache
+    precomputed = getattr(compute_features, 'precomputed', False)
+
+    def current(song, entry_name, key):
+        # number of frames of an up-to-date entry, or None
+        entry = manifest.get(song, entry_name)
+        entry_file = cache.entry_file(store_dir, key)
+        if not os.path.exists(entry_file):
+            return None
+        if entry is None or entry[0] != key:
+            # stored before, e.g. for another dataset or earlier parameters
+            num_frames = len(np.load(entry_file, mmap_mode='r'))
+            manifest.set(song, entry_name, key, num_frames)
+            return num_frames
+        return entry[1]
+
+    def link(src_file, entry_name, key, ext):
+        cache.link(cache.entry_file(store_dir, key),
+                   cache_file(cache_dir, entry_name, src_file, ext))
+
+    jobs = []
+    feat_keys = {}
+    for src_file, gt_file in zip(src_files, gt_files):
+        song = os.path.splitext(os.path.basename(src_file))[0]
+        targ_deps = (manifest.content_hash(gt_file), targ_params)
+
+        if precomputed:
+            num_frames = len(_precomputed(
+                cache_file(cache_dir, feat_names[0], src_file, FEAT_EXT)))
+            feat_entries = None
+        else:
+            src_hash = manifest.content_hash(src_file)
+            feat_keys[song] = [cache.entry_key(src_hash, p)
+                               for p in feat_params]
+            frames = [current(song, n, k)
+                      for n, k in zip(feat_names, feat_keys[song])]
+
+            if all(f is not None for f in frames):
+                num_frames = frames[0]
+                feat_entries = None
+            else:
+                num_frames = None
+                feat_entries = [cache.entry_file(store_dir, k)
+                                for k in feat_keys[song]]
+
+        if feat_entries is None:
+            targ_key = cache.entry_key(*(targ_deps + (num_frames,)))
+            if current(song, compute_targets.name, targ_key) is not None:
+                # everything is up to date, just make sure dmgr finds it
+                if not precomputed:
+                    for n, k in zip(feat_names, feat_keys[song]):
+                        link(src_file, n, k, FEAT_EXT)
+                link(src_file, compute_targets.name, targ_key, TARG_EXT)
+                continue
+
+        jobs.append((song, src_file, gt_file, feat_entries, num_frames,
+                     targ_deps, store_dir))
+
+    manifest.commit()
+
+    if len(jobs) == 0:
+        manifest.close()
+        return 0
+
+    print('Computing {} files of {} using {} processes...'.format(
+        len(jobs), name, num_workers))
+
+    src_of_song = {job[0]: job[1] for job in jobs}
+
+    start = time.time()
+    if num_workers > 1:
+        pool = multiprocessing.Pool(
+            num_workers, initializer=_init_worker,
+            initargs=(compute_features, compute_targets))
+        results = pool.imap_unordered(_extract, jobs)
+    else:
+        pool = None
+        _init_worker(compute_features, compute_targets)
+        results = (_extract(job) for job in jobs)
+
+    try:
+        for song, num_frames, targ_key in results:
+            src_file = src_of_song[song]
+            if not precomputed:
+                for n, k in zip(feat_names, feat_keys[song]):
+                    manifest.set(song, n, k, num_frames)
+                    link(src_file, n, k, FEAT_EXT)
+            manifest.set(song, compute_targets.name, targ_key, num_frames)
+            link(src_file, compute_targets.name, targ_key, TARG_EXT)
+            manifest.commit()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        manifest.close()
+    duration = time.time() - start
+
+    print('Computed {} files in {:.1f}s ({:.2f} files/s)'.format(
+        len(jobs), duration, len(jobs) / duration))
+
+    return len(jobs)
+
+
 def load_dataset(name, data_dir, feature_cache_dir,
-                 compute_features, compute_targets):
+                 compute_features, compute_targets, num_workers=1):
 
     assert name in DATASET_DEFS.keys(), 'Unknown dataset {}'.format(name)
 
+    # bring the cache up to date, the dataset will then find all features
+    # and targets already computed
+    precompute(name, data_dir, feature_cache_dir,
+               compute_features, compute_targets, num_workers)
+
     data_dir = os.path.join(data_dir, DATASET_DEFS[name]['data_dir'])
     split_filename = os.path.join(data_dir, 'splits',
                                   DATASET_DEFS[name]['split_filename'])
@@ -87,52 +340,193 @@ def create_preprocessors(preproc_defs):
     return preprocessors
 
 
-def create_datasources(dataset_names, preprocessors,
-                       compute_features, compute_targets, context_size,
-                       data_dir=DATA_DIR, feature_cache_dir=CACHE_DIR,
-                       test_fold=0, val_fold=None,
-                       **kwargs):
+class DatasetSession(object):
+    """
+    Loads the songs of a set of datasets once and creates the train,
+    validation and test sets of any fold as views of the loaded songs. The
+    data of a song is loaded when a fold first needs it and then shared by
+    all folds that use the same feature extractor. Switching to another
+    feature extractor releases the songs of the previous one.
+    """
 
-    if test_fold is not None and val_fold is None:
-        val_fold = test_fold - 1
+    def __init__(self, dataset_names, preprocessors, compute_targets,
+                 context_size, data_dir=DATA_DIR, feature_cache_dir=CACHE_DIR,
+                 num_workers=1, cached=True, memory_mapped=True, **kwargs):
+        """
+        :param dataset_names:     names of the datasets to use
+        :param preprocessors:     preprocessor definitions. preprocessors are
+                                  fit to the training set of each fold, so
+                                  the data cannot be shared between folds
+                                  if there are any
+        :param compute_targets:   target computer
+        :param context_size:      number of context frames on each side
+        :param data_dir:          base data directory
+        :param feature_cache_dir: base feature cache directory
+        :param num_workers:       number of processes to fill the cache
+        :param cached:            cache preprocessed data
+        :param memory_mapped:     open the cached features and targets
+                                  read-only memory-mapped instead of loading
+                                  them into memory. the operating system then
+                                  shares their pages between processes.
+                                  preprocessed data is always loaded
+        :param kwargs:            additional arguments for the data sources
+        """
+        self.dataset_names = dataset_names
+        self.preprocessors = preprocessors
+        self.compute_targets = compute_targets
+        self.data_dir = data_dir
+        self.feature_cache_dir = feature_cache_dir
+        self.num_workers = num_workers
+        self.cached = cached
+        self.memory_mapped = memory_mapped
+        self.context_size = context_size
 
-    preprocessors = create_preprocessors(preprocessors)
+        if context_size > 0:
+            # only used for preprocessed data, all other songs are served
+            # as datasources.ContextWindowDataSource
+            self.data_source_type = dmgr.datasources.ContextDataSource
+            kwargs['context_size'] = context_size
+        else:
+            self.data_source_type = dmgr.datasources.DataSource
+        self.kwargs = kwargs
 
-    if context_size > 0:
-        data_source_type = dmgr.datasources.ContextDataSource
-        kwargs['context_size'] = context_size
-    else:
-        data_source_type = dmgr.datasources.DataSource
+        self._datasets = {}
+        self._songs = {}
+        # features of the songs, shared with sessions for other targets
+        self._features = {}
 
-    # load all datasets
-    datasets = [load_dataset(name, data_dir, feature_cache_dir,
-                             compute_features, compute_targets)
-                for name in dataset_names]
+    def datasets(self, compute_features):
+        """
+        Loads the datasets for a feature extractor
+        :param compute_features: feature extractor
+        :return:                 list of dmgr.Dataset
+        """
+        key = tuple(feature_names(compute_features))
+        if key not in self._datasets:
+            self._evict()
+            self._datasets[key] = [
+                load_dataset(name, self.data_dir, self.feature_cache_dir,
+                             compute_features, self.compute_targets,
+                             self.num_workers)
+                for name in self.dataset_names
+            ]
+        return self._datasets[key]
 
-    if test_fold is not None:
-        files = combine_files(*[ds.fold_split(val_fold, test_fold)
-                                for ds in datasets])
-    else:
-        # times three such that train, validation and test set are the same
-        files = combine_files(*[[ds.all_files()]
-                                for ds in datasets])
+    def retarget(self, compute_targets):
+        """
+        Creates a session for another target computer. It shares the
+        features of all songs with this session, so they are only loaded
+        once for both.
+        :param compute_targets: target computer
+        :return:                DatasetSession
+        """
+        session = copy.copy(self)
+        session.compute_targets = compute_targets
+        session._datasets = {}
+        session._songs = {}
+        return session
 
-    ds = dmgr.datasources.get_datasources(
-        files, preprocessors=preprocessors, data_source_type=data_source_type,
-        **kwargs
-    )
+    def _evict(self):
+        # only the views of the current feature extractor are kept. folds
+        # can use different extractors (e.g. networks trained for the test
+        # fold), whose songs are not needed by later folds
+        for feat_file, _ in self._songs:
+            self._features.pop(feat_file, None)
+        self._datasets.clear()
+        self._songs.clear()
 
-    if len(ds) == 3:
-        train, val, test = ds
-    elif len(ds) == 1:
-        train = ds[0]
-        val = ds[0]
-        test = ds[0]
-    else:
-        raise RuntimeError('Got {} datasources,'
-                           ' expected 1 or 3.'.format(len(ds)))
+    def _load(self, filename, ext):
+        # songs stored in shards are views into the shard's memory map
+        data = shards.lookup(filename, ext)
+        if data is None:
+            data = np.load(filename, mmap_mode='r')
+        if not self.memory_mapped:
+            data = np.array(data)
+        return data
+
+    def _view(self, split):
+        if self.context_size > 0:
+            # context windows are views into the songs, not copies
+            song_type = datasources.ContextWindowDataSource
+            aggregate_type = datasources.AggregatedContextWindows
+        else:
+            song_type = self.data_source_type
+            aggregate_type = dmgr.datasources.AggregatedDataSource
+
+        for feat_file, targ_file in zip(split['feat'], split['targ']):
+            if (feat_file, targ_file) in self._songs:
+                continue
+            if feat_file not in self._features:
+                self._features[feat_file] = self._load(feat_file, FEAT_EXT)
+            self._songs[(feat_file, targ_file)] = song_type(
+                self._features[feat_file], self._load(targ_file, TARG_EXT),
+                name=shards.shard_file(feat_file, FEAT_EXT)[0],
+                **self.kwargs)
+
+        return aggregate_type(
+            [self._songs[song] for song in zip(split['feat'], split['targ'])]
+        )
+
+    def datasources(self, compute_features, test_fold=0, val_fold=None):
+        """
+        Creates the data sources of a fold
+        :param compute_features: feature extractor
+        :param test_fold:        test fold. if None, train, validation and
+                                 test set contain all songs
+        :param val_fold:         validation fold. if None, the fold before
+                                 the test fold is used
+        :return:                 train, validation and test set, and the
+                                 ground truth files of all songs
+        """
+        if test_fold is not None and val_fold is None:
+            val_fold = test_fold - 1
+
+        datasets = self.datasets(compute_features)
+
+        if test_fold is not None:
+            files = combine_files(*[ds.fold_split(val_fold, test_fold)
+                                    for ds in datasets])
+        else:
+            # times three such that train, validation and test set are the same
+            files = combine_files(*[[ds.all_files()]
+                                    for ds in datasets])
 
-    return train, val, test, sum((ds.gt_files for ds in datasets), [])
+        if self.preprocessors:
+            ds = dmgr.datasources.get_datasources(
+                files, preprocessors=create_preprocessors(self.preprocessors),
+                data_source_type=self.data_source_type, cached=self.cached,
+                **self.kwargs
+            )
+        else:
+            ds = [self._view(split) for split in files]
+
+        if len(ds) == 3:
+            train, val, test = ds
+        elif len(ds) == 1:
+            train = ds[0]
+            val = ds[0]
+            test = ds[0]
+        else:
+            raise RuntimeError('Got {} datasources,'
+                               ' expected 1 or 3.'.format(len(ds)))
+
+        return train, val, test, sum((ds.gt_files for ds in datasets), [])
+
+
+def create_datasources(dataset_names, preprocessors,
+                       compute_features, compute_targets, context_size,
+                       data_dir=DATA_DIR, feature_cache_dir=CACHE_DIR,
+                       test_fold=0, val_fold=None, num_workers=1,
+                       **kwargs):
+    """
+    Creates the data sources of a single fold. Use a DatasetSession to
+    create the data sources of several folds.
+    """
+    session = DatasetSession(dataset_names, preprocessors, compute_targets,
+                             context_size, data_dir=data_dir,
+                             feature_cache_dir=feature_cache_dir,
+                             num_workers=num_workers, **kwargs)
+    return session.datasources(compute_features, test_fold, val_fold)
 
 
 def add_sacred_config(ex):
@@ -145,6 +539,10 @@ def add_sacred_config(ex):
             # with the total score
             test_fold=6,
             val_fold=None,
-            cached=True
+            cached=True,
+            # number of processes used to fill the feature cache
+            num_workers=1,
+            # open cached features read-only memory-mapped
+            memory_mapped=True
         )
     )
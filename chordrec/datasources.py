@@ -0,0 +1,186 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class ContextWindowDataSource(object):
+
+    def __init__(self, data, targets, context_size, name=None):
+        """
+        Serves each frame of a song together with its context frames. The
+        windows are strided views into the song's data, which is neither
+        padded nor copied (and may be memory-mapped). Frames outside the
+        song are zero.
+        :param data:         data of the song (frames along the first axis)
+        :param targets:      targets of the song
+        :param context_size: number of context frames on each side
+        :param name:         name of the song
+        """
+        self.data = data
+        self.targets = targets
+        self.context_size = context_size
+        self.name = name
+
+        window_size = 2 * context_size + 1
+        num_windows = max(len(data) - window_size + 1, 0)
+        # windows[i] is the window centred at frame i + context_size
+        self.windows = as_strided(
+            data, shape=(num_windows, window_size) + data.shape[1:],
+            strides=(data.strides[0],) + data.strides
+        )
+
+    @classmethod
+    def from_files(cls, data_file, target_file, context_size,
+                   memory_mapped=False, name=None):
+        mmap_mode = 'r' if memory_mapped else None
+        return cls(np.load(data_file, mmap_mode=mmap_mode),
+                   np.load(target_file, mmap_mode=mmap_mode),
+                   context_size, name=name)
+
+    @property
+    def n_data(self):
+        return len(self.data)
+
+    def __len__(self):
+        return self.n_data
+
+    @property
+    def dshape(self):
+        return (2 * self.context_size + 1,) + self.data.shape[1:]
+
+    @property
+    def tshape(self):
+        return self.targets.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def ttype(self):
+        return self.targets.dtype
+
+    def gather(self, idxs, out=None):
+        """
+        Copies the windows centred at the given frames into a batch
+        :param idxs: frame indices
+        :param out:  array to copy the windows into. if None, a new array
+                     is allocated
+        :return:     windows, shape (len(idxs),) + dshape
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if out is None:
+            out = np.empty((len(idxs),) + self.dshape, dtype=self.dtype)
+
+        c = self.context_size
+        n = self.n_data
+        if len(self.windows) > 0:
+            # clipping moves windows at the borders of the song inwards, we
+            # fix these below. (np.take would first copy all windows of the
+            # song into a contiguous array)
+            out[...] = self.windows[np.clip(idxs - c, 0,
+                                            len(self.windows) - 1)]
+
+        for i in np.flatnonzero((idxs < c) | (idxs >= n - c)):
+            start = idxs[i] - c
+            stop = idxs[i] + c + 1
+            out[i] = 0
+            out[i, max(-start, 0):out.shape[1] - max(stop - n, 0)] = \
+                self.data[max(start, 0):min(stop, n)]
+
+        return out
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.gather([item])[0], self.targets[item]
+        idxs = np.arange(self.n_data)[item]
+        return self.gather(idxs), self.targets[idxs]
+
+    def __str__(self):
+        return '{}: N={}  dshape={}  tshape={}'.format(
+            self.name, self.n_data, self.dshape, self.tshape)
+
+
+class AggregatedContextWindows(object):
+
+    def __init__(self, datasources):
+        """
+        Combines the context window data sources of several songs. Batches
+        are gathered from the songs directly into a preallocated batch
+        array, one for each batch size. The arrays are reused, so a batch
+        returned by indexing with a slice or an index array is overwritten
+        by the next batch of the same size; copy it to keep it longer.
+        :param datasources: list of ContextWindowDataSource
+        """
+        self._datasources = datasources
+        self._starts = np.cumsum([0] + [ds.n_data for ds in datasources])
+        self._buffers = {}
+
+    @property
+    def n_datasources(self):
+        return len(self._datasources)
+
+    def datasource(self, idx):
+        return self._datasources[idx]
+
+    @property
+    def n_data(self):
+        return int(self._starts[-1])
+
+    def __len__(self):
+        return self.n_data
+
+    @property
+    def dshape(self):
+        return self._datasources[0].dshape
+
+    @property
+    def tshape(self):
+        return self._datasources[0].tshape
+
+    @property
+    def dtype(self):
+        return self._datasources[0].dtype
+
+    @property
+    def ttype(self):
+        return self._datasources[0].ttype
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            item = item if item >= 0 else self.n_data + item
+            ds_idx = np.searchsorted(self._starts, item, side='right') - 1
+            return self._datasources[ds_idx][item - self._starts[ds_idx]]
+
+        idxs = np.arange(self.n_data)[item]
+        if len(idxs) not in self._buffers:
+            self._buffers[len(idxs)] = (
+                np.empty((len(idxs),) + self.dshape, dtype=self.dtype),
+                np.empty((len(idxs),) + self.tshape, dtype=self.ttype)
+            )
+        data, targets = self._buffers[len(idxs)]
+
+        # group the batch by song
+        ds_idxs = np.searchsorted(self._starts, idxs, side='right') - 1
+        order = np.argsort(ds_idxs, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(ds_idxs[order])) + 1
+
+        for pos in np.split(order, bounds):
+            if len(pos) == 0:
+                continue
+            ds_idx = ds_idxs[pos[0]]
+            ds = self._datasources[ds_idx]
+            local = idxs[pos] - self._starts[ds_idx]
+            if pos[-1] - pos[0] + 1 == len(pos):
+                # consecutive batch elements, gather in place
+                ds.gather(local, out=data[pos[0]:pos[-1] + 1])
+                np.take(ds.targets, local, axis=0, mode='clip',
+                        out=targets[pos[0]:pos[-1] + 1])
+            else:
+                data[pos] = ds.gather(local)
+                targets[pos] = ds.targets[local]
+
+        return data, targets
+
+    def __str__(self):
+        return '{} datasources: N={}  dshape={}  tshape={}'.format(
+            self.n_datasources, self.n_data, self.dshape, self.tshape)
@@ -6,6 +6,10 @@ import shutil
 import hashlib
 import tempfile
 import sys
+import ctypes
+import traceback
+import multiprocessing
+import Queue
 from functools import partial
 from sacred import Experiment
 from sacred.observers import RunObserver
@@ -21,6 +25,8 @@ import data
 import features
 import targets
 import augmenters
+import iterators
+from datasources import ContextWindowDataSource
 
 
 class TempDir:
@@ -36,40 +42,205 @@ class TempDir:
 
 
 def compute_features(process_fn, agg_dataset, dest_dir, use_mask,
-                     batch_size, extension):
-    if not os.path.exists(dest_dir):
-        os.makedirs(dest_dir)
-    else:
-        if not os.path.isdir(dest_dir):
-            print(Colors.red('Destination path exists but is not a directory!'),
-                  file=sys.stderr)
-            return
+                     batch_size, extension, shard=None, max_frames=None,
+                     outputs=None, song_fn=None):
+    """
+    Computes features for all songs of a data source
+    :param process_fn:  function computing the features
+    :param agg_dataset: aggregated data source
+    :param dest_dir:    directory to store the features of each song to
+    :param use_mask:    process_fn expects a mask (recurrent models)
+    :param batch_size:  batch size (None: whole songs)
+    :param extension:   extension of the feature files
+    :param shard:       if given, a shards.ShardWriter the features are added
+                        to instead of writing one file per song
+    :param max_frames:  if process_fn expects a mask, process several songs
+                        at once in padded batches of at most this many frames
+    :param outputs:     if given, process_fn computes the features and the
+                        network output in one pass. the output of each song
+                        is stored in this dictionary under the song's index
+    :param song_fn:     if given, function computing the features (and the
+                        network output, like process_fn) for all frames of
+                        a song at once. used instead of process_fn for songs
+                        served as context windows
+    :return:            list of feature files
+    """
+    if shard is None:
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        else:
+            if not os.path.isdir(dest_dir):
+                print(Colors.red('Destination path exists but is not a '
+                                 'directory!'), file=sys.stderr)
+                return
 
     iterate_batches = dmgr.iterators.iterate_batches
 
-    feature_files = []
+    feature_files = [None] * agg_dataset.n_datasources
+
+    def process(fn, *args):
+        if outputs is None:
+            return fn(*args), None
+        return fn(*args)
 
-    for ds_idx in range(agg_dataset.n_datasources):
+    def save(ds_idx, feats, out):
         ds = agg_dataset.datasource(ds_idx)
+        if shard is not None:
+            shard.add(ds.name, feats)
+        else:
+            feat_file = os.path.join(dest_dir, ds.name + extension)
+            np.save(feat_file, feats)
+            feature_files[ds_idx] = feat_file
+        if outputs is not None:
+            outputs[ds_idx] = out
+
+    # e.g. when testing on the validation set, the shard already contains
+    # some of the songs
+    ds_idxs = [i for i in range(agg_dataset.n_datasources)
+               if shard is None or
+               agg_dataset.datasource(i).name not in shard.index]
+
+    if use_mask and max_frames:
+        for batch_idxs, data, mask in iterators.iterate_songs(
+                agg_dataset, max_frames, ds_idxs):
+            f, o = process(process_fn, data, mask)
+            for j, ds_idx in enumerate(batch_idxs):
+                n = int(mask[j].sum())
+                save(ds_idx, f[j, :n], None if o is None else o[j, :n])
+
+        return feature_files if shard is None else shard.files
+
+    for ds_idx in ds_idxs:
+        ds = agg_dataset.datasource(ds_idx)
+
+        if song_fn is not None and isinstance(ds, ContextWindowDataSource):
+            save(ds_idx, *process(song_fn, ds.data))
+            continue
 
         feats = []
+        outs = []
         for data, _ in iterate_batches(ds, batch_size or ds.n_data,
                                        randomise=False, expand=False):
             if use_mask:
                 data = data[np.newaxis, :]
                 mask = np.ones(data.shape[:2], dtype=np.float32)
 
-                f = process_fn(data, mask)[0]
+                f, o = process(process_fn, data, mask)
+                f = f[0]
+                o = None if o is None else o[0]
             else:
-                f = process_fn(data)
+                f, o = process(process_fn, data)
             feats.append(f)
+            outs.append(o)
+
+        save(ds_idx, np.concatenate(feats),
+             None if outputs is None else np.concatenate(outs))
 
-        feats = np.concatenate(feats)
-        feat_file = os.path.join(dest_dir, ds.name + extension)
-        np.save(feat_file, feats)
-        feature_files.append(feat_file)
+    return feature_files if shard is None else shard.files
 
-    return feature_files
+
+def limit_threads(num_threads):
+    """
+    Limits the number of threads the numerical libraries use in this process.
+    Libraries loaded later read the environment variables, libraries
+    already loaded are limited through their API (if their symbols can be
+    found).
+    :param num_threads: maximum number of threads
+    """
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+
+    process = ctypes.CDLL(None)
+    for fn in ['omp_set_num_threads', 'mkl_set_num_threads',
+               'openblas_set_num_threads']:
+        try:
+            getattr(process, fn)(ctypes.c_int(num_threads))
+        except AttributeError:
+            pass
+
+
+def _run_fold(fold_fn, fold_idx, fold, num_threads, results):
+    # runs in a forked process, so fold_fn can be a closure over the
+    # experiment configuration
+    try:
+        if num_threads:
+            limit_threads(num_threads)
+        results.put((fold_idx, fold_fn(*fold), None))
+    except Exception:
+        results.put((fold_idx, None, traceback.format_exc()))
+
+
+def run_folds(fold_fn, folds, num_workers=1, num_threads=None):
+    """
+    Runs the folds of a cross-validation, optionally in parallel. Each fold
+    runs in a fresh worker process, so only use this if Theano computes on
+    the CPU. The worker processes are not daemonic, so folds can start
+    processes of their own (e.g. to compute features or prefetch batches).
+    :param fold_fn:     function running a single fold. it must return
+                        results that can be pickled (e.g. file names)
+    :param folds:       list of argument tuples for fold_fn
+    :param num_workers: number of folds to run in parallel
+    :param num_threads: number of threads each worker may use (None: no
+                        limit)
+    :return:            generator yielding the results of fold_fn, in the
+                        order of the folds
+    """
+    if num_workers <= 1:
+        for fold in folds:
+            yield fold_fn(*fold)
+        return
+
+    results = multiprocessing.Queue()
+    pending = list(enumerate(folds))
+    running = {}
+    finished = {}
+    next_fold = 0
+
+    try:
+        while next_fold < len(folds):
+            while pending and len(running) < num_workers:
+                fold_idx, fold = pending.pop(0)
+                running[fold_idx] = multiprocessing.Process(
+                    target=_run_fold,
+                    args=(fold_fn, fold_idx, fold, num_threads, results))
+                running[fold_idx].start()
+
+            try:
+                fold_idx, result, error = results.get(timeout=1.)
+            except Queue.Empty:
+                # check for workers that died without reporting back
+                for fold_idx, worker in running.items():
+                    if worker.exitcode not in (None, 0):
+                        raise RuntimeError(
+                            'Fold {} exited with code {}'.format(
+                                fold_idx, worker.exitcode))
+                continue
+
+            running.pop(fold_idx).join()
+            if error is not None:
+                raise RuntimeError('Fold {} failed:\n{}'.format(fold_idx,
+                                                                error))
+            finished[fold_idx] = result
+
+            while next_fold in finished:
+                yield finished.pop(next_fold)
+                next_fold += 1
+    finally:
+        for worker in running.values():
+            worker.terminate()
+            worker.join()
+
+
+def close_iterators(*batch_iterators):
+    """
+    Stops the background processes of batch iterators that have them (see
+    augmenters.PrefetchIterator). Call this when training is done.
+    :param batch_iterators: batch iterators
+    """
+    for batches in batch_iterators:
+        close = getattr(batches, 'close', None)
+        if close is not None:
+            close()
 
 
 def create_optimiser(optimiser):
@@ -237,6 +408,14 @@ def setup(name):
     features.add_sacred_config(ex)
     targets.add_sacred_config(ex)
     augmenters.add_sacred_config(ex)
+    ex.add_config(
+        parallel_folds=dict(
+            # number of cross-validation folds run in parallel
+            num_workers=1,
+            # number of threads each fold may use (None: no limit)
+            num_threads=None
+        )
+    )
     return ex
 
 
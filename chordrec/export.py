@@ -0,0 +1,912 @@
+"""
+Exports trained networks to a self-contained NumPy inference graph.
+
+Running an exported network needs neither Theano nor Lasagne, so there is
+nothing to compile before the first song can be processed. Networks of the
+dnn (dense, conv, gap), rnn and crf models are supported. Exporting needs
+Lasagne (and Spaghetti for crf models) to walk the trained network.
+
+An exported network is stored as a NumPy .npz archive with the following
+entries:
+
+    format_version  format version (currently 1)
+    graph           JSON description of the network (see below)
+    <i>_<param>     parameter <param> of the i-th layer of the graph
+
+The graph is a JSON list of layers in topological order. Each layer is a
+dictionary with the keys
+
+    type    layer type (see below)
+    name    name of the layer in the trained network
+    inputs  indices of the layers it gets its input from. for recurrent and
+            crf layers, the second input is the mask (if any)
+
+and the following type-specific keys and parameters (all arrays float32):
+
+    input         role: 'data' or 'mask'
+    reshape       shape: list of ints (-1 allowed), {"ref": i} (i-th input
+                  dimension) or {"input": k, "dim": i} (i-th dimension of
+                  the k-th layer's output, e.g. batch size and sequence
+                  length of an rnn)
+    flatten       outdim
+    dimshuffle    pattern ('x' for broadcastable dimensions)
+    concat        axis
+    nonlinearity  nonlinearity (see NONLINEARITIES), leakiness for
+                  leaky_rectify
+    dense         num_leading_axes, nonlinearity; W (inputs x units), b
+    conv2d        pad, stride, flip_filters, nonlinearity; W (filters x
+                  channels x rows x cols), b (filters, or filters x rows x
+                  cols for untied biases)
+    pool2d        pool_size, stride, pad, ignore_border, mode ('max',
+                  'average_exc_pad' or 'average_inc_pad')
+    batchnorm     axes; beta, gamma, mean, inv_std
+    recurrent     backwards, nonlinearity; W_in, b, W_hid, hid_init
+    lstm          backwards, peepholes, nonlinearity, nonlinearity_<gate>;
+                  W_in_<gate>, W_hid_<gate>, b_<gate> for the gates ingate,
+                  forgetgate, cell and outgate, W_cell_<gate> for ingate,
+                  forgetgate and outgate if peepholes, cell_init, hid_init
+    crf           pi, tau, c, A, W. outputs the one-hot encoded Viterbi path
+                  (see chordrec.viterbi). beam_width (optional) prunes the
+                  search to this many states per frame
+
+Missing biases are stored as zeros. Dropout layers are left out.
+
+Dense and conv2d layers of a quantised network (see quantize()) have the
+additional key in_scale, the scale of their int8 inputs. Their W is int8,
+with the scale of each output channel (unit or filter) in W_scale.
+
+optimize() simplifies an exported network for inference: it folds batch
+normalisations into the weights of the preceding convolution or dense layer,
+merges nonlinearity layers into the layer before them and removes reshapes
+that do not change the shape. flops() counts the floating point operations
+of each layer. quantize() converts the weights of dense and convolution
+layers to int8 (post-training quantisation).
+"""
+import json
+import numpy as np
+
+from viterbi import viterbi
+
+FORMAT_VERSION = 1
+
+NONLINEARITIES = ['linear', 'rectify', 'leaky_rectify', 'sigmoid', 'tanh',
+                  'softmax', 'softplus', 'elu']
+
+LSTM_GATES = ['ingate', 'forgetgate', 'cell', 'outgate']
+
+
+# ---------------------------------------------------------------- exporting
+
+def _nonlinearity(fn):
+    import lasagne as lnn
+    nls = lnn.nonlinearities
+    if fn is None or fn is nls.linear or fn is nls.identity:
+        return {'nonlinearity': 'linear'}
+    if isinstance(fn, nls.LeakyRectify):
+        return {'nonlinearity': 'leaky_rectify',
+                'leakiness': float(fn.leakiness)}
+    for name in NONLINEARITIES:
+        if fn is getattr(nls, name, None):
+            return {'nonlinearity': name}
+    raise ValueError('Cannot export nonlinearity {}'.format(fn))
+
+
+def _value(param, shape=None):
+    if param is None:
+        return np.zeros(shape, dtype=np.float32)
+    return np.asarray(param.get_value(), dtype=np.float32)
+
+
+def _conv_pad(layer):
+    if layer.pad == 'same':
+        return [s // 2 for s in layer.filter_size]
+    elif layer.pad == 'full':
+        return [s - 1 for s in layer.filter_size]
+    return list(layer.pad)
+
+
+def _shape_spec(shape, input_layers):
+    import theano.tensor as tt
+    spec = []
+    for s in shape:
+        if isinstance(s, list):
+            spec.append({'ref': s[0]})
+            continue
+        try:
+            spec.append(int(tt.get_scalar_constant_value(s)))
+            continue
+        except tt.NotScalarConstantError:
+            pass
+        # dimension of an input variable, e.g. input_var.shape[0]
+        owner = s.owner
+        if owner is not None and isinstance(owner.op, tt.Subtensor) and \
+                owner.inputs[0].owner is not None and \
+                isinstance(owner.inputs[0].owner.op, tt.Shape):
+            var = owner.inputs[0].owner.inputs[0]
+            dim = int(tt.get_scalar_constant_value(owner.inputs[1]))
+            if var in input_layers:
+                spec.append({'input': input_layers[var], 'dim': dim})
+                continue
+        raise ValueError('Cannot export shape {}'.format(shape))
+    return spec
+
+
+def _export_layer(layer, inputs, input_layers, data_var, mask_var):
+    """
+    Describes a layer. Returns its description and parameters, or None if
+    the layer is left out (inputs[0] is used in its place).
+    """
+    import lasagne as lnn
+    L = lnn.layers
+
+    desc = {'name': layer.name, 'inputs': inputs}
+    params = {}
+
+    if isinstance(layer, L.InputLayer):
+        if layer.input_var is data_var:
+            desc.update(type='input', role='data')
+        elif layer.input_var is mask_var:
+            desc.update(type='input', role='mask')
+        else:
+            raise ValueError('Unknown input {}'.format(layer.name))
+
+    elif isinstance(layer, L.DropoutLayer):
+        return None
+
+    elif isinstance(layer, L.ReshapeLayer):
+        desc.update(type='reshape',
+                    shape=_shape_spec(layer.shape, input_layers))
+
+    elif isinstance(layer, L.FlattenLayer):
+        desc.update(type='flatten', outdim=layer.outdim)
+
+    elif isinstance(layer, L.DimshuffleLayer):
+        desc.update(type='dimshuffle', pattern=list(layer.pattern))
+
+    elif isinstance(layer, L.ConcatLayer):
+        desc.update(type='concat', axis=layer.axis)
+
+    elif isinstance(layer, L.NonlinearityLayer):
+        desc.update(type='nonlinearity', **_nonlinearity(layer.nonlinearity))
+
+    elif isinstance(layer, L.DenseLayer):
+        desc.update(type='dense',
+                    num_leading_axes=getattr(layer, 'num_leading_axes', 1),
+                    **_nonlinearity(layer.nonlinearity))
+        params['W'] = _value(layer.W)
+        params['b'] = _value(layer.b, layer.num_units)
+
+    elif isinstance(layer, L.Conv2DLayer):
+        if layer.untie_biases:
+            b_shape = layer.output_shape[1:]
+        else:
+            b_shape = layer.num_filters
+        desc.update(type='conv2d', pad=_conv_pad(layer),
+                    stride=list(layer.stride),
+                    flip_filters=bool(layer.flip_filters),
+                    **_nonlinearity(layer.nonlinearity))
+        params['W'] = _value(layer.W)
+        params['b'] = _value(layer.b, b_shape)
+
+    elif isinstance(layer, L.Pool2DLayer):
+        desc.update(type='pool2d', pool_size=list(layer.pool_size),
+                    stride=list(layer.stride), pad=list(layer.pad),
+                    ignore_border=bool(layer.ignore_border), mode=layer.mode)
+
+    elif isinstance(layer, L.BatchNormLayer):
+        desc.update(type='batchnorm', axes=list(layer.axes))
+        shape = layer.mean.get_value().shape
+        for p in ['mean', 'inv_std', 'gamma', 'beta']:
+            params[p] = _value(getattr(layer, p), shape)
+        if layer.gamma is None:
+            params['gamma'] += 1
+
+    elif isinstance(layer, L.LSTMLayer):
+        if layer.only_return_final:
+            raise ValueError('Cannot export {}'.format(layer.name))
+        desc.update(type='lstm', backwards=bool(layer.backwards),
+                    peepholes=bool(layer.peepholes),
+                    **_nonlinearity(layer.nonlinearity))
+        for gate in LSTM_GATES:
+            desc['nonlinearity_' + gate] = _nonlinearity(
+                getattr(layer, 'nonlinearity_' + gate))['nonlinearity']
+            params['W_in_' + gate] = _value(
+                getattr(layer, 'W_in_to_' + gate))
+            params['W_hid_' + gate] = _value(
+                getattr(layer, 'W_hid_to_' + gate))
+            params['b_' + gate] = _value(getattr(layer, 'b_' + gate))
+            if layer.peepholes and gate != 'cell':
+                params['W_cell_' + gate] = _value(
+                    getattr(layer, 'W_cell_to_' + gate))
+        if isinstance(layer.cell_init, L.Layer) or \
+                isinstance(layer.hid_init, L.Layer):
+            raise ValueError('Cannot export {}'.format(layer.name))
+        params['cell_init'] = _value(layer.cell_init).reshape(-1)
+        params['hid_init'] = _value(layer.hid_init).reshape(-1)
+
+    elif isinstance(layer, L.CustomRecurrentLayer):
+        if layer.only_return_final or \
+                not isinstance(layer.input_to_hidden, L.DenseLayer) or \
+                not isinstance(layer.hidden_to_hidden, L.DenseLayer) or \
+                isinstance(layer.hid_init, L.Layer):
+            raise ValueError('Cannot export {}'.format(layer.name))
+        desc.update(type='recurrent', backwards=bool(layer.backwards),
+                    **_nonlinearity(layer.nonlinearity))
+        num_units = layer.hidden_to_hidden.num_units
+        params['W_in'] = _value(layer.input_to_hidden.W)
+        params['b'] = (_value(layer.input_to_hidden.b, num_units) +
+                       _value(layer.hidden_to_hidden.b, num_units))
+        params['W_hid'] = _value(layer.hidden_to_hidden.W)
+        params['hid_init'] = _value(layer.hid_init).reshape(-1)
+
+    elif type(layer).__name__ == 'CrfLayer':
+        # parameters are stored in the order pi, tau, c, A, W
+        pi, tau, c, A, W = [_value(p) for p in layer.get_params()]
+        desc.update(type='crf')
+        params.update(pi=pi, tau=tau, c=c, A=A, W=W)
+
+    else:
+        raise ValueError('Cannot export layer {} ({})'.format(
+            layer.name, type(layer).__name__))
+
+    return desc, params
+
+
+def export(filename, network, input_var, mask_var=None):
+    """
+    Exports a trained network
+    :param filename:  file to store the exported network to (.npz)
+    :param network:   output layer of the network
+    :param input_var: input variable of the network
+    :param mask_var:  mask variable of the network (rnn and crf models)
+    """
+    import lasagne as lnn
+
+    graph = []
+    params = []
+    index = {}
+    input_layers = {}
+
+    for layer in lnn.layers.get_all_layers(network):
+        if hasattr(layer, 'input_layers'):
+            incoming = layer.input_layers
+        elif getattr(layer, 'input_layer', None) is not None:
+            incoming = [layer.input_layer]
+        else:
+            incoming = []
+        inputs = [index[source] for source in incoming]
+
+        exported = _export_layer(layer, inputs, input_layers,
+                                 input_var, mask_var)
+        if exported is None:
+            index[layer] = inputs[0]
+            continue
+
+        desc, layer_params = exported
+        index[layer] = len(graph)
+        if desc['type'] == 'input':
+            input_layers[layer.input_var] = index[layer]
+        graph.append(desc)
+        params.append(layer_params)
+
+    if index[network] != len(graph) - 1:
+        raise ValueError('The output layer was left out')
+
+    save(filename, Network(graph, params))
+
+
+# -------------------------------------------------------------- computation
+
+def _apply_nonlinearity(x, name, leakiness=0.01):
+    if name == 'linear':
+        return x
+    elif name == 'rectify':
+        return np.maximum(x, 0)
+    elif name == 'leaky_rectify':
+        return np.where(x > 0, x, x * leakiness)
+    elif name == 'sigmoid':
+        return 1. / (1. + np.exp(-x))
+    elif name == 'tanh':
+        return np.tanh(x)
+    elif name == 'softmax':
+        e = np.exp(x - x.max(axis=-1, keepdims=True))
+        return e / e.sum(axis=-1, keepdims=True)
+    elif name == 'softplus':
+        return np.logaddexp(x, 0)
+    elif name == 'elu':
+        return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+    raise ValueError('Unknown nonlinearity {}'.format(name))
+
+
+def _conv2d(x, W, b, pad, stride, flip_filters, scale=None):
+    if flip_filters:
+        W = W[:, :, ::-1, ::-1]
+    # channels last, so each filter tap is a matrix product
+    x = np.pad(x, [(0, 0), (0, 0), (pad[0], pad[0]), (pad[1], pad[1])],
+               mode='constant').transpose(0, 2, 3, 1)
+    num_filters, _, rows, cols = W.shape
+    out_rows = (x.shape[1] - rows) // stride[0] + 1
+    out_cols = (x.shape[2] - cols) // stride[1] + 1
+
+    out = np.zeros((x.shape[0], out_rows, out_cols, num_filters),
+                   dtype=np.float32)
+    for i in range(rows):
+        for j in range(cols):
+            out += np.dot(x[:, i:i + (out_rows - 1) * stride[0] + 1:stride[0],
+                            j:j + (out_cols - 1) * stride[1] + 1:stride[1]],
+                          W[:, :, i, j].T)
+
+    if scale is not None:
+        out *= scale
+    out = out.transpose(0, 3, 1, 2)
+    return out + (b[:, np.newaxis, np.newaxis] if b.ndim == 1 else b)
+
+
+def _int8(x, scale):
+    # symmetric quantisation. the values are kept as float32, so the
+    # products are computed (and accumulated) by the float BLAS routines
+    return np.clip(np.round(x / scale), -127, 127).astype(np.float32)
+
+
+def _pool_len(length, pool, stride, pad, ignore_border):
+    # as computed by theano
+    if ignore_border:
+        return (length + 2 * pad - pool) // stride + 1
+    if stride >= pool:
+        return (length - 1) // stride + 1
+    return max(0, (length - 1 - pool + stride) // stride) + 1
+
+
+def _pool2d(x, pool_size, stride, pad, ignore_border, mode):
+    out_shape = tuple(_pool_len(x.shape[2 + d], pool_size[d], stride[d],
+                                pad[d], ignore_border) for d in range(2))
+    size = [(out_shape[d] - 1) * stride[d] + pool_size[d] for d in range(2)]
+
+    def windows(a, fill, pad_fill):
+        # pad_fill is used for explicit padding, fill for partial windows
+        # at the border (ignore_border=False)
+        lead = [(0, 0)] * (a.ndim - 2)
+        a = np.pad(a, lead + [(p, p) for p in pad], mode='constant',
+                   constant_values=pad_fill)[..., :size[0], :size[1]]
+        a = np.pad(a, lead + [(0, size[0] - a.shape[-2]),
+                              (0, size[1] - a.shape[-1])],
+                   mode='constant', constant_values=fill)
+        stop = [(out_shape[k] - 1) * stride[k] + 1 for k in range(2)]
+        for i in range(pool_size[0]):
+            for j in range(pool_size[1]):
+                yield a[..., i:i + stop[0]:stride[0], j:j + stop[1]:stride[1]]
+
+    if mode == 'max':
+        out = np.full(x.shape[:2] + out_shape, -np.inf, dtype=np.float32)
+        for w in windows(x, -np.inf, -np.inf):
+            np.maximum(out, w, out=out)
+        return out
+    elif mode not in ('average_exc_pad', 'average_inc_pad'):
+        raise ValueError('Unknown pooling mode {}'.format(mode))
+
+    out = np.zeros(x.shape[:2] + out_shape, dtype=np.float32)
+    for w in windows(x, 0, 0):
+        out += w
+    # number of elements each window averages over
+    count = np.zeros(out_shape, dtype=np.float32)
+    for w in windows(np.ones(x.shape[2:], dtype=np.float32), 0,
+                     int(mode == 'average_inc_pad')):
+        count += w
+    return out / count
+
+
+def _batchnorm(x, axes, mean, inv_std, gamma, beta):
+    shape = [1 if d in axes else x.shape[d] for d in range(x.ndim)]
+    scale = (gamma * inv_std).reshape(shape)
+    return (x - mean.reshape(shape)) * scale + beta.reshape(shape)
+
+
+def _reshape(x, spec, outputs):
+    shape = []
+    for s in spec:
+        if isinstance(s, dict) and 'ref' in s:
+            shape.append(x.shape[s['ref']])
+        elif isinstance(s, dict):
+            shape.append(outputs[s['input']].shape[s['dim']])
+        else:
+            shape.append(s)
+    return x.reshape(shape)
+
+
+def _scan(step, num_steps, mask, backwards, states):
+    # runs a recurrent step function over time. masked steps keep the
+    # states of the previous step
+    outputs = np.empty((mask.shape[0], num_steps, states[-1].shape[-1]),
+                       dtype=np.float32)
+    steps = range(num_steps)
+    for t in (steps[::-1] if backwards else steps):
+        new_states = step(t, *states)
+        keep = mask[:, t, np.newaxis] > 0
+        states = [np.where(keep, n, s) for n, s in zip(new_states, states)]
+        outputs[:, t] = states[-1]
+    return outputs
+
+
+def _recurrent(x, mask, layer, p):
+    batch_size, num_steps = x.shape[:2]
+    inp = np.dot(x.reshape(batch_size, num_steps, -1), p['W_in']) + p['b']
+    hid = np.repeat(p['hid_init'][np.newaxis], batch_size, axis=0)
+
+    def step(t, hid):
+        return [_apply_nonlinearity(inp[:, t] + np.dot(hid, p['W_hid']),
+                                    layer['nonlinearity'])]
+
+    return _scan(step, num_steps, mask, layer['backwards'], [hid])
+
+
+def _lstm(x, mask, layer, p):
+    batch_size, num_steps = x.shape[:2]
+    x = x.reshape(batch_size, num_steps, -1)
+    inp = {g: np.dot(x, p['W_in_' + g]) + p['b_' + g] for g in LSTM_GATES}
+    cell = np.repeat(p['cell_init'][np.newaxis], batch_size, axis=0)
+    hid = np.repeat(p['hid_init'][np.newaxis], batch_size, axis=0)
+
+    def gate(name, t, hid, cell):
+        g = inp[name][:, t] + np.dot(hid, p['W_hid_' + name])
+        if layer['peepholes'] and name != 'cell':
+            g += cell * p['W_cell_' + name]
+        return _apply_nonlinearity(g, layer['nonlinearity_' + name])
+
+    def step(t, cell, hid):
+        cell = (gate('forgetgate', t, hid, cell) * cell +
+                gate('ingate', t, hid, cell) * gate('cell', t, hid, cell))
+        outgate = gate('outgate', t, hid, cell)
+        return [cell,
+                outgate * _apply_nonlinearity(cell, layer['nonlinearity'])]
+
+    return _scan(step, num_steps, mask, layer['backwards'], [cell, hid])
+
+
+def _crf(x, mask, layer, p):
+    paths = viterbi(x, p['pi'], p['tau'], p['c'], p['A'], p['W'], mask,
+                    beam_width=layer.get('beam_width'))
+    out = np.zeros(x.shape[:2] + (len(p['pi']),), dtype=np.float32)
+    seqs, frames = np.nonzero(mask > 0)
+    out[seqs, frames, paths[seqs, frames]] = 1
+    return out
+
+
+# ------------------------------------------------------------------ loading
+
+class Network(object):
+
+    def __init__(self, graph, params):
+        """
+        NumPy implementation of an exported network. Use load() to load an
+        exported network from a file.
+        :param graph:  list of layer descriptions
+        :param params: list of parameter dictionaries, one for each layer
+        """
+        self.graph = graph
+        self.params = params
+
+    def __call__(self, data, mask=None):
+        """
+        Computes the output of the network
+        :param data: input data
+        :param mask: mask (rnn and crf models). if None, all frames of all
+                     sequences are valid
+        :return:     output of the network
+        """
+        return self.outputs(data, mask)[-1]
+
+    def outputs(self, data, mask=None):
+        """
+        Computes the outputs of all layers of the network
+        :param data: input data
+        :param mask: mask (rnn and crf models). if None, all frames of all
+                     sequences are valid
+        :return:     list of outputs, one for each layer
+        """
+        data = np.asarray(data, dtype=np.float32)
+        if mask is None and data.ndim > 1:
+            mask = np.ones(data.shape[:2], dtype=np.float32)
+
+        outputs = []
+        for layer, p in zip(self.graph, self.params):
+            x = [outputs[i] for i in layer['inputs']]
+            t = layer['type']
+            nl = layer.get('nonlinearity')
+            leakiness = layer.get('leakiness', 0.01)
+
+            if t == 'input':
+                out = data if layer['role'] == 'data' else mask
+            elif t == 'reshape':
+                out = _reshape(x[0], layer['shape'], outputs)
+            elif t == 'flatten':
+                out = x[0].reshape(x[0].shape[:layer['outdim'] - 1] + (-1,))
+            elif t == 'dimshuffle':
+                pattern = layer['pattern']
+                out = x[0].transpose([d for d in pattern if d != 'x'])
+                for d, axis in enumerate(pattern):
+                    if axis == 'x':
+                        out = np.expand_dims(out, d)
+            elif t == 'concat':
+                out = np.concatenate(x, axis=layer['axis'])
+            elif t == 'nonlinearity':
+                out = _apply_nonlinearity(x[0], nl, leakiness)
+            elif t == 'dense':
+                n = layer['num_leading_axes']
+                inp = x[0].reshape(x[0].shape[:n] + (-1,))
+                if 'in_scale' in layer:
+                    out = np.dot(_int8(inp, layer['in_scale']),
+                                 p['W'].astype(np.float32))
+                    out *= layer['in_scale'] * p['W_scale']
+                else:
+                    out = np.dot(inp, p['W'])
+                out = _apply_nonlinearity(out + p['b'], nl, leakiness)
+            elif t == 'conv2d':
+                if 'in_scale' in layer:
+                    out = _conv2d(_int8(x[0], layer['in_scale']),
+                                  p['W'].astype(np.float32), p['b'],
+                                  layer['pad'], layer['stride'],
+                                  layer['flip_filters'],
+                                  scale=layer['in_scale'] * p['W_scale'])
+                else:
+                    out = _conv2d(x[0], p['W'], p['b'], layer['pad'],
+                                  layer['stride'], layer['flip_filters'])
+                out = _apply_nonlinearity(out, nl, leakiness)
+            elif t == 'pool2d':
+                out = _pool2d(x[0], layer['pool_size'], layer['stride'],
+                              layer['pad'], layer['ignore_border'],
+                              layer['mode'])
+            elif t == 'batchnorm':
+                out = _batchnorm(x[0], layer['axes'], p['mean'],
+                                 p['inv_std'], p['gamma'], p['beta'])
+            elif t == 'recurrent':
+                out = _recurrent(x[0], x[1] if len(x) > 1 else mask,
+                                 layer, p)
+            elif t == 'lstm':
+                out = _lstm(x[0], x[1] if len(x) > 1 else mask, layer, p)
+            elif t == 'crf':
+                out = _crf(x[0], x[1] if len(x) > 1 else mask, layer, p)
+            else:
+                raise ValueError('Unknown layer type {}'.format(t))
+
+            outputs.append(out.astype(np.float32, copy=False))
+
+        return outputs
+
+
+def save(filename, network):
+    """
+    Stores an exported network
+    :param filename: file to store the network to (.npz)
+    :param network:  Network
+    """
+    arrays = {}
+    for idx, params in enumerate(network.params):
+        for name, value in params.items():
+            arrays['{}_{}'.format(idx, name)] = value
+    np.savez(filename, format_version=FORMAT_VERSION,
+             graph=json.dumps(network.graph), **arrays)
+
+
+def load(filename):
+    """
+    Loads an exported network
+    :param filename: file of the exported network
+    :return:         Network
+    """
+    with np.load(filename) as f:
+        if int(f['format_version']) != FORMAT_VERSION:
+            raise ValueError('Unsupported format version {} of {}'.format(
+                f['format_version'], filename))
+        graph = json.loads(str(f['graph']))
+        params = [{} for _ in graph]
+        for key in f.files:
+            idx, sep, name = key.partition('_')
+            if sep and idx.isdigit():
+                params[int(idx)][name] = f[key]
+    return Network(graph, params)
+
+
+def verify(process_fn, network, agg_dataset, use_mask, batch_size=None):
+    """
+    Compares the output of an exported network with the compiled Theano
+    function of the original network on all songs of a data source
+    :param process_fn:  theano function that gives the nn's output
+    :param network:     exported Network
+    :param agg_dataset: aggregated data source
+    :param use_mask:    if the network is an rnn or crf
+    :param batch_size:  batch size if each song is to be processed batch-wise
+    :return:            maximum absolute difference of the outputs and
+                        fraction of frames with the same predicted class
+    """
+    import dmgr
+
+    max_diff = 0.
+    num_same = 0
+    num_frames = 0
+
+    for ds_idx in range(agg_dataset.n_datasources):
+        ds = agg_dataset.datasource(ds_idx)
+        for data, _ in dmgr.iterators.iterate_batches(
+                ds, batch_size or ds.n_data, randomise=False, expand=False):
+            if use_mask:
+                data = data[np.newaxis, :]
+                mask = np.ones(data.shape[:2], dtype=np.float32)
+                expected = process_fn(data, mask)[0]
+                out = network(data, mask)[0]
+            else:
+                expected = process_fn(data)
+                out = network(data)
+
+            max_diff = max(max_diff, float(np.abs(out - expected).max()))
+            num_same += np.count_nonzero(
+                out.argmax(axis=-1) == expected.argmax(axis=-1))
+            num_frames += len(out)
+
+    return max_diff, num_same / float(max(num_frames, 1))
+
+
+# ------------------------------------------------------------- optimization
+
+def _sample_shapes(network, data_shape):
+    # output shapes of all layers for an input of data_shape and for one
+    # with longer leading (batch and sequence) dimensions, so we can tell
+    # fixed dimensions from variable ones
+    has_mask = any(layer['type'] == 'input' and layer['role'] == 'mask'
+                   for layer in network.graph)
+    num_var = 2 if has_mask else 1
+    grown = tuple(d + 1 for d in data_shape[:num_var]) + \
+        tuple(data_shape[num_var:])
+    return [[o.shape for o in network.outputs(np.zeros(shape, np.float32))]
+            for shape in (tuple(data_shape), grown)]
+
+
+def _consumers(graph, idx):
+    return [i for i, layer in enumerate(graph) if idx in layer['inputs']]
+
+
+def _linear_layer(graph, idx, consumer):
+    # dense or conv layer without nonlinearity that only feeds `consumer`
+    return graph[idx]['type'] in ('dense', 'conv2d') and \
+        graph[idx]['nonlinearity'] == 'linear' and \
+        _consumers(graph, idx) == [consumer]
+
+
+def _remove(graph, params, replace):
+    # removes the layers in replace, their consumers get their input from
+    # the layer they are replaced with
+    def resolve(i):
+        while i in replace:
+            i = replace[i]
+        return i
+
+    index = {}
+    new_graph = []
+    new_params = []
+    for i, (layer, p) in enumerate(zip(graph, params)):
+        if i in replace:
+            continue
+        index[i] = len(new_graph)
+        layer = dict(layer, inputs=[index[resolve(j)]
+                                    for j in layer['inputs']])
+        if layer['type'] == 'reshape':
+            layer['shape'] = [dict(s, input=index[resolve(s['input'])])
+                              if isinstance(s, dict) and 'input' in s else s
+                              for s in layer['shape']]
+        new_graph.append(layer)
+        new_params.append(p)
+
+    if index[resolve(len(graph) - 1)] != len(new_graph) - 1:
+        raise ValueError('The output layer was removed')
+    return new_graph, new_params
+
+
+def _fold_batchnorms(graph, params, shapes):
+    replace = {}
+    for i, layer in enumerate(graph):
+        if layer['type'] != 'batchnorm' or \
+                not _linear_layer(graph, layer['inputs'][0], i) or \
+                'in_scale' in graph[layer['inputs'][0]]:
+            continue
+        src = layer['inputs'][0]
+        p = params[src]
+        bn = params[i]
+        scale = bn['gamma'] * bn['inv_std']
+        shift = bn['beta'] - bn['mean'] * scale
+
+        if graph[src]['type'] == 'conv2d' and layer['axes'] == [0, 2, 3]:
+            W = p['W'] * scale[:, np.newaxis, np.newaxis, np.newaxis]
+            if p['b'].ndim > 1:
+                scale = scale[:, np.newaxis, np.newaxis]
+                shift = shift[:, np.newaxis, np.newaxis]
+        elif graph[src]['type'] == 'dense' and \
+                layer['axes'] == list(range(graph[src]['num_leading_axes'])):
+            W = p['W'] * scale
+        else:
+            continue
+
+        params[src] = dict(p, W=W.astype(np.float32),
+                           b=(p['b'] * scale + shift).astype(np.float32))
+        replace[i] = src
+    return replace
+
+
+def _merge_nonlinearities(graph, params, shapes):
+    replace = {}
+    for i, layer in enumerate(graph):
+        if layer['type'] != 'nonlinearity':
+            continue
+        src = layer['inputs'][0]
+        if layer['nonlinearity'] == 'linear':
+            replace[i] = src
+        elif _linear_layer(graph, src, i):
+            graph[src] = dict(graph[src], nonlinearity=layer['nonlinearity'])
+            if 'leakiness' in layer:
+                graph[src]['leakiness'] = layer['leakiness']
+            replace[i] = src
+    return replace
+
+
+def _remove_reshapes(graph, params, shapes):
+    replace = {}
+    for i, layer in enumerate(graph):
+        if layer['type'] not in ('reshape', 'flatten', 'dimshuffle'):
+            continue
+        src = layer['inputs'][0]
+        if layer['type'] == 'dimshuffle' and \
+                layer['pattern'] != list(range(len(shapes[0][i]))):
+            continue
+        if all(s[i] == s[src] for s in shapes):
+            replace[i] = src
+    return replace
+
+
+def _merge_dense_reshapes(graph, params, shapes):
+    # a dense layer between a reshape that flattens the leading dimensions
+    # of its input and one that restores them (e.g. after a recurrent layer)
+    # can process the input directly
+    replace = {}
+    for i, layer in enumerate(graph):
+        if layer['type'] != 'dense' or layer['num_leading_axes'] != 1:
+            continue
+        flat = layer['inputs'][0]
+        consumers = _consumers(graph, i)
+        if graph[flat]['type'] not in ('reshape', 'flatten') or \
+                _consumers(graph, flat) != [i] or len(consumers) != 1 or \
+                graph[consumers[0]]['type'] != 'reshape':
+            continue
+        src = graph[flat]['inputs'][0]
+        restore = consumers[0]
+
+        for n in range(1, len(shapes[0][src])):
+            if all(s[flat] == (np.prod(s[src][:n]), np.prod(s[src][n:])) and
+                   s[restore] == s[src][:n] + s[i][1:] for s in shapes):
+                graph[i] = dict(layer, inputs=[src], num_leading_axes=n)
+                replace[flat] = src
+                replace[restore] = i
+                break
+    return replace
+
+
+def optimize(network, data_shape):
+    """
+    Simplifies an exported network for inference. The optimised network
+    computes the same function (up to rounding), but skips operations:
+    batch normalisations are folded into the weights and biases of the
+    convolution or dense layer before them, nonlinearity layers are merged
+    into the layer before them, and reshapes that do not change the shape
+    of their input are removed. So are reshapes around a dense layer that
+    only flatten and restore the leading dimensions of its input.
+    :param network:    exported Network
+    :param data_shape: shape of an example input of the network, used to
+                       determine the shapes of all layers (e.g. (1, 15, 105)
+                       for a dnn or (1, 100, 105) for an rnn)
+    :return:           optimised Network
+    """
+    graph = [dict(layer) for layer in network.graph]
+    params = [dict(p) for p in network.params]
+
+    passes = [_fold_batchnorms, _merge_nonlinearities, _remove_reshapes,
+              _merge_dense_reshapes]
+    changed = True
+    while changed:
+        changed = False
+        for opt_pass in passes:
+            shapes = _sample_shapes(Network(graph, params), data_shape)
+            replace = opt_pass(graph, params, shapes)
+            if replace:
+                graph, params = _remove(graph, params, replace)
+                changed = True
+
+    return Network(graph, params)
+
+
+def flops(network, data_shape):
+    """
+    Counts the floating point operations each layer of a network needs to
+    process an input of the given shape. A multiply-add counts as two
+    operations, evaluating a nonlinearity as one.
+    :param network:    exported Network
+    :param data_shape: shape of the input
+    :return:           list of (layer name, layer type, operations)
+    """
+    shapes = _sample_shapes(network, data_shape)[0]
+    counts = []
+    for i, (layer, p) in enumerate(zip(network.graph, network.params)):
+        t = layer['type']
+        out_size = np.prod(shapes[i])
+        in_size = np.prod(shapes[layer['inputs'][0]]) if layer['inputs'] \
+            else 0
+        nl_ops = out_size if layer.get('nonlinearity', 'linear') != 'linear' \
+            else 0
+
+        if t == 'dense':
+            ops = 2 * in_size * p['W'].shape[1] + out_size + nl_ops
+        elif t == 'conv2d':
+            ops = 2 * out_size * np.prod(p['W'].shape[1:]) + out_size + nl_ops
+        elif t == 'pool2d':
+            ops = out_size * np.prod(layer['pool_size'])
+        elif t == 'batchnorm':
+            ops = 2 * out_size
+        elif t == 'nonlinearity':
+            ops = nl_ops
+        elif t == 'recurrent':
+            num_units = shapes[i][-1]
+            ops = 2 * (in_size + out_size) * num_units + out_size + nl_ops
+        elif t == 'lstm':
+            # four gates, each with its nonlinearity, and the cell update
+            num_units = shapes[i][-1]
+            ops = (4 * (2 * (in_size + out_size) * num_units + 2 * out_size) +
+                   4 * out_size + nl_ops)
+        elif t == 'crf':
+            num_frames = np.prod(shapes[i][:2])
+            num_states = len(p['pi'])
+            ops = (2 * in_size * num_states +
+                   3 * num_frames * num_states * num_states)
+        else:
+            ops = 0
+        counts.append((layer['name'], t, int(ops)))
+    return counts
+
+
+# ------------------------------------------------------------- quantisation
+
+def quantize(network, calibration):
+    """
+    Quantises the weights of all dense and convolution layers of a network
+    to int8 (one scale per output channel), and their inputs to int8 with a
+    scale calibrated on example data (the maximum absolute value each layer
+    gets as input). Optimise the network first, so that batch
+    normalisations are folded into the quantised weights.
+    :param network:     exported Network
+    :param calibration: iterable of example inputs of the network (each a
+                        batch of data, all frames valid)
+    :return:            quantised Network
+    """
+    quantized = [i for i, layer in enumerate(network.graph)
+                 if layer['type'] in ('dense', 'conv2d') and
+                 'in_scale' not in layer]
+
+    max_abs = {i: 0. for i in quantized}
+    for data in calibration:
+        outputs = network.outputs(data)
+        for i in quantized:
+            inp = outputs[network.graph[i]['inputs'][0]]
+            max_abs[i] = max(max_abs[i], float(np.abs(inp).max()))
+
+    graph = [dict(layer) for layer in network.graph]
+    params = [dict(p) for p in network.params]
+    for i in quantized:
+        W = params[i]['W']
+        if graph[i]['type'] == 'conv2d':
+            w_max = np.abs(W).reshape(len(W), -1).max(axis=1)
+            w_shape = (-1, 1, 1, 1)
+        else:
+            w_max = np.abs(W).max(axis=0)
+            w_shape = (1, -1)
+        w_scale = np.where(w_max > 0, w_max / 127., 1.).astype(np.float32)
+        params[i]['W'] = np.clip(np.round(W / w_scale.reshape(w_shape)),
+                                 -127, 127).astype(np.int8)
+        params[i]['W_scale'] = w_scale
+        graph[i]['in_scale'] = max_abs[i] / 127. if max_abs[i] > 0 else 1.
+
+    return Network(graph, params)
@@ -2,6 +2,23 @@ import numpy as np
 import madmom as mm
 import pickle
 
+import audio
+
+
+def spectrograms(audio_file, sample_rate, fps, frame_sizes):
+    """
+    Computes magnitude spectrograms of an audio file
+    :param audio_file:  audio file
+    :param sample_rate: sample rate of the audio
+    :param fps:         frames per second
+    :param frame_sizes: frame sizes to compute the spectrograms for
+    :return:            dictionary mapping frame sizes to spectrograms
+    """
+    sig = audio.load_signal(audio_file, sample_rate=sample_rate)
+    return {ffts: mm.audio.spectrogram.Spectrogram(sig, fps=fps,
+                                                   frame_size=ffts)
+            for ffts in frame_sizes}
+
 
 class ConstantQ:
 
@@ -43,11 +60,12 @@ class ConstantQ:
 
     def __call__(self, audio_file):
 
-        audio = mm.audio.signal.Signal(audio_file,
-                                       sample_rate=self.sample_rate,
-                                       num_channels=1).astype(np.float64)
+        # yaafe gets the unscaled 16 bit samples, as it did before we cached
+        # the decoded audio
+        sig = audio.load_signal(audio_file, sample_rate=self.sample_rate)
+        sig = sig.astype(np.float64) * audio.INT16_MAX
 
-        cqt = self.engine.processAudio(audio.reshape((1, -1)))['cqt']
+        cqt = self.engine.processAudio(sig.reshape((1, -1)))['cqt']
         # compensate for different padding in madmom vs. yaafe and convert
         # to float32
         cqt = np.vstack((cqt, np.zeros(cqt.shape[1:]))).astype(np.float32)
@@ -81,12 +99,20 @@ class LogFiltSpec:
     def __call__(self, audio_file):
         # do not resample because ffmpeg/avconv creates terrible sampling
         # artifacts
+        return self.from_spectrograms(
+            spectrograms(audio_file, self.sample_rate, self.fps,
+                         self.frame_sizes))
+
+    def from_spectrograms(self, specs):
+        """
+        Computes the features from precomputed spectrograms
+        :param specs: dictionary mapping frame sizes to spectrograms
+        :return:      log-filtered spectrograms of all frame sizes
+        """
         specs = [
             mm.audio.spectrogram.LogarithmicFilteredSpectrogram(
-                audio_file, num_channels=1, sample_rate=self.sample_rate,
-                fps=self.fps, frame_size=ffts,
-                num_bands=self.num_bands, fmin=self.fmin, fmax=self.fmax,
-                unique_filters=self.unique_filters)
+                specs[ffts], num_bands=self.num_bands, fmin=self.fmin,
+                fmax=self.fmax, unique_filters=self.unique_filters)
             for ffts in self.frame_sizes
         ]
 
@@ -103,6 +129,7 @@ class Chroma:
         self.oct_width = oct_width
         self.center_note = center_note
         self.frame_size = frame_size
+        self.frame_sizes = [frame_size]
         self.log_eta = log_eta
 
         # parameters are based on Cho and Bello, 2014.
@@ -138,10 +165,17 @@ class Chroma:
             self.fps, self.fmax, self.frame_size) + gauss_str + log_str
 
     def __call__(self, audio_file):
-        spec = mm.audio.spectrogram.Spectrogram(
-            audio_file, num_channels=1, sample_rate=self.sample_rate,
-            fps=self.fps, frame_size=4096,
-        )
+        return self.from_spectrograms(
+            spectrograms(audio_file, self.sample_rate, self.fps,
+                         self.frame_sizes))
+
+    def from_spectrograms(self, specs):
+        """
+        Computes the features from precomputed spectrograms
+        :param specs: dictionary mapping frame sizes to spectrograms
+        :return:      chroma vectors
+        """
+        spec = specs[self.frame_size]
 
         if self.log_eta is not None:
             spec = np.log(self.log_eta * spec / spec.max() + 1)
@@ -196,8 +230,7 @@ class ChromaCq:
 
     def __call__(self, audio_file):
         import librosa
-        y = mm.audio.signal.Signal(audio_file, num_channels=1,
-                                   sample_rate=self.sample_rate)
+        y = audio.load_signal(audio_file, sample_rate=self.sample_rate)
 
         cq = librosa.core.cqt(y, sr=y.sample_rate, tuning=0,
                               fmin=mm.audio.filters.midi2hz(24),
@@ -233,8 +266,9 @@ class HarmonicPitchClassProfile:
     def __call__(self, audio_file):
         from madmom.audio import chroma
 
+        sig = audio.load_signal(audio_file, sample_rate=self.sample_rate)
         hpcp = chroma.HarmonicPitchClassProfile(
-            audio_file, fps=self.fps, fmax=self.fmax,
+            sig, fps=self.fps, fmax=self.fmax,
             num_classes=self.num_bands, sample_rate=self.sample_rate
         )
 
@@ -254,6 +288,9 @@ class DeepChroma:
         self.fmin = fmin
         self.fmax = fmax
         self.unique_filters = unique_filters
+        self.sample_rate = sample_rate
+        # frame size of the spectrogram the DeepChromaProcessor computes
+        self.frame_sizes = [8192]
         self.dcp = DeepChromaProcessor(
             fmin=fmin, fmax=fmax, unique_filters=unique_filters, models=models
         )
@@ -267,11 +304,111 @@ class DeepChroma:
         )
 
     def __call__(self, audio_file):
-        return self.dcp(audio_file)
+        return self.dcp(
+            audio.load_signal(audio_file, sample_rate=self.sample_rate))
+
+    def from_spectrograms(self, specs):
+        """
+        Computes the features from precomputed spectrograms
+        :param specs: dictionary mapping frame sizes to spectrograms
+        :return:      deep chroma vectors
+        """
+        data = mm.audio.spectrogram.LogarithmicFilteredSpectrogram(
+            specs[8192], num_bands=24, fmin=self.fmin, fmax=self.fmax,
+            unique_filters=self.unique_filters)
+
+        # the processor computes signal, frames, stft and log-filtered
+        # spectrogram in its first four steps. we already have the latter,
+        # so we only run the remaining steps (context frames and network)
+        for processor in self.dcp.processors[4:]:
+            data = processor(data)
+
+        return data
+
+
+class MultiFeature:
+
+    def __init__(self, extractors, fold=None):
+        """
+        Computes several features in one pass, sharing the spectrograms
+        between them. Each feature keeps the name of its extractor, so it
+        is cached as if it was computed separately.
+        :param extractors: list of feature extractor configurations. only
+                           extractors computed from spectrograms are supported
+                           (LogFiltSpec, Chroma and DeepChroma)
+        :param fold:       fold to create the extractors for
+        """
+        self.extractors = [create_extractor(e, fold) for e in extractors]
+
+        for e in self.extractors:
+            e = getattr(e, 'extractor', e)
+            if not hasattr(e, 'from_spectrograms'):
+                raise ValueError('{} does not support shared spectrograms'
+                                 .format(e.__class__.__name__))
+
+        if len(set((e.fps, e.sample_rate) for e in self.extractors)) > 1:
+            raise ValueError('All features must have the same frame rate and '
+                             'sample rate')
+
+        self.fps = self.extractors[0].fps
+        self.sample_rate = self.extractors[0].sample_rate
+        self.frame_sizes = sorted(set(sum((e.frame_sizes
+                                           for e in self.extractors), [])))
+
+    @property
+    def names(self):
+        return [e.name for e in self.extractors]
+
+    def __call__(self, audio_file):
+        """
+        Computes all features of an audio file
+        :param audio_file: audio file
+        :return:           list of features, in the order of the extractors
+        """
+        specs = spectrograms(audio_file, self.sample_rate, self.fps,
+                             self.frame_sizes)
+        return [e.from_spectrograms(specs) for e in self.extractors]
+
+
+class StorageDtype:
+
+    def __init__(self, extractor, dtype):
+        """
+        Stores the features of an extractor in a different data type, e.g.
+        float16 to halve the memory the features take in the cache and in
+        the data sources. Batches are converted back to float32 before they
+        reach the network (see augmenters.Upcast).
+        :param extractor: feature extractor
+        :param dtype:     data type to store the features in
+        """
+        if getattr(extractor, 'precomputed', False):
+            raise ValueError('Cannot change the data type of precomputed '
+                             'features')
+        self.extractor = extractor
+        self.dtype = np.dtype(dtype).name
+
+    def __getattr__(self, name):
+        # behave like the wrapped extractor (fps, sample rate, ...)
+        if name.startswith('__') or name == 'extractor':
+            raise AttributeError(name)
+        return getattr(self.extractor, name)
+
+    @property
+    def name(self):
+        return '{}_dtype={}'.format(self.extractor.name, self.dtype)
+
+    def __call__(self, audio_file):
+        return self.extractor(audio_file).astype(self.dtype)
+
+    def from_spectrograms(self, specs):
+        return self.extractor.from_spectrograms(specs).astype(self.dtype)
 
 
 class PrecomputedFeature:
 
+    # features computed elsewhere, the cache does not manage them
+    precomputed = True
+
     def __init__(self, name, fps, fold):
         self._name = name
         self.fps = fps
@@ -457,4 +594,10 @@ def add_sacred_config(ex):
 
 
 def create_extractor(config, fold):
-    return globals()[config['name']](fold=fold, **config['params'])
+    extractor = globals()[config['name']](fold=fold, **config['params'])
+
+    # features can optionally be stored in reduced precision (e.g. float16)
+    if config.get('dtype', 'float32') != 'float32':
+        extractor = StorageDtype(extractor, config['dtype'])
+
+    return extractor
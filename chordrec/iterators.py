@@ -0,0 +1,262 @@
+from __future__ import print_function
+
+import numpy as np
+
+
+class FrameBatchIterator(object):
+
+    def __init__(self, datasource, batch_size, randomise=True, expand=True):
+        """
+        Iterates over the frames of a data source in batches, like
+        dmgr.iterators.BatchIterator. Batches are planned (frame indices)
+        and assembled in separate steps, so a PrefetchIterator can assemble
+        them in its worker processes.
+        :param datasource: (aggregated) data source
+        :param batch_size: number of frames per batch
+        :param randomise:  shuffle the frames
+        :param expand:     fill up the last batch with randomly drawn frames
+                           of the other batches
+        """
+        self.datasource = datasource
+        self.batch_size = batch_size
+        self.randomise = randomise
+        self.expand = expand
+
+    def __len__(self):
+        return -(-self.datasource.n_data // self.batch_size)
+
+    def plan(self):
+        """
+        Plans the batches of an epoch
+        :return: list of frame indices of each batch
+        """
+        n_data = self.datasource.n_data
+        if self.randomise:
+            idxs = np.random.permutation(n_data)
+        else:
+            idxs = np.arange(n_data)
+        batches = [idxs[i:i + self.batch_size]
+                   for i in range(0, n_data, self.batch_size)]
+
+        num_missing = self.batch_size - len(batches[-1]) if batches else 0
+        if self.expand and 0 < num_missing <= n_data - len(batches[-1]):
+            fill = np.random.choice(idxs[:-len(batches[-1])], num_missing,
+                                    replace=False)
+            batches[-1] = np.concatenate([batches[-1], fill])
+        return batches
+
+    def assemble(self, idxs):
+        """
+        Assembles a batch
+        :param idxs: frame indices of the batch
+        :return:     data and targets of the batch
+        """
+        # in index order, the frames of each song are gathered together
+        return self.datasource[np.sort(idxs)]
+
+    def __iter__(self):
+        # the data source may reuse its batch arrays (see
+        # datasources.AggregatedContextWindows), but consumers like nn.train
+        # keep several batches at once. (PrefetchIterator workers copy the
+        # assembled batches into their buffers right away instead)
+        for idxs in self.plan():
+            yield tuple(np.array(a) for a in self.assemble(idxs))
+
+
+class CopiedBatches(object):
+
+    def __init__(self, batch_iterator):
+        """
+        Copies the batches of an iterator, e.g. of a dmgr iterator over a
+        data source that reuses its batch arrays (see
+        datasources.AggregatedContextWindows), so that consumers can keep
+        several batches at once.
+        :param batch_iterator: batch iterator
+        """
+        self.batch_iterator = batch_iterator
+
+    def __getattr__(self, name):
+        # behave like the wrapped iterator (e.g. batch size)
+        if name == 'batch_iterator':
+            raise AttributeError(name)
+        return getattr(self.batch_iterator, name)
+
+    def __len__(self):
+        return len(self.batch_iterator)
+
+    def __iter__(self):
+        for batch in self.batch_iterator:
+            yield tuple(np.array(a) for a in batch)
+
+
+class BucketedSequenceIterator(object):
+
+    def __init__(self, datasource, batch_size, max_seq_len, randomise=True,
+                 pool_size=50, report=True, seed=None):
+        """
+        Iterates over sequences (crops of at most max_seq_len frames of the
+        songs of a data source) in batches of sequences with similar length,
+        so batches need little padding. Like the SequenceIterator, it yields
+        (data, targets, mask) batches.
+
+        The crops of each song start at an offset drawn anew every epoch,
+        so the crop boundaries differ between epochs. Crops are shuffled
+        and then distributed into pools of pool_size * batch_size crops.
+        Within a pool, crops are sorted by length and cut into batches, and
+        the order of all batches is shuffled again. The content of the
+        batches thus remains random, only crops of similar length end up
+        together. Like the FrameBatchIterator, batches are planned and
+        assembled in separate steps.
+
+        :param datasource:  aggregated data source
+        :param batch_size:  number of sequences per batch
+        :param max_seq_len: maximum sequence length
+        :param randomise:   shuffle crops and batches. if False, crops
+                            are batched in order, without bucketing
+        :param pool_size:   number of batches per pool
+        :param report:      print the padding efficiency of each epoch
+        :param seed:        seed of the random number stream of the
+                            iterator. if None, it is drawn from numpy's
+                            random number generator
+        """
+        self.datasource = datasource
+        self.batch_size = batch_size
+        self.max_seq_len = max_seq_len
+        self.randomise = randomise
+        self.pool_size = pool_size
+        self.report = report
+        self.efficiency = None
+        self.random_state = np.random.RandomState(
+            seed if seed is not None else np.random.randint(2 ** 30))
+
+        # crops of the next epoch
+        self.crops = self._draw_crops()
+
+    def _draw_crops(self):
+        # crops are (song index, start, stop). with a random offset, the
+        # first crop of a song ends at the offset
+        crops = []
+        for i in range(self.datasource.n_datasources):
+            n_data = self.datasource.datasource(i).n_data
+            offset = 0
+            if self.randomise and n_data > self.max_seq_len:
+                offset = self.random_state.randint(self.max_seq_len)
+            bounds = sorted(set([0, n_data] + range(offset, n_data,
+                                                    self.max_seq_len)))
+            crops += [(i, start, stop)
+                      for start, stop in zip(bounds[:-1], bounds[1:])]
+        return crops
+
+    def _batches(self):
+        crops = self.crops
+        self.crops = self._draw_crops()
+        if not self.randomise:
+            return [crops[i:i + self.batch_size]
+                    for i in range(0, len(crops), self.batch_size)]
+
+        crops = [crops[i] for i in
+                 self.random_state.permutation(len(crops))]
+        pool_len = self.batch_size * self.pool_size
+        batches = []
+        for p in range(0, len(crops), pool_len):
+            # the sort is stable, so crops of equal length stay shuffled
+            pool = sorted(crops[p:p + pool_len],
+                          key=lambda crop: crop[2] - crop[1])
+            batches += [pool[i:i + self.batch_size]
+                        for i in range(0, len(pool), self.batch_size)]
+
+        return [batches[i] for i in
+                self.random_state.permutation(len(batches))]
+
+    def plan(self):
+        """
+        Plans the batches of an epoch
+        :return: list of crops (song index, start, stop) of each batch
+        """
+        batches = self._batches()
+
+        num_frames = sum(stop - start for crops in batches
+                         for _, start, stop in crops)
+        num_padded = sum(len(crops) * max(stop - start
+                                          for _, start, stop in crops)
+                         for crops in batches)
+        self.efficiency = num_frames / float(max(num_padded, 1))
+        if self.report:
+            print('Padding efficiency: {:.1f}% ({:d} of {:d} frames)'.format(
+                self.efficiency * 100, num_frames, num_padded))
+
+        return batches
+
+    def __len__(self):
+        # number of batches of the next epoch
+        num_crops = len(self.crops)
+        if not self.randomise:
+            return -(-num_crops // self.batch_size)
+        pool_len = self.batch_size * self.pool_size
+        num_batches = (num_crops // pool_len) * self.pool_size
+        return num_batches + -(-(num_crops % pool_len) // self.batch_size)
+
+    def assemble(self, crops):
+        """
+        Assembles a batch
+        :param crops: crops (song index, start, stop) of the batch
+        :return:      data, targets and mask of the batch
+        """
+        max_len = max(stop - start for _, start, stop in crops)
+        ds = self.datasource
+        data = np.zeros((len(crops), max_len) + ds.dshape, dtype=ds.dtype)
+        targets = np.zeros((len(crops), max_len) + ds.tshape,
+                           dtype=ds.ttype)
+        mask = np.zeros((len(crops), max_len), dtype=np.float32)
+
+        for j, (i, start, stop) in enumerate(crops):
+            d, t = ds.datasource(i)[start:stop]
+            data[j, :stop - start] = d
+            targets[j, :stop - start] = t
+            mask[j, :stop - start] = 1
+
+        return data, targets, mask
+
+    def __iter__(self):
+        for crops in self.plan():
+            yield self.assemble(crops)
+
+
+def iterate_songs(agg_datasource, max_frames, song_idxs=None):
+    """
+    Iterates over whole songs in padded, masked batches, e.g. to process
+    them with a recurrent network. Songs are sorted by length, so songs of
+    similar length share a batch. Each batch holds as many songs as fit
+    into max_frames frames (including padding), but at least one.
+    :param agg_datasource: aggregated data source
+    :param max_frames:     maximum number of frames per batch
+    :param song_idxs:      indices of the songs to iterate over. if None,
+                           all songs of the data source
+    :return:               generator of (song indices, data, mask)
+    """
+    if song_idxs is None:
+        song_idxs = range(agg_datasource.n_datasources)
+    lengths = {i: agg_datasource.datasource(i).n_data for i in song_idxs}
+    # longest songs first, so the first song of a batch is its longest
+    order = sorted(song_idxs, key=lambda i: -lengths[i])
+
+    def assemble(batch):
+        max_len = lengths[batch[0]]
+        data = np.zeros((len(batch), max_len) + agg_datasource.dshape,
+                        dtype=agg_datasource.dtype)
+        mask = np.zeros((len(batch), max_len), dtype=np.float32)
+        for j, i in enumerate(batch):
+            data[j, :lengths[i]] = agg_datasource.datasource(i)[
+                0:lengths[i]][0]
+            mask[j, :lengths[i]] = 1
+        return batch, data, mask
+
+    batch = []
+    for i in order:
+        if batch and (len(batch) + 1) * lengths[batch[0]] > max_frames:
+            yield assemble(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        yield assemble(batch)
@@ -1,21 +1,55 @@
 from dnn import *
 
 
-def build_model(in_shape, out_size, model):
-    network, input_var, target_var = build_net(in_shape, out_size, model)
-
+def _feature_layer(network):
     # this goes back to the nonlinearity layer of the penultimate conv layer
     # (after batchnorm!)
-    feature_layer = network
     for _ in range(7):
-        feature_layer = feature_layer.input_layer
+        network = network.input_layer
+    return network
+
+
+def build_model(in_shape, out_size, model):
+    network, input_var, target_var = build_net(in_shape, out_size, model)
+    feature_layer = _feature_layer(network)
+
+    # compute features and network output in one pass, so they share the
+    # computation of the conv layers
+    feature_out, process_out = lnn.layers.get_output(
+        [feature_layer, network], deterministic=True)
 
     # average the feature maps of this conv layer
-    feature_out = lnn.layers.get_output(feature_layer, deterministic=True)
     feature_out = tt.mean(feature_out, axis=(2, 3))
 
     return dict(network=network, input_var=input_var, target_var=target_var,
-                loss_fn=categorical_crossentropy, feature_out=feature_out)
+                loss_fn=categorical_crossentropy, feature_out=feature_out,
+                process_out=process_out)
+
+
+def fully_convolutional_features(network):
+    """
+    Builds a network that computes the features and the output of a
+    context window network for all frames of a song in one pass (see
+    dnn.fully_convolutional). Like in the context window network, the
+    features of a frame average the feature maps of its window.
+    :param network: output layer of the context window network
+    :return:        feature layer, output layer and input variable of the
+                    new network
+    """
+    layer_map = {}
+    fcn, input_var = fully_convolutional(network, layer_map)
+    feature_maps, window = layer_map[_feature_layer(network)]
+
+    # (1, channels, frames, 1) -> (frames, channels)
+    feature_fcn = lnn.layers.Pool2DLayer(
+        feature_maps, pool_size=window[1:], stride=(1, 1),
+        mode='average_inc_pad', name='window_mean')
+    feature_fcn = lnn.layers.DimshuffleLayer(feature_fcn, (2, 1, 3),
+                                             name='feature_frames')
+    feature_fcn = lnn.layers.reshape(feature_fcn, shape=([0], -1),
+                                     name='feature_flatten')
+
+    return feature_fcn, fcn, input_var
 
 
 def add_sacred_config(ex):
@@ -147,6 +181,9 @@ def add_sacred_config(ex):
         ),
         testing=dict(
             test_on_val=False,
-            batch_size=512
+            batch_size=512,
+            # no layer pads along time, so whole songs can be processed at
+            # once instead of context window by context window
+            fully_convolutional=True
         )
     )
@@ -35,10 +35,15 @@ def build_net(in_shape, out_size_chroma, out_size, model):
 def build_model(in_shape, out_size_chroma, out_size, model):
     (crm, crd, inv, crmv, crdv) = build_net(in_shape, out_size_chroma,
                                             out_size, model)
+    # chroma vectors and chord predictions in one pass, the chord classifier
+    # is computed from the chroma vectors
+    chroma_out, chord_out = lnn.layers.get_output([crm, crd],
+                                                  deterministic=True)
     return dict(chroma_network=crm, chord_network=crd,
                 input_var=inv, chroma_target_var=crmv, chord_target_var=crdv,
                 chroma_loss_fn=compute_loss,
-                chord_loss_fn=dnn.categorical_crossentropy)
+                chord_loss_fn=dnn.categorical_crossentropy,
+                chroma_out=chroma_out, chord_out=chord_out)
 
 
 create_iterators = dnn.create_iterators
@@ -5,6 +5,7 @@ import lasagne as lnn
 import spaghetti as spg
 
 from .. import augmenters
+from . import rnn
 
 
 class CrfLoss:
@@ -50,21 +51,21 @@ def build_model(in_shape, out_size, model):
                 mask_var=mask_var, loss_fn=loss_fn)
 
 
-def create_iterators(train_set, val_set, training, augmentation):
-    train_batches = dmgr.iterators.SequenceIterator(
-        train_set, training['batch_size'], randomise=True,
-        expand=True, max_seq_len=training['max_seq_len']
-    )
+def create_iterators(train_set, val_set, training, augmentation,
+                     num_classes=None):
+    train_batches = rnn.train_iterator(train_set, training)
 
     val_batches = dmgr.iterators.SequenceIterator(
         val_set, training['batch_size'], randomise=False,
         expand=False
     )
 
-    if augmentation is not None:
-        train_batches = dmgr.iterators.AugmentedIterator(
-            train_batches, *augmenters.create_augmenters(augmentation)
-        )
+    train_batches = augmenters.augment(train_batches, augmentation,
+                                       training.get('prefetch'), num_classes)
+    # no augmentation, but convert features stored in lower precision
+    # (and expand class id targets)
+    val_batches = augmenters.augment(val_batches, None,
+                                     num_classes=num_classes)
 
     return train_batches, val_batches
 
@@ -86,6 +87,7 @@ def add_sacred_config(ex):
             schedule=None
         ),
         training=dict(
+            iterator='SequenceIterator',
             batch_size=32,
             max_seq_len=1024,
             num_epochs=500,
@@ -99,5 +101,8 @@ def add_sacred_config(ex):
         testing=dict(
             test_on_val=False,
             batch_size=None,
+            # process several songs at once, in padded batches of at most
+            # this many frames
+            max_frames=50000,
         )
     )
@@ -4,6 +4,7 @@ import lasagne as lnn
 import dmgr
 
 from .. import augmenters
+from .. import iterators
 from . import blocks
 
 
@@ -57,18 +58,165 @@ def build_net(in_shape, out_size, model):
     return network, input_var, target_var
 
 
+def _time_pad(layer):
+    pad = layer.pad
+    if pad == 'same':
+        return layer.filter_size[0] // 2
+    elif pad == 'full':
+        return layer.filter_size[0] - 1
+    return pad[0]
+
+
+def fully_convolutional(network, layer_map=None):
+    """
+    Builds a network that computes the output of a context window network
+    for all frames of a song in one pass. Instead of recomputing the
+    convolutions for each (overlapping) context window, the layers are
+    applied once along the time axis of the zero-padded song: dense layers
+    become convolutions spanning the feature maps of one window, and global
+    pooling becomes pooling over the windows' extent. The new network shares
+    the parameters of the given one.
+
+    The output equals the output of the windowed network only if no layer
+    pads, strides or locally pools along time; for other networks, a
+    ValueError is raised.
+
+    :param network:   output layer of the context window network
+    :param layer_map: if given, dictionary that is filled with the layer of
+                      the new network and the shape of the feature maps of
+                      a single window (channels, time, bins) for each layer
+                      of the context window network
+    :return:          output layer and input variable of the new network.
+                      it takes the frames of a song (frames x features) and
+                      outputs one prediction per frame
+    """
+    layers = lnn.layers.get_all_layers(network)
+    in_shape = layers[0].shape[1:]
+    if len(in_shape) == 1:
+        in_shape = (1,) + in_shape
+    context_size = (in_shape[0] - 1) // 2
+
+    input_var = tt.matrix('song', dtype='float32')
+    fcn = lnn.layers.InputLayer(name='input', shape=(None, in_shape[1]),
+                                input_var=input_var)
+    fcn = lnn.layers.reshape(fcn, shape=(1, 1, -1, in_shape[1]),
+                             name='reshape')
+    fcn = lnn.layers.PadLayer(fcn, width=[(context_size, context_size),
+                                          (0, 0)], name='pad')
+
+    # shape of the feature maps computed from a single context window
+    window = (1,) + in_shape
+    # dense layers flatten the feature maps
+    flat = False
+    out_nl = None
+    if layer_map is None:
+        layer_map = {}
+    layer_map[layers[0]] = (fcn, window)
+
+    for layer in layers[1:]:
+        if out_nl is not None:
+            raise ValueError('Layer {} follows the softmax'.format(layer.name))
+
+        if isinstance(layer, lnn.layers.DropoutLayer):
+            pass
+
+        elif isinstance(layer, (lnn.layers.ReshapeLayer,
+                                lnn.layers.FlattenLayer)):
+            if len(layer.output_shape) == 2:
+                flat = True
+            elif tuple(layer.output_shape[1:]) != window:
+                raise ValueError('Cannot reshape {}'.format(layer.name))
+
+        elif isinstance(layer, lnn.layers.Conv2DLayer):
+            if flat or layer.untie_biases or layer.stride[0] != 1 or \
+                    _time_pad(layer) != 0:
+                raise ValueError('Layer {} pads or strides along '
+                                 'time'.format(layer.name))
+            pad = layer.pad
+            if not isinstance(pad, tuple):
+                pad = (0, {'same': layer.filter_size[1] // 2,
+                           'full': layer.filter_size[1] - 1}[pad])
+            fcn = lnn.layers.Conv2DLayer(
+                fcn, num_filters=layer.num_filters,
+                filter_size=layer.filter_size, stride=layer.stride,
+                pad=pad, W=layer.W, b=layer.b,
+                nonlinearity=layer.nonlinearity,
+                flip_filters=layer.flip_filters, name=layer.name)
+            window = tuple(layer.output_shape[1:])
+
+        elif isinstance(layer, lnn.layers.Pool2DLayer):
+            global_time = layer.pool_size[0] == window[1]
+            if flat or layer.pad[0] != 0 or not (
+                    global_time or layer.pool_size[0] == layer.stride[0] == 1):
+                raise ValueError('Layer {} pools locally along '
+                                 'time'.format(layer.name))
+            fcn = lnn.layers.Pool2DLayer(
+                fcn, pool_size=layer.pool_size,
+                stride=(1, layer.stride[1]), pad=layer.pad,
+                ignore_border=layer.ignore_border, mode=layer.mode,
+                name=layer.name)
+            window = tuple(layer.output_shape[1:])
+
+        elif isinstance(layer, lnn.layers.DenseLayer):
+            if layer.nonlinearity is lnn.nonlinearities.softmax:
+                out_nl = layer.nonlinearity
+            # the dense layer is a convolution with one filter per unit
+            # that covers the whole window
+            W = layer.W.T.reshape((layer.num_units,) + window)
+            fcn = lnn.layers.Conv2DLayer(
+                fcn, num_filters=layer.num_units, filter_size=window[1:],
+                W=W, b=layer.b, nonlinearity=(
+                    None if out_nl is not None else layer.nonlinearity),
+                flip_filters=False, name=layer.name)
+            window = (layer.num_units, 1, 1)
+            flat = True
+
+        elif isinstance(layer, lnn.layers.BatchNormLayer):
+            if layer.axes != (0,) + tuple(range(2, len(layer.input_shape))):
+                raise ValueError('Cannot convert {}'.format(layer.name))
+            fcn = lnn.layers.BatchNormLayer(
+                fcn, axes=(0, 2, 3), epsilon=layer.epsilon,
+                alpha=layer.alpha, beta=layer.beta, gamma=layer.gamma,
+                mean=layer.mean, inv_std=layer.inv_std, name=layer.name)
+
+        elif isinstance(layer, lnn.layers.NonlinearityLayer):
+            if layer.nonlinearity is lnn.nonlinearities.softmax:
+                out_nl = layer.nonlinearity
+            else:
+                fcn = lnn.layers.NonlinearityLayer(
+                    fcn, nonlinearity=layer.nonlinearity, name=layer.name)
+
+        else:
+            raise ValueError('Cannot convert {} ({})'.format(
+                layer.name, type(layer).__name__))
+
+        layer_map[layer] = (fcn, window)
+
+    if window[1] != 1:
+        raise ValueError('Network does not output a single frame per window')
+
+    # (1, channels, frames, bins) -> (frames, channels * bins)
+    fcn = lnn.layers.DimshuffleLayer(fcn, (2, 1, 3), name='frames')
+    fcn = lnn.layers.reshape(fcn, shape=([0], -1), name='flatten')
+    if out_nl is not None:
+        fcn = lnn.layers.NonlinearityLayer(fcn, nonlinearity=out_nl,
+                                           name='output')
+
+    return fcn, input_var
+
+
 def train_iterator(train_set, training):
     it = training.get('iterator', 'BatchIterator')
 
     if it == 'BatchIterator':
-        return dmgr.iterators.BatchIterator(
+        return iterators.FrameBatchIterator(
             train_set, training['batch_size'], randomise=True,
             expand=True
         )
     elif it == 'ClassBalancedIterator':
-        return dmgr.iterators.UniformClassIterator(
+        return iterators.CopiedBatches(dmgr.iterators.UniformClassIterator(
             train_set, training['batch_size']
-        )
+        ))
     else:
         raise ValueError('Unknown Batch Iterator: {}'.format(it))
 
@@ -79,16 +227,19 @@ def build_model(in_shape, out_size, model):
                 loss_fn=categorical_crossentropy)
 
 
-def create_iterators(train_set, val_set, training, augmentation):
+def create_iterators(train_set, val_set, training, augmentation,
+                     num_classes=None):
     train_batches = train_iterator(train_set, training)
-    val_batches = dmgr.iterators.BatchIterator(
+    val_batches = iterators.FrameBatchIterator(
         val_set, training['batch_size'], randomise=False, expand=True
     )
 
-    if augmentation is not None:
-        train_batches = dmgr.iterators.AugmentedIterator(
-            train_batches, *augmenters.create_augmenters(augmentation)
-        )
+    train_batches = augmenters.augment(train_batches, augmentation,
+                                       training.get('prefetch'), num_classes)
+    # no augmentation, but convert features stored in lower precision
+    # (and expand class id targets)
+    val_batches = augmenters.augment(val_batches, None,
+                                     num_classes=num_classes)
 
     return train_batches, val_batches
 
@@ -4,6 +4,7 @@ import dmgr
 import lasagne as lnn
 
 from .. import augmenters
+from .. import iterators
 from . import blocks
 
 
@@ -62,21 +63,39 @@ def build_model(in_shape, out_size, model):
                 mask_var=mask_var, loss_fn=compute_loss)
 
 
-def create_iterators(train_set, val_set, training, augmentation):
-    train_batches = dmgr.iterators.SequenceIterator(
-        train_set, training['batch_size'], randomise=True,
-        expand=True, max_seq_len=training['max_seq_len']
-    )
+def train_iterator(train_set, training):
+    it = training.get('iterator', 'SequenceIterator')
+
+    # 'BatchIterator' is what older configurations specify
+    if it in ('SequenceIterator', 'BatchIterator'):
+        return dmgr.iterators.SequenceIterator(
+            train_set, training['batch_size'], randomise=True,
+            expand=True, max_seq_len=training['max_seq_len']
+        )
+    elif it == 'BucketedSequenceIterator':
+        return iterators.BucketedSequenceIterator(
+            train_set, training['batch_size'], randomise=True,
+            max_seq_len=training['max_seq_len']
+        )
+    else:
+        raise ValueError('Unknown Batch Iterator: {}'.format(it))
+
+
+def create_iterators(train_set, val_set, training, augmentation,
+                     num_classes=None):
+    train_batches = train_iterator(train_set, training)
 
     val_batches = dmgr.iterators.SequenceIterator(
         val_set, training['batch_size'], randomise=False,
         expand=False
     )
 
-    if augmentation is not None:
-        train_batches = dmgr.iterators.AugmentedIterator(
-            train_batches, *augmenters.create_augmenters(augmentation)
-        )
+    train_batches = augmenters.augment(train_batches, augmentation,
+                                       training.get('prefetch'), num_classes)
+    # no augmentation, but convert features stored in lower precision
+    # (and expand class id targets)
+    val_batches = augmenters.augment(val_batches, None,
+                                     num_classes=num_classes)
 
     return train_batches, val_batches
 
@@ -114,7 +133,10 @@ def add_sacred_config(ex):
             l2=1e-4,
         ),
         testing=dict(
-            test_on_val=False
+            test_on_val=False,
+            # process several songs at once, in padded batches of at most
+            # this many frames
+            max_frames=50000
         )
     )
 
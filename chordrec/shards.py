@@ -0,0 +1,213 @@
+"""
+Feature shards store the features (or targets) of many songs in one file.
+
+A shard consists of two files:
+
+    <base>.shard.npy   all songs concatenated along the first (time) axis,
+                       stored as a regular .npy file
+    <base>.shard.json  index mapping each song name to the [start, stop)
+                       range of its frames
+
+The shard of a feature (or target) is stored next to the directory holding
+its per-song files, e.g. feature_cache/<dataset>/<name>.shard.npy for the
+files in feature_cache/<dataset>/<name>/. Shards are opened with a single
+read-only memory map, and the data of a song is a view into it.
+"""
+import os
+import json
+import tempfile
+import numpy as np
+
+SHARD_EXT = '.shard.npy'
+INDEX_EXT = '.shard.json'
+
+# reserved size of the .npy header, so we can write the final shape after
+# all songs have been added
+HEADER_SIZE = 256
+
+# shards opened by this process
+_shards = {}
+
+
+def shard_file(song_file, ext):
+    """
+    Determines the shard that may contain the data of a song file
+    :param song_file: per-song file, e.g. <cache>/<dataset>/<name>/<song><ext>
+    :param ext:       extension of the per-song file
+    :return:          song name and shard file
+    """
+    song = os.path.basename(song_file)[:-len(ext)]
+    return song, os.path.dirname(song_file) + SHARD_EXT
+
+
+def _header(dtype, shape):
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                   'fortran_order': False, 'shape': shape})
+    # magic string (6 bytes), version (2 bytes), header length (2 bytes)
+    header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+    if len(header) != HEADER_SIZE - 10:
+        raise ValueError('Shape {} is too long for the header'.format(shape))
+    return (np.lib.format.magic(1, 0) +
+            np.array(len(header), dtype='<u2').tostring() + header)
+
+
+class ShardWriter(object):
+
+    def __init__(self, base):
+        """
+        Writes a shard song by song, without keeping the data in memory.
+        The shard becomes visible when the writer is closed.
+        :param base: shard file name without extension
+        """
+        self.data_file = base + SHARD_EXT
+        self.index_file = base + INDEX_EXT
+        self.index = {}
+        self.dtype = None
+        self.frame_shape = None
+        self.num_frames = 0
+
+        shard_dir = os.path.dirname(self.data_file)
+        if shard_dir and not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+
+        self._file = tempfile.NamedTemporaryFile(dir=shard_dir or None,
+                                                 suffix='.tmp', delete=False)
+        self._file.write(' ' * HEADER_SIZE)
+
+    @property
+    def files(self):
+        return [self.data_file, self.index_file]
+
+    def add(self, song, data):
+        """
+        Adds the data of a song
+        :param song: song name
+        :param data: data of the song (frames along the first axis)
+        """
+        data = np.ascontiguousarray(data)
+        if self.dtype is None:
+            self.dtype = data.dtype
+            self.frame_shape = data.shape[1:]
+        elif data.dtype != self.dtype or data.shape[1:] != self.frame_shape:
+            raise ValueError('Data of {} does not match the shard: {} {} '
+                             'instead of {} {}'.format(
+                                 song, data.dtype, data.shape[1:],
+                                 self.dtype, self.frame_shape))
+        if song in self.index:
+            raise ValueError('{} is already in the shard'.format(song))
+
+        self._file.write(data.tostring())
+        self.index[song] = [self.num_frames, self.num_frames + len(data)]
+        self.num_frames += len(data)
+
+    def close(self):
+        """
+        Writes header and index, and moves the shard to its destination
+        """
+        if self.dtype is None:
+            self.dtype = np.dtype(np.float32)
+            self.frame_shape = ()
+
+        self._file.seek(0)
+        self._file.write(_header(self.dtype,
+                                 (self.num_frames,) + self.frame_shape))
+        self._file.close()
+
+        # the index is written last, readers only open shards with an index
+        os.rename(self._file.name, self.data_file)
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(self.index_file) or None,
+                suffix='.tmp', delete=False) as f:
+            json.dump(self.index, f)
+        os.rename(f.name, self.index_file)
+        _shards.pop(self.data_file, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._file.name)
+
+
+class Shard(object):
+
+    def __init__(self, data_file):
+        """
+        Opens a shard read-only memory-mapped
+        :param data_file: shard data file (<base>.shard.npy)
+        """
+        self.data_file = data_file
+        index_file = data_file[:-len(SHARD_EXT)] + INDEX_EXT
+        with open(index_file) as f:
+            self.index = json.load(f)
+        self.data = np.load(data_file, mmap_mode='r')
+        self.mtime = os.path.getmtime(index_file)
+
+    @property
+    def songs(self):
+        return sorted(self.index)
+
+    def __contains__(self, song):
+        return song in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, song):
+        start, stop = self.index[song]
+        return self.data[start:stop]
+
+
+def open_shard(data_file):
+    """
+    Opens a shard, or returns it if it is already open in this process
+    :param data_file: shard data file
+    :return:          Shard, or None if the shard does not exist
+    """
+    if data_file not in _shards:
+        index_file = data_file[:-len(SHARD_EXT)] + INDEX_EXT
+        if not os.path.exists(index_file):
+            return None
+        _shards[data_file] = Shard(data_file)
+    return _shards[data_file]
+
+
+def lookup(song_file, ext):
+    """
+    Looks up the data of a song file in its shard. Songs whose file is newer
+    than the shard (e.g. because features were recomputed) are ignored.
+    :param song_file: per-song file
+    :param ext:       extension of the per-song file
+    :return:          data of the song (memory-mapped), or None
+    """
+    song, data_file = shard_file(song_file, ext)
+    shard = open_shard(data_file)
+    if shard is None or song not in shard:
+        return None
+    if os.path.exists(song_file) and \
+            os.path.getmtime(song_file) > shard.mtime:
+        return None
+    return shard[song]
+
+
+def pack(song_files, ext, base=None):
+    """
+    Writes per-song files into a shard
+    :param song_files: per-song files (all in the same directory)
+    :param ext:        extension of the per-song files
+    :param base:       shard file name without extension. if None, it is
+                       derived from the directory of the song files
+    :return:           files of the shard
+    """
+    if base is None:
+        base = shard_file(song_files[0], ext)[1][:-len(SHARD_EXT)]
+
+    with ShardWriter(base) as writer:
+        for song_file in sorted(song_files):
+            writer.add(os.path.basename(song_file)[:-len(ext)],
+                       np.load(song_file, mmap_mode='r'))
+    return writer.files
@@ -21,6 +21,36 @@ def one_hot(class_ids, num_classes):
     return oh
 
 
+def assign_segments(start, end, times):
+    """
+    Finds the segment [start, end) each time point falls into. Each time
+    point has to fall into exactly one segment.
+    :param start: start times of the segments
+    :param end:   end times of the segments
+    :param times: time points to assign
+    :return:      index of the segment for each time point
+    """
+    # empty segments cannot contain any time point
+    segments = np.flatnonzero(start < end)
+    segments = segments[np.argsort(start[segments], kind='mergesort')]
+    seg_start = start[segments]
+    seg_end = end[segments]
+
+    if (seg_end[:-1] > seg_start[1:]).any():
+        # overlapping segments. this should not happen for proper
+        # annotations, so we use the slow but simple way here
+        in_segment = ((start <= times[:, np.newaxis]) &
+                      (times[:, np.newaxis] < end))
+        assert (in_segment.sum(axis=1) == 1).all()
+        return np.nonzero(in_segment)[1]
+
+    # segments do not overlap, so the only segment that can contain a time
+    # point is the last one starting before (or at) it
+    idx = np.searchsorted(seg_start, times, side='right') - 1
+    assert (idx >= 0).all() and (times < seg_end[idx]).all()
+    return segments[idx]
+
+
 class IntervalAnnotationTarget(object):
 
     def __init__(self, fps, num_classes):
@@ -41,14 +71,22 @@ class IntervalAnnotationTarget(object):
     def _dummy_target(self):
         raise NotImplementedError('Implement this.')
 
+    def _encode(self, targets):
+        """
+        Encodes the targets per frame for storage and training
+        :param targets: targets per frame
+        :return:        encoded targets per frame
+        """
+        return targets.astype(np.float32)
+
     def __call__(self, target_file, num_frames=None):
         """
-        Creates one-hot encodings from an annotation file.
+        Creates targets per frame from an annotation file.
 
         :param target_file: file containing time annotations
         :param num_frames:  number of frames in the audio file. if None,
                             estimate from the end of last annotation
-        :return:            one-hot ground truth per frame
+        :return:            ground truth per frame
         """
         ann = np.loadtxt(target_file,
                          comments=None,
@@ -64,9 +102,9 @@ class IntervalAnnotationTarget(object):
         # we will add a dummy class at the end and at the beginning,
         # because some annotations miss it, are not exactly aligned at the end
         # or do not start at the beginning of an audio file
-        targets = np.vstack((self._dummy_target(),
-                             self._annotations_to_targets(ann['label']),
-                             self._dummy_target()))
+        targets = np.concatenate(([self._dummy_target()],
+                                  self._annotations_to_targets(ann['label']),
+                                  [self._dummy_target()]))
 
         # add the times for the dummy events
         start = np.hstack(([-np.inf], ann['start'], ann['end'][-1]))
@@ -83,14 +121,9 @@ class IntervalAnnotationTarget(object):
         end = np.round(end, decimals=3)
         frame_times = np.round(frame_times, decimals=3)
 
-        target_per_frame = ((start <= frame_times[:, np.newaxis]) &
-                            (frame_times[:, np.newaxis] < end))
-
-        # make sure each frame is assigned to only one target vector
-        assert (target_per_frame.sum(axis=1) == 1).all()
-
-        # create the one hot vectors per frame
-        return targets[np.nonzero(target_per_frame)[1]].astype(np.float32)
+        # create the targets per frame. this makes sure each frame
+        # is assigned to exactly one target
+        return self._encode(targets[assign_segments(start, end, frame_times)])
 
     def write_chord_predictions(self, filename, predictions):
         with open(filename, 'w') as f:
@@ -98,27 +131,49 @@ class IntervalAnnotationTarget(object):
                           for p in self._targets_to_annotations(predictions)])
 
 
-class ChordsMajMin(IntervalAnnotationTarget):
+class ChordTarget(IntervalAnnotationTarget):
 
-    def __init__(self, fps):
+    def __init__(self, fps, num_classes, class_ids=False):
+        """
+        Targets for chord classification. Per frame, these are either
+        one-hot vectors or compact integer class ids.
+        :param fps:         frames per second
+        :param num_classes: number of chord classes, including 'no chord'
+        :param class_ids:   store integer class ids instead of one-hot
+                            vectors. they need to be expanded before being
+                            fed to a network (see augmenters.OneHotTargets)
+        """
+        super(ChordTarget, self).__init__(fps, num_classes)
+        self.class_ids = class_ids
+
+    def _dummy_target(self):
+        # 'no chord' is always the last class
+        return self.num_classes - 1
+
+    def _encode(self, targets):
+        if self.class_ids:
+            return targets.astype(np.int16)
+        else:
+            return one_hot(targets, self.num_classes)
+
+
+class ChordsMajMin(ChordTarget):
+
+    def __init__(self, fps, class_ids=False):
         # 25 classes - 12 minor, 12 major, one "No Chord"
-        super(ChordsMajMin, self).__init__(fps, 25)
+        super(ChordsMajMin, self).__init__(fps, 25, class_ids)
 
     @property
     def name(self):
-        return 'chords_majmin_fps={}'.format(self.fps)
-
-    def _dummy_target(self):
-        dt = np.zeros(self.num_classes, dtype=np.float32)
-        dt[-1] = 1
-        return dt
+        return 'chords_majmin_fps={}'.format(self.fps) + \
+            ('_ids' if self.class_ids else '')
 
     def _annotations_to_targets(self, labels):
         """
         Maps chord annotations to 25 classes (12 major, 12 minor, 1 no chord)
 
         :param labels: chord labels
-        :return: one-hot encoding of class id per annotation
+        :return: class id per annotation
         """
         # first, create chord/class mapping. root note 'A' has id 0, increasing
         # with each semitone. we have duplicate mappings for flat and sharp
@@ -134,9 +189,8 @@ class ChordsMajMin(IntervalAnnotationTarget):
         # 'no chord'
         root_note_map = dict(natural + sharp + flat + [('N', 24), ('X', 24)])
 
-        # then, we load the annotations, map the chords to class ids, and
-        # finally map class ids to a one-hot encoding. first, map the root
-        # notes.
+        # then, we load the annotations and map the chords to class ids.
+        # first, map the root notes.
         chord_root_notes = [c.split(':')[0].split('/')[0] for c in labels]
         chord_root_note_ids = np.array([root_note_map[crn]
                                         for crn in chord_root_notes])
@@ -156,8 +210,7 @@ class ChordsMajMin(IntervalAnnotationTarget):
         )
 
         # now we can compute the final chord class id
-        return one_hot(chord_root_note_ids + chord_type_shift,
-                       self.num_classes)
+        return chord_root_note_ids + chord_type_shift
 
     def _targets_to_annotations(self, targets):
         natural = zip([0, 2, 3, 5, 7, 8, 10], string.uppercase[:7])
@@ -191,20 +244,16 @@ class ChordsMajMin(IntervalAnnotationTarget):
         return zip(start_times, end_times, chord_labels)
 
 
-class ChordsRoot(IntervalAnnotationTarget):
+class ChordsRoot(ChordTarget):
 
-    def __init__(self, fps):
+    def __init__(self, fps, class_ids=False):
         # 13 classes - 12 semitones and "no chord"
-        super(ChordsRoot, self).__init__(fps, 13)
+        super(ChordsRoot, self).__init__(fps, 13, class_ids)
 
     @property
     def name(self):
-        return 'chords_root_fps={}'.format(self.fps)
-
-    def _dummy_target(self):
-        dt = np.zeros(self.num_classes, dtype=np.float32)
-        dt[-1] = 1
-        return dt
+        return 'chords_root_fps={}'.format(self.fps) + \
+            ('_ids' if self.class_ids else '')
 
     def _annotations_to_targets(self, labels):
         """
@@ -227,14 +276,13 @@ class ChordsRoot(IntervalAnnotationTarget):
         # 'no chord'
         root_note_map = dict(natural + sharp + flat + [('N', 12), ('X', 12)])
 
-        # then, we load the annotations, map the chords to class ids, and
-        # finally map class ids to a one-hot encoding. first, map the root
-        # notes.
+        # then, we load the annotations and map the chords to class ids.
+        # first, map the root notes.
         chord_root_notes = [c.split(':')[0].split('/')[0] for c in labels]
         chord_root_note_ids = np.array([root_note_map[crn]
                                         for crn in chord_root_notes])
 
-        return one_hot(chord_root_note_ids, self.num_classes)
+        return chord_root_note_ids
 
     def _targets_to_annotations(self, targets):
         natural = zip([0, 2, 3, 5, 7, 8, 10], string.uppercase[:7])
@@ -262,20 +310,16 @@ class ChordsRoot(IntervalAnnotationTarget):
         return zip(start_times, end_times, chord_labels)
 
 
-class ChordsMajMinSevenths(IntervalAnnotationTarget):
+class ChordsMajMinSevenths(ChordTarget):
 
-    def __init__(self, fps):
+    def __init__(self, fps, class_ids=False):
         # 73 classes - maj, 7, maj7, min, min7 minmaj7 with 12 each, 1 no chord
-        super(ChordsMajMinSevenths, self).__init__(fps, 73)
+        super(ChordsMajMinSevenths, self).__init__(fps, 73, class_ids)
 
     @property
     def name(self):
-        return 'chords_majminsevenths_fps={}'.format(self.fps)
-
-    def _dummy_target(self):
-        dt = np.zeros(self.num_classes, dtype=np.float32)
-        dt[-1] = 1
-        return dt
+        return 'chords_majminsevenths_fps={}'.format(self.fps) + \
+            ('_ids' if self.class_ids else '')
 
     def _annotations_to_targets(self, labels):
         root, semis, _ = mir_eval.chord.encode_many(labels, True)
@@ -299,7 +343,7 @@ class ChordsMajMinSevenths(IntervalAnnotationTarget):
         class_ids[seventh] += 12
         class_ids[maj_seventh] += 24
 
-        return one_hot(class_ids, self.num_classes)
+        return class_ids
 
     def _targets_to_annotations(self, targets):
         natural = zip([0, 2, 3, 5, 7, 8, 10], string.uppercase[:7])
@@ -380,6 +424,14 @@ def add_sacred_config(ex):
             params=dict()
         )
     )
+    # combine with one of the chord targets above to store compact class
+    # ids instead of one-hot vectors
+    ex.add_named_config(
+        'class_ids',
+        target=dict(
+            params=dict(class_ids=True)
+        )
+    )
 
 
 def create_target(fps, config):
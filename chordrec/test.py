@@ -6,12 +6,16 @@ import numpy as np
 from dmgr.iterators import iterate_batches
 from nn.utils import Colors
 
+from datasources import ContextWindowDataSource
+from iterators import iterate_songs
+
 
 PREDICTION_EXT = '.chords.txt'
 
 
 def compute_labeling(process_fn, target, agg_dataset, dest_dir, use_mask,
-                     batch_size=None, extension='.chords.txt'):
+                     batch_size=None, extension='.chords.txt',
+                     max_frames=None, song_fn=None, outputs=None):
     """
     Computes and saves the labels for each datasource in an aggragated
     datasource
@@ -22,6 +26,14 @@ def compute_labeling(process_fn, target, agg_dataset, dest_dir, use_mask,
     :param use_mask:    if the network is an rnn
     :param batch_size:  Batch size if each datasource is to be processed batch-wise
     :param extension:   file extension of the resulting files
+    :param max_frames:  if the network is an rnn, process several songs at
+                        once in padded batches of at most this many frames
+    :param song_fn:     if given, function that gives the nn's output for
+                        all frames of a song at once. used instead of
+                        process_fn for songs served as context windows
+    :param outputs:     if given, the nn's output for each song (as stored
+                        by experiment.compute_features), which is used
+                        instead of computing it again
     :return:            list of files containing the predictions
     """
     if not os.path.exists(dest_dir):
@@ -32,11 +44,35 @@ def compute_labeling(process_fn, target, agg_dataset, dest_dir, use_mask,
                   file=sys.stderr)
             return
 
-    pred_files = []
+    pred_files = [None] * agg_dataset.n_datasources
+
+    def save(ds_idx, pred):
+        ds = agg_dataset.datasource(ds_idx)
+        pred_file = os.path.join(dest_dir, ds.name + extension)
+        target.write_chord_predictions(pred_file, pred)
+        pred_files[ds_idx] = pred_file
+
+    if outputs is not None:
+        for ds_idx in range(agg_dataset.n_datasources):
+            save(ds_idx, outputs[ds_idx].argmax(axis=1))
+
+        return pred_files
+
+    if use_mask and max_frames:
+        for ds_idxs, data, mask in iterate_songs(agg_dataset, max_frames):
+            p = process_fn(data, mask)
+            for j, ds_idx in enumerate(ds_idxs):
+                save(ds_idx, p[j, :int(mask[j].sum())].argmax(axis=1))
+
+        return pred_files
 
     for ds_idx in range(agg_dataset.n_datasources):
         ds = agg_dataset.datasource(ds_idx)
 
+        if song_fn is not None and isinstance(ds, ContextWindowDataSource):
+            save(ds_idx, song_fn(ds.data).argmax(axis=1))
+            continue
+
         pred = []
         for data, _ in iterate_batches(ds, batch_size or ds.n_data,
                                        randomise=False, expand=False):
@@ -50,11 +86,7 @@ def compute_labeling(process_fn, target, agg_dataset, dest_dir, use_mask,
 
             pred.append(p.argmax(axis=1))
 
-        pred = np.concatenate(pred)
-
-        pred_file = os.path.join(dest_dir, ds.name + extension)
-        target.write_chord_predictions(pred_file, pred)
-        pred_files.append(pred_file)
+        save(ds_idx, np.concatenate(pred))
 
     return pred_files
 
@@ -0,0 +1,173 @@
+"""
+Viterbi decoding of linear-chain conditional random fields in NumPy.
+
+The CRF is parametrised like spaghetti's CrfLayer and madmom's
+ConditionalRandomField, i.e. by the tuple (pi, tau, c, A, W) stored in the
+parameter files of trained crf models:
+
+    pi   initial potentials (states)
+    tau  final potentials (states)
+    c    state biases (states)
+    A    transition potentials (states x states, from x to)
+    W    observation weights (features x states)
+
+All songs of a batch are decoded at once, so the maximisation over the
+predecessors of all states of all songs is a single NumPy operation per
+frame. FixedLagViterbi decodes a stream of frames online, with a fixed
+delay.
+"""
+import collections
+
+import numpy as np
+
+
+def viterbi(observations, pi, tau, c, A, W, mask=None, beam_width=None):
+    """
+    Decodes the most probable state sequences of a batch of sequences
+    :param observations: observations (sequences x frames x features)
+    :param pi:           initial potentials
+    :param tau:          final potentials
+    :param c:            state biases
+    :param A:            transition potentials (from x to)
+    :param W:            observation weights (features x states)
+    :param mask:         mask (sequences x frames), valid frames of each
+                         sequence first. if None, all frames are valid
+    :param beam_width:   if given, only continue paths from the beam_width
+                         best states of each frame. this makes decoding of
+                         large vocabularies faster, but the path found is
+                         not guaranteed to be the most probable one
+    :return:             state sequences (sequences x frames). the states of
+                         masked frames are 0
+    """
+    observations = np.asarray(observations)
+    batch_size, num_frames = observations.shape[:2]
+    num_states = len(pi)
+    if mask is None:
+        lengths = np.full(batch_size, num_frames, dtype=np.int64)
+    else:
+        lengths = np.asarray(mask).sum(axis=1).astype(np.int64)
+    if beam_width is not None and beam_width >= num_states:
+        beam_width = None
+
+    scores = np.dot(observations.reshape(batch_size, num_frames, -1), W) + c
+    bt_pointers = np.zeros((batch_size, num_frames, num_states),
+                           dtype=np.uint32)
+    seqs = np.arange(batch_size)[:, np.newaxis]
+    v = np.repeat(pi[np.newaxis], batch_size, axis=0)
+    # transitions to y from x in A_to[y, x], so the maximisation over the
+    # predecessors runs along the contiguous last axis
+    A_to = np.ascontiguousarray(A.T)
+
+    for i in range(int(lengths.max()) if batch_size else 0):
+        if beam_width is None:
+            # all_trans[s, y, x]: score of the best path of sequence s
+            # that reaches state y through state x
+            all_trans = A_to + v[:, np.newaxis, :]
+            bt = np.argmax(all_trans, axis=2)
+        else:
+            beam = np.argpartition(-v, beam_width - 1,
+                                   axis=1)[:, :beam_width]
+            all_trans = A_to[:, beam].transpose(1, 0, 2) + \
+                v[seqs, beam][:, np.newaxis, :]
+            bt = beam[seqs, np.argmax(all_trans, axis=2)]
+        # (pointers of sequences that have ended are never followed)
+        bt_pointers[:, i] = bt
+        new_v = scores[:, i] + np.max(all_trans, axis=2)
+
+        # sequences that have ended keep their scores
+        if i < lengths.min():
+            v = new_v
+        else:
+            v = np.where((i < lengths)[:, np.newaxis], new_v, v)
+
+    v += tau
+
+    paths = np.zeros((batch_size, num_frames), dtype=np.uint32)
+    ended = lengths > 0
+    state = np.argmax(v, axis=1)
+    paths[ended, lengths[ended] - 1] = state[ended]
+    for i in range(num_frames - 1)[::-1]:
+        active = i + 1 < lengths
+        state = np.where(active, bt_pointers[seqs[:, 0], i + 1, state], state)
+        paths[active, i] = state[active]
+
+    return paths
+
+
+class FixedLagViterbi(object):
+
+    def __init__(self, pi, tau, c, A, W, lag):
+        """
+        Decodes a single sequence online: after each frame, the state of
+        the frame `lag` frames earlier is decided, based on the best path
+        to the current frame. Memory and latency are bounded by the lag.
+        The decisions can differ from the Viterbi path of the whole
+        sequence, which also depends on the frames after the lag (and the
+        final potentials).
+        :param pi:  initial potentials
+        :param tau: final potentials
+        :param c:   state biases
+        :param A:   transition potentials (from x to)
+        :param W:   observation weights (features x states)
+        :param lag: number of frames a decision lags behind the input
+        """
+        self.pi = pi
+        self.tau = tau
+        self.c = c
+        self.W = W
+        self.lag = lag
+        self._A_to = np.ascontiguousarray(A.T)
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new sequence
+        """
+        self._v = self.pi.copy()
+        # back tracking pointers of the last lag frames
+        self._bt_pointers = collections.deque(maxlen=self.lag)
+
+    def _backtrack(self, state, num_steps):
+        states = [state]
+        pointers = list(self._bt_pointers)[::-1]
+        for bt in pointers[:num_steps]:
+            states.append(bt[states[-1]])
+        return states
+
+    def process(self, observations):
+        """
+        Processes the next frames of the sequence
+        :param observations: observations of the frames (frames x features)
+        :return:             states decided after these frames. there is
+                             one per frame once the first `lag` frames are
+                             processed
+        """
+        observations = np.asarray(observations)
+        if len(observations) == 0:
+            # e.g. an empty chunk of a stream
+            return np.empty(0, dtype=np.uint32)
+        scores = np.dot(observations.reshape(len(observations), -1),
+                        self.W) + self.c
+        states = []
+        for frame_scores in scores:
+            all_trans = self._A_to + self._v
+            bt = np.argmax(all_trans, axis=1)
+            self._v = frame_scores + np.max(all_trans, axis=1)
+            full = len(self._bt_pointers) == self.lag
+            self._bt_pointers.append(bt)
+            if full:
+                states.append(self._backtrack(np.argmax(self._v),
+                                              self.lag)[-1])
+        return np.array(states, dtype=np.uint32)
+
+    def finish(self):
+        """
+        Ends the sequence
+        :return: states of the frames not decided yet, following the
+                 Viterbi path that ends at the last frame
+        """
+        num_open = len(self._bt_pointers)
+        states = self._backtrack(np.argmax(self._v + self.tau),
+                                 num_open - 1)[::-1] if num_open else []
+        self.reset()
+        return np.array(states, dtype=np.uint32)
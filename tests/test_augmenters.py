@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from chordrec import augmenters, targets
+
+
+def shifted_classes(class_ids, shifts, num_classes=25):
+    shifts = shifts.reshape(shifts.shape + (1,) * (class_ids.ndim - 1))
+    expected = (class_ids % 12 + shifts) % 12 + class_ids // 12 * 12
+    expected[class_ids == num_classes - 1] = num_classes - 1
+    return expected
+
+
+def test_semitone_shift_one_hot_sequences():
+    rng = np.random.RandomState(0)
+    class_ids = rng.randint(0, 25, size=(4, 7))
+    class_ids[0, :3] = 24
+    one_hot = targets.one_hot(class_ids.ravel(), 25).reshape(
+        class_ids.shape + (25,))
+    shifts = np.array([-4, 0, 1, 3])
+
+    shifter = augmenters.SemitoneShift(p=1.0, max_shift=4,
+                                       bins_per_semitone=2)
+    new_targets = shifter.adapt_targets(one_hot, shifts)
+
+    assert new_targets.shape == one_hot.shape
+    assert (new_targets.sum(axis=-1) == 1).all()
+    assert (new_targets.argmax(axis=-1) ==
+            shifted_classes(class_ids, shifts)).all()
+
+
+def test_semitone_shift_class_ids():
+    rng = np.random.RandomState(1)
+    class_ids = rng.randint(0, 25, size=(4, 7)).astype(np.int16)
+    shifts = np.array([2, -1, 0, 4])
+
+    shifter = augmenters.SemitoneShift(p=1.0, max_shift=4,
+                                       bins_per_semitone=2, num_classes=25)
+    new_targets = shifter.adapt_targets(class_ids, shifts)
+
+    assert new_targets.dtype == class_ids.dtype
+    assert (new_targets == shifted_classes(class_ids, shifts)).all()
+
+
+def test_semitone_shift_batches():
+    # each frame has a single active bin; its position tells the shift
+    rng = np.random.RandomState(2)
+    num_bins = 48
+    data = np.zeros((8, 5, num_bins), dtype=np.float32)
+    data[..., 10] = 1
+    class_ids = rng.randint(0, 25, size=(8, 5))
+    one_hot = targets.one_hot(class_ids.ravel(), 25).reshape(
+        class_ids.shape + (25,))
+    mask = np.ones((8, 5), dtype=np.float32)
+
+    shifter = augmenters.SemitoneShift(p=1.0, max_shift=4,
+                                       bins_per_semitone=2)
+    new_data, new_targets, new_mask = next(
+        shifter(iter([(data, one_hot, mask)])))
+
+    shifts = (new_data[:, 0].argmax(axis=-1) - 10) // 2
+    assert (new_mask == mask).all()
+    assert (new_targets.argmax(axis=-1) ==
+            shifted_classes(class_ids, shifts)).all()
+
+
+def test_class_id_targets_augmented():
+    # class id targets from the config, shifted and expanded to one-hot
+    # vectors by the augmentation chain of the training iterators
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ann_file = os.path.join(tmp_dir, 'song.chords')
+        with open(ann_file, 'w') as f:
+            f.write('0.0\t1.0\tC:maj\n1.0\t2.0\tA:min\n2.0\t3.0\tN\n')
+        config = dict(name='ChordsMajMin', params=dict(class_ids=True))
+        target = targets.create_target(10, config)
+        class_ids = target(ann_file, 30)
+        one_hot = targets.create_target(10, dict(config, params={}))(
+            ann_file, 30)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    assert class_ids.dtype.kind == 'i'
+    assert (class_ids == one_hot.argmax(axis=-1)).all()
+
+    data = np.zeros((2, 30, 48), dtype=np.float32)
+    data[..., 10] = 1
+    batch_targets = np.stack([class_ids, class_ids[::-1]])
+    mask = np.ones((2, 30), dtype=np.float32)
+    augmentation = dict(SemitoneShift=dict(p=1.0, max_shift=4,
+                                           bins_per_semitone=2))
+
+    batches = augmenters.augment([(data, batch_targets, mask)], augmentation,
+                                 num_classes=target.num_classes)
+    new_data, new_targets, _ = next(iter(batches))
+
+    shifts = (new_data[:, 0].argmax(axis=-1) - 10) // 2
+    assert new_targets.shape == (2, 30, 25)
+    assert new_targets.dtype == np.float32
+    assert (new_targets.argmax(axis=-1) ==
+            shifted_classes(batch_targets, shifts)).all()
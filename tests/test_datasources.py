@@ -0,0 +1,93 @@
+import numpy as np
+
+from chordrec import datasources
+
+
+def reference_windows(data, context_size):
+    padded = np.pad(data, [(context_size, context_size)] +
+                    [(0, 0)] * (data.ndim - 1), mode='constant')
+    return np.stack([padded[i:i + 2 * context_size + 1]
+                     for i in range(len(data))])
+
+
+def random_songs(lengths, context_size, seed=0):
+    rng = np.random.RandomState(seed)
+    return [datasources.ContextWindowDataSource(
+        rng.rand(n, 6).astype(np.float32),
+        rng.randint(0, 25, n).astype(np.int16), context_size, name=str(i))
+        for i, n in enumerate(lengths)]
+
+
+def test_gather_zero_fills_borders():
+    # songs shorter than, as long as and longer than a window
+    for ds in random_songs([1, 3, 9, 10, 40], context_size=4):
+        expected = reference_windows(ds.data, 4)
+        assert ds.gather(np.arange(ds.n_data)).shape == \
+            (ds.n_data, 9, 6)
+        assert (ds.gather(np.arange(ds.n_data)) == expected).all()
+        idxs = np.random.RandomState(1).randint(0, ds.n_data, 7)
+        assert (ds.gather(idxs) == expected[idxs]).all()
+
+
+def test_gather_into_out():
+    ds = random_songs([20], context_size=2)[0]
+    out = np.ones((5, 5, 6), dtype=np.float32)
+    result = ds.gather([0, 1, 7, 18, 19], out=out)
+    assert result is out
+    assert (out == reference_windows(ds.data, 2)[[0, 1, 7, 18, 19]]).all()
+
+
+def test_context_window_indexing():
+    ds = random_songs([12], context_size=3)[0]
+    expected = reference_windows(ds.data, 3)
+    data, targets = ds[5]
+    assert (data == expected[5]).all() and targets == ds.targets[5]
+    data, targets = ds[2:9:3]
+    assert (data == expected[2:9:3]).all()
+    assert (targets == ds.targets[2:9:3]).all()
+
+
+def test_aggregated_batches():
+    songs = random_songs([2, 15, 1, 40, 7], context_size=3)
+    agg = datasources.AggregatedContextWindows(songs)
+    all_data = np.concatenate([reference_windows(ds.data, 3) for ds in songs])
+    all_targets = np.concatenate([ds.targets for ds in songs])
+    assert agg.n_data == len(all_data)
+
+    rng = np.random.RandomState(2)
+    for _ in range(20):
+        idxs = rng.choice(agg.n_data, 16, replace=False)
+        # sorted batches gather the frames of each song in place, others
+        # are regrouped by song
+        for batch in (np.sort(idxs), idxs):
+            data, targets = agg[batch]
+            assert (data == all_data[batch]).all()
+            assert (targets == all_targets[batch]).all()
+
+    for item in (slice(3, 30), slice(None, None, 4), slice(50, 10, -3)):
+        data, targets = agg[item]
+        assert (data == all_data[item]).all()
+        assert (targets == all_targets[item]).all()
+
+    for item in (0, 17, agg.n_data - 1, -1):
+        data, targets = agg[item]
+        assert (data == all_data[item]).all()
+        assert targets == all_targets[item]
+
+
+def test_aggregated_reuses_batch_arrays():
+    songs = random_songs([10, 20], context_size=1)
+    agg = datasources.AggregatedContextWindows(songs)
+    first, first_targets = agg[np.arange(0, 8)]
+    expected = np.array(first)
+
+    second, second_targets = agg[np.arange(12, 20)]
+    # a batch of the same size overwrites the previous one
+    assert second is first and second_targets is first_targets
+    assert not (first == expected).all()
+    expected = np.array(second)
+
+    # batches of other sizes have their own arrays
+    other, _ = agg[np.arange(0, 4)]
+    assert other is not first
+    assert (second == expected).all()
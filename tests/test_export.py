@@ -0,0 +1,397 @@
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from chordrec import export
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def reference_conv2d(x, W, b, pad, stride, flip_filters):
+    if flip_filters:
+        W = W[:, :, ::-1, ::-1]
+    x = np.pad(x, [(0, 0), (0, 0), (pad[0], pad[0]), (pad[1], pad[1])],
+               mode='constant')
+    rows, cols = W.shape[2:]
+    out_rows = (x.shape[2] - rows) // stride[0] + 1
+    out_cols = (x.shape[3] - cols) // stride[1] + 1
+    out = np.zeros((len(x), len(W), out_rows, out_cols))
+    for n in range(len(x)):
+        for f in range(len(W)):
+            for i in range(out_rows):
+                for j in range(out_cols):
+                    r, c = i * stride[0], j * stride[1]
+                    out[n, f, i, j] = (x[n, :, r:r + rows, c:c + cols] *
+                                       W[f]).sum() + b[f]
+    return out
+
+
+def pool_len(length, pool, stride, pad, ignore_border):
+    # output length of theano's pool_2d
+    if ignore_border:
+        return (length + 2 * pad - pool) // stride + 1
+    if stride >= pool:
+        return (length - 1) // stride + 1
+    return max(0, (length - 1 - pool + stride) // stride) + 1
+
+
+def reference_pool2d(x, pool_size, stride, pad, ignore_border, mode):
+    rows, cols = x.shape[2:]
+    out_shape = [pool_len(x.shape[2 + d], pool_size[d], stride[d], pad[d],
+                          ignore_border) for d in range(2)]
+    out = np.zeros(x.shape[:2] + tuple(out_shape))
+    for i in range(out_shape[0]):
+        for j in range(out_shape[1]):
+            r, c = i * stride[0] - pad[0], j * stride[1] - pad[1]
+            window = x[:, :, max(r, 0):r + pool_size[0],
+                       max(c, 0):c + pool_size[1]]
+            if mode == 'max':
+                out[:, :, i, j] = window.max(axis=(2, 3))
+            elif mode == 'average_exc_pad':
+                out[:, :, i, j] = window.mean(axis=(2, 3))
+            else:
+                # padding counts, the border of the data does not
+                num_rows = (min(r + pool_size[0], rows + pad[0]) -
+                            max(r, -pad[0]))
+                num_cols = (min(c + pool_size[1], cols + pad[1]) -
+                            max(c, -pad[1]))
+                out[:, :, i, j] = (window.sum(axis=(2, 3)) /
+                                   float(num_rows * num_cols))
+    return out
+
+
+def reference_recurrent(x, mask, step, states, backwards):
+    # runs a single sequence step by step, masked steps keep the states
+    outputs = np.zeros((len(x), len(states[-1])))
+    steps = range(len(x))
+    for t in (steps[::-1] if backwards else steps):
+        if mask[t]:
+            states = step(x[t], *states)
+        outputs[t] = states[-1]
+    return outputs
+
+
+def reference_viterbi(observations, pi, tau, c, A, W):
+    scores = np.dot(observations, W) + c
+    v = pi.copy()
+    bt_pointers = []
+    for frame_scores in scores:
+        all_trans = A + v[:, np.newaxis]
+        bt_pointers.append(np.argmax(all_trans, axis=0))
+        v = frame_scores + np.max(all_trans, axis=0)
+    v += tau
+
+    path = [np.argmax(v)]
+    for bt in bt_pointers[:0:-1]:
+        path.append(bt[path[-1]])
+    return np.array(path[::-1])
+
+
+def random_mask(batch_size, num_steps, rng):
+    lengths = rng.randint(1, num_steps + 1, batch_size)
+    lengths[0] = num_steps
+    return (np.arange(num_steps) < lengths[:, np.newaxis]).astype(np.float32)
+
+
+def test_conv2d():
+    rng = np.random.RandomState(0)
+    x = rng.randn(2, 3, 9, 11).astype(np.float32)
+    W = rng.randn(4, 3, 3, 2).astype(np.float32)
+    b = rng.randn(4).astype(np.float32)
+    for pad, stride, flip_filters in [((0, 0), (1, 1), True),
+                                      ((1, 1), (1, 1), False),
+                                      ((2, 0), (2, 3), True)]:
+        out = export._conv2d(x, W, b, pad, stride, flip_filters)
+        assert np.allclose(out, reference_conv2d(x, W, b, pad, stride,
+                                                 flip_filters), atol=1e-4)
+
+    # untied biases
+    b = rng.randn(4, 7, 10).astype(np.float32)
+    out = export._conv2d(x, W, b, (0, 0), (1, 1), False)
+    expected = reference_conv2d(x, W, np.zeros(4), (0, 0), (1, 1), False)
+    assert np.allclose(out, expected + b, atol=1e-4)
+
+
+def test_pool2d():
+    rng = np.random.RandomState(1)
+    x = rng.randn(2, 3, 9, 11).astype(np.float32)
+    configs = [((2, 2), (2, 2), (0, 0), True),
+               ((3, 2), (2, 1), (0, 0), True),
+               ((3, 3), (2, 2), (0, 0), False),
+               ((2, 4), (3, 4), (0, 0), False),
+               ((3, 3), (1, 2), (1, 1), True)]
+    for pool_size, stride, pad, ignore_border in configs:
+        for mode in ('max', 'average_exc_pad', 'average_inc_pad'):
+            out = export._pool2d(x, pool_size, stride, pad, ignore_border,
+                                 mode)
+            expected = reference_pool2d(x, pool_size, stride, pad,
+                                        ignore_border, mode)
+            assert out.shape == expected.shape
+            assert np.allclose(out, expected, atol=1e-5)
+
+
+def test_batchnorm():
+    rng = np.random.RandomState(2)
+    x = rng.randn(4, 3, 5, 6).astype(np.float32)
+    mean, gamma, beta = rng.randn(3, 3).astype(np.float32)
+    std = rng.rand(3).astype(np.float32) + .5
+    out = export._batchnorm(x, [0, 2, 3], mean, 1. / std, gamma, beta)
+    expected = ((x - mean[:, None, None]) / std[:, None, None] *
+                gamma[:, None, None] + beta[:, None, None])
+    assert np.allclose(out, expected, atol=1e-5)
+
+    # normalisation of dense layer outputs
+    x = rng.randn(4, 3).astype(np.float32)
+    out = export._batchnorm(x, [0], mean, 1. / std, gamma, beta)
+    assert np.allclose(out, (x - mean) / std * gamma + beta, atol=1e-5)
+
+
+def test_recurrent():
+    rng = np.random.RandomState(3)
+    x = rng.randn(3, 8, 5).astype(np.float32)
+    mask = random_mask(3, 8, rng)
+    p = dict(W_in=rng.randn(5, 4), b=rng.randn(4), W_hid=rng.randn(4, 4) * .5,
+             hid_init=rng.randn(4))
+    p = {k: v.astype(np.float32) for k, v in p.items()}
+
+    def step(x_t, hid):
+        return [np.tanh(np.dot(x_t, p['W_in']) + p['b'] +
+                        np.dot(hid, p['W_hid']))]
+
+    for backwards in (False, True):
+        layer = dict(nonlinearity='tanh', backwards=backwards)
+        out = export._recurrent(x, mask, layer, p)
+        for s in range(len(x)):
+            expected = reference_recurrent(x[s], mask[s], step,
+                                           [p['hid_init']], backwards)
+            assert np.allclose(out[s], expected, atol=1e-5)
+
+
+def test_lstm():
+    rng = np.random.RandomState(4)
+    x = rng.randn(3, 8, 5).astype(np.float32)
+    mask = random_mask(3, 8, rng)
+    p = dict(cell_init=rng.randn(4), hid_init=rng.randn(4))
+    for gate in export.LSTM_GATES:
+        p['W_in_' + gate] = rng.randn(5, 4)
+        p['W_hid_' + gate] = rng.randn(4, 4) * .5
+        p['b_' + gate] = rng.randn(4)
+        if gate != 'cell':
+            p['W_cell_' + gate] = rng.randn(4)
+    p = {k: v.astype(np.float32) for k, v in p.items()}
+
+    def gate(name, x_t, hid):
+        return (np.dot(x_t, p['W_in_' + name]) + p['b_' + name] +
+                np.dot(hid, p['W_hid_' + name]))
+
+    for peepholes in (False, True):
+        def step(x_t, cell, hid):
+            peep = {g: (p['W_cell_' + g] if peepholes else 0)
+                    for g in ('ingate', 'forgetgate', 'outgate')}
+            i = sigmoid(gate('ingate', x_t, hid) + cell * peep['ingate'])
+            f = sigmoid(gate('forgetgate', x_t, hid) +
+                        cell * peep['forgetgate'])
+            cell = f * cell + i * np.tanh(gate('cell', x_t, hid))
+            o = sigmoid(gate('outgate', x_t, hid) + cell * peep['outgate'])
+            return [cell, o * np.tanh(cell)]
+
+        for backwards in (False, True):
+            layer = dict(nonlinearity='tanh', backwards=backwards,
+                         peepholes=peepholes, nonlinearity_ingate='sigmoid',
+                         nonlinearity_forgetgate='sigmoid',
+                         nonlinearity_cell='tanh',
+                         nonlinearity_outgate='sigmoid')
+            out = export._lstm(x, mask, layer, p)
+            for s in range(len(x)):
+                expected = reference_recurrent(
+                    x[s], mask[s], step, [p['cell_init'], p['hid_init']],
+                    backwards)
+                assert np.allclose(out[s], expected, atol=1e-5)
+
+
+def test_crf():
+    rng = np.random.RandomState(5)
+    x = rng.randn(3, 12, 6)
+    mask = random_mask(3, 12, rng)
+    p = dict(pi=rng.randn(7), tau=rng.randn(7), c=rng.randn(7),
+             A=rng.randn(7, 7), W=rng.randn(6, 7))
+    out = export._crf(x, mask, {}, p)
+
+    assert out.shape == (3, 12, 7)
+    for s in range(len(x)):
+        n = int(mask[s].sum())
+        assert (out[s, :n].sum(axis=1) == 1).all()
+        assert (out[s, :n].argmax(axis=1) ==
+                reference_viterbi(x[s, :n], **p)).all()
+        assert (out[s, n:] == 0).all()
+
+
+def dense_conv_network(rng):
+    graph = [
+        dict(type='input', role='data', inputs=[], name='input'),
+        dict(type='reshape', shape=[-1, 1, 5, 8], inputs=[0],
+             name='reshape'),
+        dict(type='conv2d', pad=[1, 1], stride=[1, 1], flip_filters=True,
+             nonlinearity='rectify', inputs=[1], name='conv'),
+        dict(type='batchnorm', axes=[0, 2, 3], inputs=[2], name='bn'),
+        dict(type='pool2d', pool_size=[1, 2], stride=[1, 2], pad=[0, 0],
+             ignore_border=True, mode='max', inputs=[3], name='pool'),
+        dict(type='flatten', outdim=2, inputs=[4], name='flatten'),
+        dict(type='dense', num_leading_axes=1, nonlinearity='softmax',
+             inputs=[5], name='output'),
+    ]
+
+    def f(*shape):
+        return rng.randn(*shape).astype(np.float32)
+
+    params = [{}, {}, dict(W=f(4, 1, 3, 3), b=f(4)),
+              dict(mean=f(4), inv_std=np.abs(f(4)) + .5, gamma=f(4),
+                   beta=f(4)),
+              {}, {}, dict(W=f(80, 6), b=f(6))]
+    return export.Network(graph, params)
+
+
+def test_save_load():
+    rng = np.random.RandomState(6)
+    network = dense_conv_network(rng)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'network.npz')
+        export.save(filename, network)
+
+        # the documented format
+        with np.load(filename) as f:
+            assert int(f['format_version']) == export.FORMAT_VERSION
+            assert json.loads(str(f['graph'])) == network.graph
+            assert set(f.files) == set(
+                ['format_version', 'graph'] +
+                ['{}_{}'.format(i, name)
+                 for i, p in enumerate(network.params) for name in p])
+            assert (f['2_W'] == network.params[2]['W']).all()
+
+        loaded = export.load(filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    assert loaded.graph == network.graph
+    for p, q in zip(network.params, loaded.params):
+        assert sorted(p) == sorted(q)
+        assert all((p[name] == q[name]).all() for name in p)
+
+    x = rng.randn(10, 5, 8).astype(np.float32)
+    out = loaded(x)
+    assert out.shape == (10, 6)
+    assert np.allclose(out, network(x))
+    assert np.allclose(out.sum(axis=1), 1, atol=1e-5)
+
+
+def test_quantize_scales():
+    rng = np.random.RandomState(8)
+    network = dense_conv_network(rng)
+    calibration = [rng.randn(10, 5, 8).astype(np.float32) for _ in range(3)]
+    quantized = export.quantize(network, calibration)
+
+    # the original network is left as it is
+    assert network.params[2]['W'].dtype == np.float32
+    assert 'in_scale' not in network.graph[2]
+
+    conv_W = network.params[2]['W']
+    dense_W = network.params[6]['W']
+    for i, w_max in ((2, np.abs(conv_W).reshape(4, -1).max(axis=1)),
+                     (6, np.abs(dense_W).max(axis=0))):
+        p = quantized.params[i]
+        assert p['W'].dtype == np.int8
+        assert p['W'].shape == network.params[i]['W'].shape
+        # one scale per output channel, so that the largest weight of each
+        # channel maps to 127
+        assert np.allclose(p['W_scale'], w_max / 127.)
+
+    assert (np.abs(quantized.params[2]['W']).reshape(4, -1).max(axis=1) ==
+            127).all()
+    assert (np.abs(quantized.params[6]['W']).max(axis=0) == 127).all()
+    assert np.allclose(np.int8(quantized.params[2]['W']) *
+                       quantized.params[2]['W_scale'][:, None, None, None],
+                       conv_W, atol=quantized.params[2]['W_scale'].max() / 2)
+
+    # the input scales are calibrated on the inputs the layers get
+    outputs = [network.outputs(x) for x in calibration]
+    for i in (2, 6):
+        max_abs = max(np.abs(out[network.graph[i]['inputs'][0]]).max()
+                      for out in outputs)
+        assert np.isclose(quantized.graph[i]['in_scale'], max_abs / 127.)
+
+    # layers without weights are kept
+    for i in (0, 1, 3, 4, 5):
+        assert quantized.graph[i] == network.graph[i]
+
+
+def test_quantize_error():
+    rng = np.random.RandomState(9)
+    graph = [dict(type='input', role='data', inputs=[], name='input'),
+             dict(type='dense', num_leading_axes=1, nonlinearity='linear',
+                  inputs=[0], name='output')]
+    W = rng.randn(40, 25).astype(np.float32)
+    network = export.Network(graph, [{}, dict(W=W, b=rng.randn(25))])
+    x = rng.randn(100, 40).astype(np.float32)
+    quantized = export.quantize(network, [x])
+
+    # each input and weight is off by at most half of its scale, which
+    # bounds the error of each output
+    in_scale = quantized.graph[1]['in_scale']
+    w_scale = quantized.params[1]['W_scale']
+    bound = (np.dot(np.abs(x), np.ones_like(W)) * w_scale / 2 +
+             np.abs(W).sum(axis=0) * in_scale / 2 +
+             len(W) * in_scale * w_scale / 4)
+    error = np.abs(quantized(x) - network(x))
+    assert (error <= bound * 1.001 + 1e-5).all()
+    assert error.max() > 0
+
+    # the classifications of the quantised network hardly change
+    network = dense_conv_network(rng)
+    x = rng.randn(200, 5, 8).astype(np.float32)
+    out = network(x)
+    q_out = export.quantize(network, [x])(x)
+    assert np.abs(q_out - out).mean() < 0.01
+    assert (q_out.argmax(axis=1) == out.argmax(axis=1)).mean() > 0.95
+
+
+def test_export_matches_theano():
+    lnn = pytest.importorskip('lasagne')
+    import theano
+    import theano.tensor as tt
+
+    rng = np.random.RandomState(7)
+    input_var = tt.tensor3('input', dtype='float32')
+    net = lnn.layers.InputLayer((None, 5, 8), input_var=input_var)
+    net = lnn.layers.reshape(net, (-1, 1, 5, 8))
+    net = lnn.layers.Conv2DLayer(net, num_filters=4, filter_size=(3, 3),
+                                 pad='same')
+    net = lnn.layers.BatchNormLayer(net)
+    net = lnn.layers.Pool2DLayer(net, pool_size=(1, 2))
+    net = lnn.layers.DropoutLayer(net)
+    net = lnn.layers.DenseLayer(net, num_units=6,
+                                nonlinearity=lnn.nonlinearities.softmax)
+    for param in lnn.layers.get_all_params(net):
+        value = param.get_value()
+        param.set_value(rng.rand(*value.shape).astype(value.dtype) + .5
+                        if param.name == 'inv_std' else
+                        rng.randn(*value.shape).astype(value.dtype))
+    process_fn = theano.function(
+        [input_var], lnn.layers.get_output(net, deterministic=True))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'network.npz')
+        export.export(filename, net, input_var)
+        network = export.load(filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    x = rng.randn(20, 5, 8).astype(np.float32)
+    assert np.allclose(network(x), process_fn(x), atol=1e-5)
@@ -0,0 +1,118 @@
+import numpy as np
+
+from chordrec import datasources, iterators
+
+
+def songs(lengths, seed=0):
+    rng = np.random.RandomState(seed)
+    return datasources.AggregatedContextWindows([
+        datasources.ContextWindowDataSource(
+            rng.rand(n, 6).astype(np.float32),
+            rng.randint(0, 25, n).astype(np.int16), 0, name=str(i))
+        for i, n in enumerate(lengths)
+    ])
+
+
+def check_crops(agg, batches, max_seq_len):
+    crops = sorted(crop for batch in batches for crop in batch)
+    for i in range(agg.n_datasources):
+        bounds = [(start, stop) for j, start, stop in crops if j == i]
+        assert bounds[0][0] == 0
+        assert bounds[-1][1] == agg.datasource(i).n_data
+        for (_, stop), (start, _) in zip(bounds[:-1], bounds[1:]):
+            assert stop == start
+        assert all(0 < stop - start <= max_seq_len for start, stop in bounds)
+    return crops
+
+
+def test_bucketed_crops_move_between_epochs():
+    agg = songs([5, 30, 47, 100, 8, 64] * 10)
+    it = iterators.BucketedSequenceIterator(agg, 4, 16, pool_size=3,
+                                            report=False, seed=1)
+    epochs = []
+    for _ in range(4):
+        num_batches = len(it)
+        batches = it.plan()
+        assert len(batches) == num_batches
+        assert all(0 < len(batch) <= 4 for batch in batches)
+        epochs.append(check_crops(agg, batches, 16))
+    assert len(set(map(tuple, epochs))) == len(epochs)
+
+
+def test_bucketed_pools_sort_by_length():
+    agg = songs([5, 30, 47, 100, 8, 64] * 10)
+    # a single pool holds all crops, so the batches cut the crops sorted by
+    # length into consecutive runs
+    it = iterators.BucketedSequenceIterator(agg, 4, 16, pool_size=1000,
+                                            report=False, seed=2)
+    batches = it.plan()
+    check_crops(agg, batches, 16)
+    ranges = sorted((min(stop - start for _, start, stop in batch),
+                     max(stop - start for _, start, stop in batch))
+                    for batch in batches)
+    for (_, upper), (lower, _) in zip(ranges[:-1], ranges[1:]):
+        assert upper <= lower
+    assert sum(len(batch) < 4 for batch in batches) <= 1
+
+
+def test_bucketed_in_order_without_randomise():
+    agg = songs([5, 30, 47])
+    it = iterators.BucketedSequenceIterator(agg, 2, 16, randomise=False,
+                                            report=False)
+    for _ in range(2):
+        assert len(it) == 3
+        assert it.plan() == [[(0, 0, 5), (1, 0, 16)],
+                             [(1, 16, 30), (2, 0, 16)],
+                             [(2, 16, 32), (2, 32, 47)]]
+
+
+def test_bucketed_same_seed_same_plan():
+    agg = songs([5, 30, 47, 100, 8])
+    plans = [iterators.BucketedSequenceIterator(
+        agg, 2, 16, pool_size=2, report=False, seed=3).plan()
+        for _ in range(2)]
+    assert plans[0] == plans[1]
+
+
+def test_bucketed_assemble():
+    agg = songs([5, 30, 47])
+    it = iterators.BucketedSequenceIterator(agg, 3, 16, report=False,
+                                            seed=4)
+    crops = [(0, 0, 5), (2, 20, 36), (1, 3, 10)]
+    data, targets, mask = it.assemble(crops)
+
+    assert data.shape == (3, 16, 1, 6)
+    assert targets.shape == (3, 16)
+    for j, (i, start, stop) in enumerate(crops):
+        ds = agg.datasource(i)
+        n = stop - start
+        assert (data[j, :n, 0] == ds.data[start:stop]).all()
+        assert (targets[j, :n] == ds.targets[start:stop]).all()
+        assert (data[j, n:] == 0).all()
+        assert (mask[j, :n] == 1).all() and (mask[j, n:] == 0).all()
+
+
+def test_iterate_songs():
+    lengths = [5, 30, 47, 100, 8, 64, 12]
+    agg = songs(lengths)
+    seen = []
+    for song_idxs, data, mask in iterators.iterate_songs(agg, 100):
+        longest = lengths[song_idxs[0]]
+        assert data.shape[:2] == mask.shape == (len(song_idxs), longest)
+        assert len(song_idxs) == 1 or data.shape[0] * longest <= 100
+        for j, i in enumerate(song_idxs):
+            assert lengths[i] <= longest
+            assert (data[j, :lengths[i], 0] == agg.datasource(i).data).all()
+            assert (data[j, lengths[i]:] == 0).all()
+            assert mask[j].sum() == lengths[i]
+        seen += song_idxs
+    assert sorted(seen) == list(range(len(lengths)))
+    # longest songs first
+    assert [lengths[i] for i in seen] == sorted(lengths, reverse=True)
+
+
+def test_iterate_songs_subset():
+    agg = songs([5, 30, 47, 100, 8])
+    seen = [i for song_idxs, _, _ in iterators.iterate_songs(
+        agg, 60, song_idxs=[4, 1, 2]) for i in song_idxs]
+    assert seen == [2, 1, 4]
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from chordrec import datasources
+
+
+def randomise(params, rng):
+    for param in params:
+        value = param.get_value()
+        param.set_value(rng.rand(*value.shape).astype(value.dtype) + .5
+                        if param.name == 'inv_std' else
+                        rng.randn(*value.shape).astype(value.dtype) * .5)
+
+
+def windows(song, context_size):
+    return datasources.ContextWindowDataSource(
+        song, np.zeros(len(song), dtype=np.int16), context_size
+    ).gather(np.arange(len(song)))
+
+
+def conv_block(num_filters, pool_size):
+    return dict(num_layers=1, num_filters=num_filters, filter_size=(3, 3),
+                pad='valid', pool_size=pool_size, dropout=0.5,
+                batch_norm=True)
+
+
+def test_fully_convolutional_dense():
+    lnn = pytest.importorskip('lasagne')
+    import theano
+    from chordrec.models import dnn
+
+    rng = np.random.RandomState(0)
+    model = dict(conv=dict(conv1=conv_block(3, (1, 2)),
+                           conv2=conv_block(4, (1, 2))),
+                 dense=dict(num_layers=1, num_units=7, batch_norm=True,
+                            nonlinearity='rectify', dropout=0.5),
+                 out_nonlinearity='softmax')
+    network, input_var, _ = dnn.build_net((9, 16), 5, model)
+    randomise(lnn.layers.get_all_params(network), rng)
+    process_fn = theano.function(
+        [input_var], lnn.layers.get_output(network, deterministic=True))
+
+    song_net, song_var = dnn.fully_convolutional(network)
+    song_fn = theano.function(
+        [song_var], lnn.layers.get_output(song_net, deterministic=True))
+
+    # songs shorter and longer than a context window
+    for length in (1, 3, 50):
+        song = rng.randn(length, 16).astype(np.float32)
+        out = song_fn(song)
+        assert out.shape == (length, 5)
+        assert np.allclose(out, process_fn(windows(song, 4)), atol=1e-5)
+
+
+def test_fully_convolutional_gap_features():
+    lnn = pytest.importorskip('lasagne')
+    import theano
+    from chordrec.models import avg_gap_feature
+
+    rng = np.random.RandomState(1)
+    model = dict(conv=dict(conv1=conv_block(3, (1, 2)),
+                           conv2=conv_block(4, None)),
+                 gap=dict(batch_norm=True, gap_nonlinearity='linear'),
+                 out_nonlinearity='softmax')
+    net = avg_gap_feature.build_model((7, 12), 5, model)
+    randomise(lnn.layers.get_all_params(net['network']), rng)
+    process_fn = theano.function([net['input_var']],
+                                 [net['feature_out'], net['process_out']])
+
+    feature_net, song_net, song_var = \
+        avg_gap_feature.fully_convolutional_features(net['network'])
+    song_fn = theano.function([song_var], lnn.layers.get_output(
+        [feature_net, song_net], deterministic=True))
+
+    for length in (2, 40):
+        song = rng.randn(length, 12).astype(np.float32)
+        features, out = song_fn(song)
+        expected_features, expected_out = process_fn(windows(song, 3))
+        assert features.shape == (length, 4)
+        assert np.allclose(features, expected_features, atol=1e-5)
+        assert np.allclose(out, expected_out, atol=1e-5)
+
+
+def test_fully_convolutional_rejects_time_padding():
+    pytest.importorskip('lasagne')
+    from chordrec.models import dnn
+
+    model = dict(conv=dict(conv1=dict(conv_block(3, None), pad='same')),
+                 out_nonlinearity='softmax')
+    network, _, _ = dnn.build_net((7, 12), 5, model)
+    with pytest.raises(ValueError):
+        dnn.fully_convolutional(network)
@@ -0,0 +1,118 @@
+import numpy as np
+
+from chordrec import viterbi
+
+
+def random_crf(num_states, num_features, rng):
+    return (rng.randn(num_states), rng.randn(num_states),
+            rng.randn(num_states), rng.randn(num_states, num_states) * 3,
+            rng.randn(num_features, num_states) * .3)
+
+
+def reference_viterbi(observations, pi, tau, c, A, W):
+    # decodes a single song like madmom's ConditionalRandomField
+    scores = np.dot(observations, W) + c
+    v = pi.copy()
+    bt_pointers = []
+    for frame_scores in scores:
+        all_trans = A + v[:, np.newaxis]
+        bt_pointers.append(np.argmax(all_trans, axis=0))
+        v = frame_scores + np.max(all_trans, axis=0)
+    v += tau
+
+    path = [np.argmax(v)]
+    for bt in bt_pointers[:0:-1]:
+        path.append(bt[path[-1]])
+    return np.array(path[::-1])
+
+
+def test_viterbi_matches_per_song_decoding():
+    rng = np.random.RandomState(0)
+    for num_states in (25, 73):
+        crf = random_crf(num_states, 12, rng)
+        observations = rng.randn(6, 40, 12)
+        # ragged songs, including a single frame and a full-length one
+        lengths = np.array([40, 1, 17, 33, 2, 40])
+        mask = (np.arange(40) < lengths[:, np.newaxis]).astype(np.float32)
+
+        paths = viterbi.viterbi(observations, *crf, mask=mask)
+
+        assert paths.shape == (6, 40) and paths.dtype == np.uint32
+        for obs, path, n in zip(observations, paths, lengths):
+            assert (path[:n] == reference_viterbi(obs[:n], *crf)).all()
+            assert (path[n:] == 0).all()
+
+
+def test_viterbi_without_mask():
+    rng = np.random.RandomState(1)
+    crf = random_crf(25, 12, rng)
+    observations = rng.randn(3, 20, 12)
+    paths = viterbi.viterbi(observations, *crf)
+    for obs, path in zip(observations, paths):
+        assert (path == reference_viterbi(obs, *crf)).all()
+
+
+def test_viterbi_full_beam_is_exact():
+    rng = np.random.RandomState(2)
+    for num_states in (25, 73):
+        crf = random_crf(num_states, 12, rng)
+        observations = rng.randn(4, 30, 12)
+        lengths = np.array([30, 9, 21, 3])
+        mask = (np.arange(30) < lengths[:, np.newaxis]).astype(np.float32)
+
+        exact = viterbi.viterbi(observations, *crf, mask=mask)
+        for beam_width in (num_states, num_states + 5):
+            assert (viterbi.viterbi(observations, *crf, mask=mask,
+                                    beam_width=beam_width) == exact).all()
+
+
+def test_viterbi_beam_paths_are_valid():
+    rng = np.random.RandomState(3)
+    crf = random_crf(73, 12, rng)
+    observations = rng.randn(2, 25, 12)
+    mask = np.ones((2, 25), dtype=np.float32)
+    mask[1, 10:] = 0
+    paths = viterbi.viterbi(observations, *crf, mask=mask, beam_width=10)
+    assert paths.shape == (2, 25)
+    assert (paths < 73).all() and (paths[1, 10:] == 0).all()
+
+
+def test_fixed_lag_long_lag_reproduces_viterbi():
+    rng = np.random.RandomState(4)
+    crf = random_crf(25, 12, rng)
+    song = rng.randn(50, 12)
+    full = viterbi.viterbi(song[np.newaxis], *crf)[0]
+
+    for lag in (50, 80):
+        decoder = viterbi.FixedLagViterbi(*crf, lag=lag)
+        # chunks of a stream, some of them empty
+        chunks = np.split(song, [0, 7, 7, 30, 49])
+        online = [decoder.process(chunk) for chunk in chunks]
+        assert sum(len(states) for states in online) == 0
+        assert (decoder.finish() == full).all()
+
+
+def test_fixed_lag_one_state_per_frame():
+    rng = np.random.RandomState(5)
+    crf = random_crf(25, 12, rng)
+    song = rng.randn(40, 12)
+
+    for lag in (0, 1, 5):
+        decoder = viterbi.FixedLagViterbi(*crf, lag=lag)
+        online = []
+        for i in range(len(song)):
+            states = decoder.process(song[i:i + 1])
+            assert len(states) == (1 if i >= lag else 0)
+            online.append(states)
+        assert len(decoder.process(song[:0])) == 0
+        rest = decoder.finish()
+        assert len(rest) == lag
+        assert len(np.concatenate(online + [rest])) == len(song)
+
+
+def test_fixed_lag_empty_chunk():
+    rng = np.random.RandomState(6)
+    decoder = viterbi.FixedLagViterbi(*random_crf(25, 12, rng), lag=3)
+    states = decoder.process(np.empty((0, 12)))
+    assert states.shape == (0,) and states.dtype == np.uint32
+    assert len(decoder.finish()) == 0
@@ -0,0 +1,110 @@
+"""
+compare_loading.py
+
+    Compares loading the data of an experiment into memory with opening it
+    memory-mapped. For each mode, a fresh process creates the data sources of
+    a fold and reports the time this took and its memory usage. Resident
+    memory (RSS) includes pages shared with other processes, private memory
+    only counts pages no other process can use. With --epoch, the process
+    also iterates once over the training set, which touches every page.
+
+    The operating system caches files, so run the tool twice and look at the
+    second run to compare without disk access.
+
+Usage:
+    compare_loading.py [options] <config>
+
+Arguments:
+    <config>  experiment configuration file (yaml)
+
+Options:
+    -f=<fold>        test fold [default: 0]
+    -b=<batch_size>  batch size for iterating the training set [default: 512]
+    --epoch          iterate once over the training set
+"""
+from __future__ import print_function
+
+import time
+import multiprocessing
+
+import yaml
+from docopt import docopt
+
+import dmgr
+from chordrec import data, features, targets
+
+
+def memory_usage():
+    """
+    Memory usage of this process in MB (Linux only)
+    :return: resident and private memory
+    """
+    usage = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Private_Clean:', 'Private_Dirty:'):
+                usage[fields[0]] = int(fields[1]) / 1024.
+
+    return (usage['Rss:'],
+            usage['Private_Clean:'] + usage['Private_Dirty:'])
+
+
+def measure(cfg, memory_mapped, test_fold, batch_size, epoch, results):
+    ds_cfg = cfg['datasource']
+    fe = features.create_extractor(cfg['feature_extractor'], test_fold)
+    session = data.DatasetSession(
+        dataset_names=ds_cfg['datasets'],
+        preprocessors=ds_cfg.get('preprocessors', []),
+        compute_targets=targets.create_target(fe.fps, cfg['target']),
+        context_size=ds_cfg.get('context_size', 0),
+        memory_mapped=memory_mapped
+    )
+
+    start = time.time()
+    train_set, _, _, _ = session.datasources(fe, test_fold=test_fold)
+    result = {'load_time': time.time() - start}
+    result['rss'], result['private'] = memory_usage()
+
+    if epoch:
+        start = time.time()
+        for _ in dmgr.iterators.iterate_batches(train_set, batch_size,
+                                                randomise=True):
+            pass
+        result['epoch_time'] = time.time() - start
+        result['epoch_rss'], result['epoch_private'] = memory_usage()
+
+    results.put(result)
+
+
+def main():
+    args = docopt(__doc__)
+    cfg = yaml.load(open(args['<config>']))
+
+    # make sure all features are computed, so we only measure loading
+    fe = features.create_extractor(cfg['feature_extractor'], int(args['-f']))
+    for name in cfg['datasource']['datasets']:
+        data.precompute(name, data.DATA_DIR, data.CACHE_DIR, fe,
+                        targets.create_target(fe.fps, cfg['target']))
+
+    for memory_mapped in [False, True]:
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=measure,
+            args=(cfg, memory_mapped, int(args['-f']), int(args['-b']),
+                  args['--epoch'], results))
+        p.start()
+        r = results.get()
+        p.join()
+
+        print('memory-mapped' if memory_mapped else 'eager')
+        print('  startup: {:.2f}s, rss: {:.0f} MB, private: {:.0f} MB'.format(
+            r['load_time'], r['rss'], r['private']))
+        if args['--epoch']:
+            print('  epoch:   {:.2f}s, rss: {:.0f} MB, private: {:.0f} MB'
+                  .format(r['epoch_time'], r['epoch_rss'],
+                          r['epoch_private']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+export_model.py
+
+    Exports a trained network to a NumPy inference graph (see
+    chordrec.export), which can be run without Theano and Lasagne.
+
+    With --optimize, the exported network is simplified for inference
+    (batch normalisations folded into the weights, nonlinearity layers
+    merged, needless reshapes removed, see chordrec.export.optimize). The
+    tool reports the floating point operations per frame and the time it
+    takes to process the test set before and after.
+
+    With --check, the tool also compiles the Theano function of the network,
+    processes the test set of the fold with both, and compares their
+    outputs. It reports the time until each is ready to process the first
+    song, and exits with an error if the outputs differ by more than the
+    tolerance.
+
+Usage:
+    export_model.py [options] <config> <params> <model>
+
+Arguments:
+    <config>  experiment configuration file (yaml)
+    <params>  parameter file of the trained network (params_fold_*.pkl)
+    <model>   file to store the exported network to (.npz)
+
+Options:
+    -f=<fold>       test fold the network was trained for [default: 0]
+    --optimize      optimise the exported network for inference
+    --check         compare the exported network with the Theano network
+    -t=<tolerance>  maximum absolute difference of the outputs
+                    [default: 1e-4]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+import yaml
+from docopt import docopt
+
+import dmgr
+
+import nn
+from chordrec import data, export, features, targets
+from chordrec.models import dnn, avg_gap_feature, crf, rnn
+
+MODELS = {'dnn': dnn, 'avg_gap_feature': avg_gap_feature, 'crf': crf,
+          'rnn': rnn}
+
+# sequence length to count the operations of recurrent networks for
+SEQ_LEN = 100
+
+
+def process_time(network, agg_dataset, use_mask, batch_size=None):
+    start = time.time()
+    for ds_idx in range(agg_dataset.n_datasources):
+        ds = agg_dataset.datasource(ds_idx)
+        for batch, _ in dmgr.iterators.iterate_batches(
+                ds, batch_size or ds.n_data, randomise=False, expand=False):
+            if use_mask:
+                network(batch[None, :])
+            else:
+                network(batch)
+    return time.time() - start
+
+
+def optimize(network, agg_dataset, use_mask, batch_size=None):
+    if use_mask:
+        data_shape = (1, SEQ_LEN) + agg_dataset.dshape
+        num_frames = SEQ_LEN
+    else:
+        data_shape = (1,) + agg_dataset.dshape
+        num_frames = 1
+
+    optimized = export.optimize(network, data_shape)
+
+    print('{:>10s} {:>7s} {:>14s} {:>12s}'.format(
+        '', 'layers', 'FLOPs/frame', 'test set'))
+    for name, net in [('exported', network), ('optimised', optimized)]:
+        num_flops = sum(f for _, _, f in export.flops(net, data_shape))
+        print('{:>10s} {:7d} {:14,d} {:11.2f}s'.format(
+            name, len(net.graph), num_flops // num_frames,
+            process_time(net, agg_dataset, use_mask, batch_size)))
+
+    return optimized
+
+
+def main():
+    args = docopt(__doc__)
+    cfg = yaml.load(open(args['<config>']))
+    test_fold = int(args['-f'])
+
+    ds_cfg = cfg['datasource']
+    fe = features.create_extractor(cfg['feature_extractor'], test_fold)
+    target = targets.create_target(fe.fps, cfg['target'])
+    session = data.DatasetSession(
+        dataset_names=ds_cfg['datasets'],
+        preprocessors=ds_cfg.get('preprocessors', []),
+        compute_targets=target,
+        context_size=ds_cfg.get('context_size', 0)
+    )
+    _, _, test_set, _ = session.datasources(fe, test_fold=test_fold)
+
+    mdl = MODELS[cfg['model']['type']].build_model(
+        in_shape=test_set.dshape, out_size=target.num_classes,
+        model=cfg['model'])
+    nn.load_params(mdl['network'], args['<params>'])
+    mask_var = mdl.get('mask_var')
+    batch_size = cfg.get('testing', {}).get('batch_size')
+
+    export.export(args['<model>'], mdl['network'], mdl['input_var'],
+                  mask_var)
+    print('Exported network to {}'.format(args['<model>']))
+
+    if args['--optimize']:
+        network = optimize(export.load(args['<model>']), test_set,
+                           use_mask=mask_var is not None,
+                           batch_size=batch_size)
+        export.save(args['<model>'], network)
+        print('Optimised network')
+
+    if not args['--check']:
+        return
+
+    start = time.time()
+    process_fn = nn.compile_process_func(mdl['network'], mdl['input_var'],
+                                         mask_var=mask_var)
+    compile_time = time.time() - start
+
+    start = time.time()
+    network = export.load(args['<model>'])
+    load_time = time.time() - start
+
+    print('Ready to process: theano {:.2f}s, numpy {:.3f}s'.format(
+        compile_time, load_time))
+
+    max_diff, agreement = export.verify(
+        process_fn, network, test_set, use_mask=mask_var is not None,
+        batch_size=batch_size)
+    print('Max. abs. difference: {:.3g}'.format(max_diff))
+    print('Same prediction:      {:.2f}% of frames'.format(agreement * 100))
+
+    if max_diff > float(args['-t']):
+        print('Outputs differ by more than {}'.format(args['-t']),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,8 @@ import madmom as mm
 import mir_eval
 
 from dmgr.files import find, match_files
+from chordrec.audio import load_signal
+from chordrec.targets import assign_segments
 
 
 def to_chroma(intervals, labels, num_frames, fps):
@@ -48,14 +50,10 @@ def to_chroma(intervals, labels, num_frames, fps):
     ends = np.round(ends, decimals=3)
     frame_times = np.round(frame_times, decimals=3)
 
-    target_per_frame = ((starts <= frame_times[:, np.newaxis]) &
-                        (frame_times[:, np.newaxis] < ends))
-
-    # make sure each frame is assigned to only one target vector
-    assert (target_per_frame.sum(axis=1) == 1).all()
-
-    # create the one hot vectors per frame
-    return chromas[np.nonzero(target_per_frame)[1]].astype(np.float32)
+    # create the chroma vectors per frame. this makes sure each frame
+    # is assigned to exactly one chroma vector
+    return chromas[assign_segments(starts, ends, frame_times)].astype(
+        np.float32)
 
 
 def main():
@@ -73,7 +71,8 @@ def main():
     audio_files = match_files(chord_files, audio_files, '.chords', '.flac')
 
     for cf, af in izip(chord_files, audio_files):
-        sig = mm.audio.signal.FramedSignal(af, fps=float(args['<fps>']))
+        sig = mm.audio.signal.FramedSignal(load_signal(af),
+                                           fps=float(args['<fps>']))
         intervals, labels = mir_eval.io.load_labeled_intervals(cf)
 
         chromas = to_chroma(intervals, labels, sig.num_frames, 
@@ -0,0 +1,148 @@
+"""
+float16_error.py
+
+    Measures how much precision features lose when they are stored as
+    float16 (feature_extractor.dtype=float16). For the cached float32
+    features of each dataset, it reports the maximum absolute and mean
+    relative error of the float16 values, how many values overflow or flush
+    to zero, and the memory the features take in both data types.
+
+    Given an exported network (see export_model.py) trained on the float32
+    features, it also labels the test set of its fold from features stored
+    as float32 and as float16, and reports the WCSR (majmin and root) of
+    both. To measure the impact on training as well, run the same
+    experiment twice, e.g. for the convolutional network:
+
+        python -m chordrec.classify with conv_net log_filt_spec
+        python -m chordrec.classify with conv_net log_filt_spec \\
+            feature_extractor.dtype=float16
+
+    and compare the results of all folds (results.yaml).
+
+Usage:
+    float16_error.py [options] <config>
+
+Arguments:
+    <config>  experiment configuration file (yaml)
+
+Options:
+    -d=<data_dir>   data directory [default: data]
+    -c=<cache_dir>  feature cache directory [default: feature_cache]
+    -m=<model>      exported network to compare the WCSR with (.npz)
+    -f=<fold>       test fold the network was trained for [default: 0]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import yaml
+import numpy as np
+from docopt import docopt
+
+import dmgr
+from chordrec import data, export, features, targets, test
+
+
+def wcsr(network, cfg, dtype, test_fold, data_dir, cache_dir):
+    fe = features.create_extractor(
+        dict(cfg['feature_extractor'], dtype=dtype), test_fold)
+    target = targets.create_target(fe.fps, cfg['target'])
+    _, _, test_set, gt_files = data.create_datasources(
+        dataset_names=cfg['datasource']['datasets'],
+        preprocessors=cfg['datasource'].get('preprocessors', []),
+        compute_features=fe,
+        compute_targets=target,
+        context_size=cfg['datasource'].get('context_size', 0),
+        data_dir=data_dir,
+        feature_cache_dir=cache_dir,
+        test_fold=test_fold
+    )
+    use_mask = any(layer['type'] == 'input' and layer['role'] == 'mask'
+                   for layer in network.graph)
+
+    def process_fn(batch, *mask):
+        # like augmenters.Upcast in training
+        return network(batch.astype(np.float32), *mask)
+
+    dest_dir = tempfile.mkdtemp()
+    try:
+        pred_files = test.compute_labeling(
+            process_fn, target, test_set, dest_dir=dest_dir,
+            use_mask=use_mask,
+            batch_size=cfg.get('testing', {}).get('batch_size'))
+        test_gt_files = dmgr.files.match_files(
+            pred_files, test.PREDICTION_EXT, gt_files, data.GT_EXT)
+        return test.compute_average_scores(test_gt_files, pred_files)
+    finally:
+        shutil.rmtree(dest_dir)
+
+
+def main():
+    args = docopt(__doc__)
+    cfg = yaml.load(open(args['<config>']))
+
+    fe_cfg = dict(cfg['feature_extractor'], dtype='float32')
+    fe = features.create_extractor(fe_cfg, None)
+    target = targets.create_target(fe.fps, cfg['target'])
+    f16_max = np.finfo(np.float16).max
+    f16_tiny = np.finfo(np.float16).tiny
+
+    for name in cfg['datasource']['datasets']:
+        data.precompute(name, args['-d'], args['-c'], fe, target)
+        feat_dir = os.path.join(args['-c'], name, fe.name)
+
+        max_abs = 0.
+        sum_rel = 0.
+        num_rel = 0
+        num_values = 0
+        num_overflow = 0
+        num_flushed = 0
+
+        for feat_file in dmgr.files.find(feat_dir, '*' + data.FEAT_EXT):
+            f32 = np.load(feat_file, mmap_mode='r').astype(np.float64)
+            f16 = f32.astype(np.float16).astype(np.float64)
+
+            finite = np.isfinite(f16)
+            num_overflow += np.count_nonzero(~finite)
+            num_flushed += np.count_nonzero((f16 == 0) & (f32 != 0))
+
+            err = np.abs(f16 - f32)[finite]
+            max_abs = max(max_abs, err.max() if err.size else 0.)
+            nonzero = (f32 != 0)[finite]
+            sum_rel += (err[nonzero] / np.abs(f32[finite][nonzero])).sum()
+            num_rel += np.count_nonzero(nonzero)
+            num_values += f32.size
+
+        print('{} ({})'.format(name, fe.name))
+        print('  values:             {}'.format(num_values))
+        print('  max. abs. error:    {:.3g}'.format(max_abs))
+        print('  mean rel. error:    {:.3g}'.format(
+            sum_rel / max(num_rel, 1)))
+        print('  overflow (> {:g}): {}'.format(f16_max, num_overflow))
+        print('  flushed to zero:    {} (|x| < {:.3g} are subnormal)'.format(
+            num_flushed, f16_tiny))
+        print('  memory:             {:.1f} MB -> {:.1f} MB'.format(
+            num_values * 4 / 2. ** 20, num_values * 2 / 2. ** 20))
+
+    if args['-m'] is None:
+        return
+
+    network = export.load(args['-m'])
+    test_fold = int(args['-f'])
+    scores = {dtype: wcsr(network, cfg, dtype, test_fold, args['-d'],
+                          args['-c'])
+              for dtype in ['float32', 'float16']}
+
+    print('WCSR on test fold {} ({})'.format(test_fold, args['-m']))
+    print('{:>10s} {:>8s} {:>8s}'.format('', 'majmin', 'root'))
+    for dtype in ['float32', 'float16']:
+        print('{:>10s} {:8.4f} {:8.4f}'.format(
+            dtype, scores[dtype]['majmin'], scores[dtype]['root']))
+    print('{:>10s} {:+8.4f} {:+8.4f}'.format(
+        'change', scores['float16']['majmin'] - scores['float32']['majmin'],
+        scores['float16']['root'] - scores['float32']['root']))
+
+
+if __name__ == '__main__':
+    main()
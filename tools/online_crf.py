@@ -0,0 +1,77 @@
+"""
+online_crf.py
+
+    Measures how well a trained crf model labels chords online, with a fixed
+    lag (see chordrec.viterbi.FixedLagViterbi). For each lag, it decodes the
+    songs of the test set frame by frame and reports how often the online
+    decision differs from the Viterbi path of the whole song, and the delay
+    this lag means at the frame rate of the features.
+
+Usage:
+    online_crf.py [options] <config> <params>
+
+Arguments:
+    <config>  experiment configuration file of the crf model (yaml)
+    <params>  parameter file of the trained crf (params_fold_*.pkl)
+
+Options:
+    -f=<fold>  test fold the crf was trained for [default: 0]
+    -l=<lags>  comma-separated lags in frames [default: 0,1,2,5,10,20,50]
+"""
+from __future__ import print_function
+
+import pickle
+
+import numpy as np
+import yaml
+from docopt import docopt
+
+from chordrec import data, features, targets
+from chordrec.viterbi import viterbi, FixedLagViterbi
+
+
+def main():
+    args = docopt(__doc__)
+    cfg = yaml.load(open(args['<config>']))
+    test_fold = int(args['-f'])
+    lags = [int(lag) for lag in args['-l'].split(',')]
+
+    ds_cfg = cfg['datasource']
+    fe = features.create_extractor(cfg['feature_extractor'], test_fold)
+    target = targets.create_target(fe.fps, cfg['target'])
+    session = data.DatasetSession(
+        dataset_names=ds_cfg['datasets'],
+        preprocessors=ds_cfg.get('preprocessors', []),
+        compute_targets=target,
+        context_size=ds_cfg.get('context_size', 0)
+    )
+    _, _, test_set, _ = session.datasources(fe, test_fold=test_fold)
+
+    # parameters are stored in the order pi, tau, c, A, W
+    crf_params = pickle.load(open(args['<params>'], 'rb'))
+
+    num_frames = 0
+    num_differ = {lag: 0 for lag in lags}
+    for ds_idx in range(test_set.n_datasources):
+        ds = test_set.datasource(ds_idx)
+        song = ds[0:ds.n_data][0]
+        full = viterbi(song[np.newaxis], *crf_params)[0]
+        num_frames += len(full)
+
+        for lag in lags:
+            decoder = FixedLagViterbi(*crf_params, lag=lag)
+            online = np.concatenate(
+                [decoder.process(song[i:i + 1]) for i in range(len(song))] +
+                [decoder.finish()])
+            num_differ[lag] += np.count_nonzero(online != full)
+
+    print('{:>6s} {:>8s} {:>14s}'.format('lag', 'delay', 'differs from'))
+    print('{:>6s} {:>8s} {:>14s}'.format('frames', 'seconds', 'full Viterbi'))
+    for lag in lags:
+        print('{:6d} {:8.2f} {:13.2f}%'.format(
+            lag, lag / float(fe.fps),
+            num_differ[lag] * 100. / max(num_frames, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+pack_shards.py
+
+    Packs the cached per-song features and targets of datasets into shards,
+    one per dataset and feature (or target) name. Experiments then open a
+    single memory-mapped file instead of one file per song, and the shards
+    are much faster to copy between machines. See chordrec/shards.py for
+    the format.
+
+Usage:
+    pack_shards.py [options] <datasets>...
+
+Arguments:
+    <datasets>  names of the datasets to pack
+
+Options:
+    -c=<cache_dir>  feature cache directory [default: feature_cache]
+"""
+from __future__ import print_function
+
+import os
+from docopt import docopt
+
+import dmgr
+from chordrec import data, shards
+
+
+def main():
+    args = docopt(__doc__)
+
+    for name in args['<datasets>']:
+        cache_dir = os.path.join(args['-c'], name)
+        for ext in [data.FEAT_EXT, data.TARG_EXT]:
+            song_files = list(dmgr.files.find(cache_dir, '*' + ext))
+
+            # group the files by feature (or target) directory
+            dirs = {}
+            for sf in song_files:
+                dirs.setdefault(os.path.dirname(sf), []).append(sf)
+
+            for files in dirs.values():
+                shard_files = shards.pack(files, ext)
+                print('{}: {} songs'.format(shard_files[0], len(files)))
+
+
+if __name__ == '__main__':
+    main()
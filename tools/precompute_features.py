@@ -0,0 +1,74 @@
+"""
+precompute_features.py
+
+    Fills the feature cache for several experiment configurations at once.
+    Features that are computed from spectrograms (LogFiltSpec, Chroma and
+    DeepChroma) share one spectrogram per frame size, all others are computed
+    separately. Each feature is cached under its usual name, together with
+    the targets of all configurations that use it, so the experiments find
+    them already computed.
+
+Usage:
+    precompute_features.py [options] <configs>...
+
+Arguments:
+    <configs>  experiment configuration files (yaml)
+
+Options:
+    -j=<num_workers>  number of worker processes [default: 1]
+    -d=<data_dir>     data directory [default: data]
+    -c=<cache_dir>    feature cache directory [default: feature_cache]
+"""
+
+import yaml
+from docopt import docopt
+
+from chordrec import data, features, targets
+
+
+def main():
+    args = docopt(__doc__)
+
+    configs = [yaml.load(open(c)) for c in args['<configs>']]
+
+    # group feature extractors that can share spectrograms by their frame
+    # and sample rate, and collect the targets each group is used with
+    shared = {}
+    separate = []
+    shared_targets = {}
+    separate_targets = []
+    for cfg in configs:
+        fe = cfg['feature_extractor']
+        if fe['name'] in ('LogFiltSpec', 'Chroma', 'DeepChroma'):
+            key = (fe['params']['fps'], fe['params'].get('sample_rate', 44100))
+            if fe not in shared.setdefault(key, []):
+                shared[key].append(fe)
+            group_targets = shared_targets.setdefault(key, [])
+        else:
+            if fe not in separate:
+                separate.append(fe)
+                separate_targets.append([])
+            group_targets = separate_targets[separate.index(fe)]
+        if cfg['target'] not in group_targets:
+            group_targets.append(cfg['target'])
+
+    extractors = [(features.MultiFeature(fes), shared_targets[key])
+                  for key, fes in shared.items()]
+    extractors += [(features.create_extractor(fe, None), target_cfgs)
+                   for fe, target_cfgs in zip(separate, separate_targets)]
+
+    dataset_names = sorted(set(sum((cfg['datasource']['datasets']
+                                    for cfg in configs), [])))
+
+    for ext, target_cfgs in extractors:
+        # features are computed with the first target only, they are
+        # cached for the others
+        for target in target_cfgs:
+            target_computer = targets.create_target(ext.fps, target)
+            for name in dataset_names:
+                data.precompute(name, args['-d'], args['-c'], ext,
+                                target_computer, int(args['-j']))
+
+
+if __name__ == '__main__':
+    main()
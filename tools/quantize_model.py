@@ -0,0 +1,136 @@
+"""
+quantize_model.py
+
+    Quantises an exported network (see export_model.py) to int8 weights and
+    activations (post-training quantisation, see chordrec.export.quantize).
+    The network is optimised first, so that batch normalisations are folded
+    into the quantised weights. The activation ranges are calibrated on
+    randomly drawn frames (or songs, for rnn and crf models) of the training
+    set of the fold.
+
+    The tool labels the test set of the fold with the original and the
+    quantised network, and reports the WCSR (majmin and root) of both, so
+    one can decide whether the quantised network is accurate enough.
+
+    NumPy has no int8 matrix products, so the exported networks compute the
+    products of the int8 values in float32: the quantised network has the
+    accuracy of an int8 network, but not its speed. The times the tool
+    reports are those of this float32 simulation, they do not tell the
+    speedup of an int8 implementation.
+
+Usage:
+    quantize_model.py [options] <config> <model> <quantized>
+
+Arguments:
+    <config>     experiment configuration file (yaml)
+    <model>      exported network (.npz)
+    <quantized>  file to store the quantised network to (.npz)
+
+Options:
+    -f=<fold>    test fold the network was trained for [default: 0]
+    -n=<frames>  number of training frames to calibrate on [default: 10000]
+    -s=<seed>    random seed for drawing the calibration data [default: 0]
+"""
+from __future__ import print_function
+
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import yaml
+from docopt import docopt
+
+import dmgr
+from chordrec import data, export, features, targets, test
+
+
+def calibration_data(train_set, num_frames, use_mask):
+    if not use_mask:
+        idxs = np.random.choice(train_set.n_data,
+                                min(num_frames, train_set.n_data),
+                                replace=False)
+        # process the calibration frames in batches of moderate size
+        for batch in np.array_split(np.sort(idxs),
+                                    -(-len(idxs) // 1024)):
+            yield train_set[batch][0]
+        return
+
+    for ds_idx in np.random.permutation(train_set.n_datasources):
+        ds = train_set.datasource(ds_idx)
+        yield ds[0:min(ds.n_data, num_frames)][0][np.newaxis]
+        num_frames -= ds.n_data
+        if num_frames <= 0:
+            return
+
+
+def evaluate(network, test_set, gt_files, target, use_mask, batch_size):
+    dest_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        pred_files = test.compute_labeling(
+            network, target, test_set, dest_dir=dest_dir,
+            use_mask=use_mask, batch_size=batch_size)
+        duration = time.time() - start
+        test_gt_files = dmgr.files.match_files(
+            pred_files, test.PREDICTION_EXT, gt_files, data.GT_EXT)
+        scores = test.compute_average_scores(test_gt_files, pred_files)
+    finally:
+        shutil.rmtree(dest_dir)
+
+    return scores, duration
+
+
+def main():
+    args = docopt(__doc__)
+    cfg = yaml.load(open(args['<config>']))
+    test_fold = int(args['-f'])
+    np.random.seed(int(args['-s']))
+
+    ds_cfg = cfg['datasource']
+    fe = features.create_extractor(cfg['feature_extractor'], test_fold)
+    target = targets.create_target(fe.fps, cfg['target'])
+    train_set, _, test_set, gt_files = data.create_datasources(
+        dataset_names=ds_cfg['datasets'],
+        preprocessors=ds_cfg.get('preprocessors', []),
+        compute_features=fe,
+        compute_targets=target,
+        context_size=ds_cfg.get('context_size', 0),
+        test_fold=test_fold
+    )
+
+    network = export.load(args['<model>'])
+    use_mask = any(layer['type'] == 'input' and layer['role'] == 'mask'
+                   for layer in network.graph)
+    batch_size = cfg.get('testing', {}).get('batch_size')
+
+    if use_mask:
+        data_shape = (1, 100) + train_set.dshape
+    else:
+        data_shape = (1,) + train_set.dshape
+    network = export.optimize(network, data_shape)
+
+    print('Calibrating on {} training frames'.format(args['-n']))
+    quantized = export.quantize(
+        network, calibration_data(train_set, int(args['-n']), use_mask))
+    export.save(args['<quantized>'], quantized)
+    print('Quantised network stored to {}'.format(args['<quantized>']))
+
+    scores, duration = evaluate(network, test_set, gt_files, target,
+                                use_mask, batch_size)
+    q_scores, q_duration = evaluate(quantized, test_set, gt_files, target,
+                                    use_mask, batch_size)
+
+    print('{:>10s} {:>8s} {:>8s}  {}'.format(
+        '', 'majmin', 'root', 'test set (float32 simulation)'))
+    print('{:>10s} {:8.4f} {:8.4f}  {:.2f}s'.format(
+        'float32', scores['majmin'], scores['root'], duration))
+    print('{:>10s} {:8.4f} {:8.4f}  {:.2f}s'.format(
+        'int8', q_scores['majmin'], q_scores['root'], q_duration))
+    print('{:>10s} {:+8.4f} {:+8.4f}'.format(
+        'change', q_scores['majmin'] - scores['majmin'],
+        q_scores['root'] - scores['root']))
+
+
+if __name__ == '__main__':
+    main()